@@ -34,24 +34,31 @@ def create_app(config_name=None):
     app.debug = os.environ.get('DEBUG', 'False').lower() == 'true'
     
     # Habilitar CORS
+    from app.services.search_service import HEADER_FILTRO_TRUNCADO
     app.add_middleware(
         CORSMiddleware,
         allow_origins=["http://localhost:4200", "http://127.0.0.1:4200"],
         allow_credentials=True,
         allow_methods=["*"],
         allow_headers=["*"],
+        expose_headers=[HEADER_FILTRO_TRUNCADO],
     )
     
     # Registrar rutas
-    from app.routes import pacientes, estudios, citas, informes, notificaciones, auth, dicom
+    from app.routes import pacientes, estudios, citas, informes, estadisticas, tarifas, notificaciones, auth, dicom, stream, worklist, plantillas
     
     app.include_router(auth.router, prefix="/api", tags=["Autenticación"])
     app.include_router(pacientes.router, prefix="/api", tags=["Pacientes"])
     app.include_router(estudios.router, prefix="/api", tags=["Estudios"])
     app.include_router(citas.router, prefix="/api", tags=["Citas"])
+    app.include_router(estadisticas.router, prefix="/api", tags=["Estadísticas"])
     app.include_router(informes.router, prefix="/api", tags=["Informes"])
+    app.include_router(tarifas.router, prefix="/api", tags=["Tarifas"])
     app.include_router(notificaciones.router, prefix="/api", tags=["Notificaciones"])
     app.include_router(dicom.router, tags=["DICOM"])
+    app.include_router(stream.router, prefix="/api", tags=["Eventos"])
+    app.include_router(worklist.router, prefix="/api", tags=["Lista de trabajo"])
+    app.include_router(plantillas.router, prefix="/api", tags=["Plantillas"])
     
     # Eventos de startup y shutdown
     @app.on_event("startup")
@@ -67,6 +74,34 @@ def create_app(config_name=None):
             if await test_connection():
                 # Inicializar base de datos
                 await init_database()
+                
+                # Mantener el snapshot de informes al día y publicar los cambios a /api/stream/events
+                if os.getenv("CHANGE_FEED_ENABLED", "True").lower() == "true":
+                    from app.services.change_feed import change_feed
+                    from app.services.event_bus import event_bus
+                    from app.services.informes_snapshot_service import InformesSnapshotService
+                    
+                    change_feed.suscribir(InformesSnapshotService().procesar_cambio)
+                    change_feed.suscribir(event_bus.procesar_cambio)
+                    await change_feed.start()
+                
+                # Recalcular en segundo plano los rollups diarios marcados como sucios
+                from app.services.estadisticas_service import estadisticas_service
+                import asyncio
+                
+                intervalo = float(os.getenv("ESTADISTICAS_COMPACTAR_INTERVALO", "300"))
+                app.state.compactador = asyncio.create_task(
+                    estadisticas_service.ejecutar_compactador(intervalo)
+                )
+                
+                # Las notificaciones las envía run_dispatcher.py; en desarrollo puede correr aquí
+                if os.getenv("NOTIFICACIONES_DISPATCHER_EMBEBIDO", "False").lower() == "true":
+                    from app.services.outbox_service import dispatcher
+                    
+                    app.state.dispatcher = asyncio.create_task(
+                        dispatcher.ejecutar(float(os.getenv("NOTIFICACIONES_INTERVALO", "5")))
+                    )
+                
                 logger.info("Aplicación iniciada correctamente")
             else:
                 logger.error("No se pudo conectar a la base de datos")
@@ -82,7 +117,17 @@ def create_app(config_name=None):
             from app.database import close_database
             import logging
             
+            from app.services.change_feed import change_feed
+            from app.services.email_service import smtp_pool
+            from app.services.sms_service import sms_http
+            
             logger = logging.getLogger(__name__)
+            await change_feed.stop()
+            await smtp_pool.cerrar()
+            await sms_http.cerrar()
+            for tarea in ("compactador", "dispatcher"):
+                if getattr(app.state, tarea, None):
+                    getattr(app.state, tarea).cancel()
             await close_database()
             logger.info("Aplicación cerrada correctamente")
         except Exception as e:
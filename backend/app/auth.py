@@ -23,6 +23,8 @@ pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
 # JWT Bearer token
 security = HTTPBearer()
+# Same, for endpoints that also accept anonymous requests
+optional_security = HTTPBearer(auto_error=False)
 
 def verify_password(plain_password: str, hashed_password: str) -> bool:
     """Verify a password against its hash"""
@@ -127,6 +129,14 @@ async def get_current_user(token_data: dict = Depends(verify_token)) -> User:
     
     return user
 
+async def get_optional_user(
+    credentials: Optional[HTTPAuthorizationCredentials] = Depends(optional_security),
+) -> Optional[User]:
+    """Get current user from token if one was sent, otherwise None"""
+    if credentials is None:
+        return None
+    return await get_current_user(verify_token(credentials))
+
 def get_current_active_user(allowed_roles: list[UserRole] = None):
     """Factory function to create a dependency that checks user roles"""
     async def check_user(current_user: User = Depends(get_current_user)) -> User:
@@ -28,43 +28,56 @@ def object_id_to_str(obj):
         return str(obj)
     raise TypeError(f"Object of type {type(obj)} is not JSON serializable")
 
+def filtro_por_id(valor: str) -> dict:
+    """Construir el filtro de un identificador: ObjectId en _id, identificadores heredados en id"""
+    if isinstance(valor, ObjectId):
+        return {"_id": valor}
+    if ObjectId.is_valid(valor):
+        return {"_id": ObjectId(valor)}
+    return {"id": valor}
+
+async def buscar_por_id(coleccion: str, valor: str, projection=None):
+    """Buscar un documento por su identificador canónico o heredado con una sola consulta indexada"""
+    if not valor:
+        return None
+    return await get_database()[coleccion].find_one(filtro_por_id(valor), projection)
+
 async def init_database():
     """Inicializar la base de datos con índices y configuración"""
     try:
         db = get_database()
         
-        # Crear índices para mejor rendimiento
-        await db.pacientes.create_index("identificacion", unique=True)
-        await db.pacientes.create_index("email")
-        await db.pacientes.create_index("fecha_creacion")
+        # Crear índices compuestos según la versión definida en app.indexes
+        from app.indexes import aplicar_indices
+        await aplicar_indices(db)
         
-        await db.estudios.create_index("paciente_id")
-        await db.estudios.create_index("estado")
-        await db.estudios.create_index("fecha_solicitud")
-        await db.estudios.create_index("tipo_estudio")
-        await db.estudios.create_index("medico_solicitante")
+        # Completar campos de búsqueda de pacientes creados antes del índice
+        from app.services.search_service import SearchService
+        reindexados = await SearchService().reindexar_pacientes()
+        if reindexados:
+            logging.info(f"Campos de búsqueda calculados para {reindexados} pacientes")
         
-        await db.citas.create_index("estudio_id")
-        await db.citas.create_index("fecha_hora")
-        await db.citas.create_index("estado")
-        await db.citas.create_index("tecnico_asignado")
-        await db.citas.create_index("sala")
+        # Crear el catálogo de tarifas inicial si no existe
+        from app.services.tarifas_service import tarifas_service
+        await tarifas_service.sembrar()
         
-        await db.informes.create_index("estudio_id")
-        await db.informes.create_index("medico_radiologo")
-        await db.informes.create_index("fecha_creacion")
-        await db.informes.create_index("firmado")
+        # Prioridad en la lista de trabajo de los informes anteriores a ella
+        from app.services.worklist_service import worklist_service
+        preparados = await worklist_service.preparar()
+        if preparados:
+            logging.info(f"Lista de trabajo calculada para {preparados} informes")
         
-        await db.notificaciones.create_index("paciente_id")
-        await db.notificaciones.create_index("estudio_id")
-        await db.notificaciones.create_index("tipo")
-        await db.notificaciones.create_index("enviada")
-        await db.notificaciones.create_index("fecha_creacion")
+        # Fin de las citas anteriores a la detección de solapamientos
+        from app.services.agenda_service import agenda_service
+        completadas = await agenda_service.preparar()
+        if completadas:
+            logging.info(f"Fecha de fin calculada para {completadas} citas")
         
-        # Índices para archivos DICOM
-        await db.dicom_files.create_index("estudio_id")
-        await db.dicom_files.create_index("paciente_id")
-        await db.dicom_files.create_index("fecha_subida")
+        # Estado de outbox para las notificaciones anteriores al dispatcher
+        from app.services.outbox_service import dispatcher
+        migradas = await dispatcher.preparar()
+        if migradas:
+            logging.info(f"Estado de envío asignado a {migradas} notificaciones")
         
         logging.info("Base de datos inicializada correctamente")
         
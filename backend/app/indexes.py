@@ -0,0 +1,295 @@
+"""
+Definición versionada de índices de MongoDB y catálogo de consultas frecuentes
+"""
+
+from datetime import datetime, timedelta
+import logging
+
+from pymongo import ASCENDING, DESCENDING, IndexModel
+from pymongo.errors import OperationFailure
+
+# Incrementar cada vez que cambie INDICES u OBSOLETOS
+INDEX_VERSION = 15
+
+INDICES = {
+    "pacientes": [
+        IndexModel([("identificacion", ASCENDING)], unique=True),
+        IndexModel([("email", ASCENDING)]),
+        IndexModel([("fecha_creacion", ASCENDING)]),
+        IndexModel([("tokens_busqueda", ASCENDING)]),
+        # Identificadores heredados (no ObjectId) resueltos por buscar_por_id
+        IndexModel([("id", ASCENDING)], sparse=True),
+        # Change feed por polling: documentos modificados después de la última marca
+        IndexModel([("fecha_actualizacion", ASCENDING)]),
+    ],
+    "estudios": [
+        # get_estudios: filtro por estado + rango de fechas, orden por fecha_solicitud
+        IndexModel([("estado", ASCENDING), ("fecha_solicitud", DESCENDING)]),
+        # Estudios de un paciente ordenados por fecha
+        IndexModel([("paciente_id", ASCENDING), ("fecha_solicitud", DESCENDING)]),
+        # Listado sin filtros y estadísticas por rango de solicitud
+        IndexModel([("fecha_solicitud", DESCENDING)]),
+        # Rendimiento y financiero: completados por fecha de realización
+        IndexModel([("estado", ASCENDING), ("fecha_realizacion", ASCENDING)]),
+        IndexModel([("tipo_estudio", ASCENDING)]),
+        IndexModel([("medico_solicitante", ASCENDING)]),
+        IndexModel([("id", ASCENDING)], sparse=True),
+        IndexModel([("fecha_actualizacion", ASCENDING)]),
+    ],
+    "citas": [
+        # get_citas: filtro por estado + día, orden por fecha_cita
+        IndexModel([("estado", ASCENDING), ("fecha_cita", ASCENDING)]),
+        IndexModel([("fecha_cita", ASCENDING)]),
+        IndexModel([("paciente_id", ASCENDING), ("fecha_cita", ASCENDING)]),
+        # delete_estudio: citas activas de un estudio
+        IndexModel([("estudio_id", ASCENDING), ("estado", ASCENDING)]),
+        # Estadísticas por fecha de creación
+        IndexModel([("fecha_creacion", ASCENDING)]),
+        # Agenda: solapamientos por sala y por técnico (fecha_fin se filtra sobre el rango)
+        IndexModel([("sala", ASCENDING), ("fecha_cita", ASCENDING)]),
+        IndexModel([("tecnico_asignado", ASCENDING), ("fecha_cita", ASCENDING)]),
+        IndexModel([("fecha_actualizacion", ASCENDING)]),
+    ],
+    "informes": [
+        IndexModel([("estudio_id", ASCENDING)]),
+        IndexModel([("medico_radiologo", ASCENDING)]),
+        IndexModel([("fecha_creacion", DESCENDING)]),
+        IndexModel([("firmado", ASCENDING)]),
+        IndexModel([("fecha_firma", ASCENDING)], sparse=True),
+        IndexModel([("id", ASCENDING)], sparse=True),
+        # Snapshot de paciente y timeline: informes de un paciente por fecha
+        IndexModel([("paciente_id", ASCENDING), ("fecha_creacion", DESCENDING)]),
+        # Lista de trabajo: informes sin firmar por prioridad y antigüedad
+        IndexModel(
+            [("lista_prioridad", DESCENDING), ("fecha_creacion", ASCENDING)],
+            name="lista_trabajo",
+            partialFilterExpression={"firmado": False},
+        ),
+        IndexModel([("fecha_actualizacion", ASCENDING)]),
+    ],
+    "notificaciones": [
+        IndexModel([("paciente_id", ASCENDING), ("fecha_creacion", DESCENDING)]),
+        IndexModel([("enviada", ASCENDING), ("fecha_creacion", DESCENDING)]),
+        IndexModel([("fecha_creacion", DESCENDING)]),
+        IndexModel([("estudio_id", ASCENDING)]),
+        IndexModel([("tipo", ASCENDING)]),
+        # Outbox: pendientes por orden de disponibilidad y lotes con lease vencido
+        IndexModel([("estado", ASCENDING), ("disponible_desde", ASCENDING)]),
+        IndexModel(
+            [("estado", ASCENDING), ("reclamada_hasta", ASCENDING)],
+            partialFilterExpression={"estado": "enviando"},
+        ),
+        # Recordatorios de citas: una notificación por clave de idempotencia
+        IndexModel([("idempotency_key", ASCENDING)], unique=True, sparse=True),
+        # Agrupación de cambios de estado: a lo sumo un aviso pendiente por paciente y canal
+        IndexModel(
+            [("agrupacion", ASCENDING)],
+            unique=True,
+            partialFilterExpression={"agrupacion": {"$exists": True}, "estado": "pendiente"},
+        ),
+    ],
+    "dicom_files": [
+        IndexModel([("estudio_id", ASCENDING)]),
+        IndexModel([("paciente_id", ASCENDING)]),
+        IndexModel([("fecha_subida", ASCENDING)]),
+    ],
+    "tarifas": [
+        IndexModel([("tipo_estudio", ASCENDING), ("vigente_desde", ASCENDING)]),
+    ],
+    # Rollups diarios (_id = YYYY-MM-DD); el compactador busca los días sucios
+    "estadisticas_diarias": [
+        IndexModel([("sucio", ASCENDING), ("_id", ASCENDING)]),
+    ],
+}
+
+# Índices de versiones anteriores que quedan cubiertos por los compuestos
+OBSOLETOS = {
+    "estudios": ["paciente_id_1", "estado_1", "fecha_solicitud_1"],
+    "citas": ["fecha_hora_1", "estado_1", "estudio_id_1", "tecnico_asignado_1", "sala_1"],
+    "informes": ["fecha_creacion_1", "paciente_id_1"],
+    "notificaciones": ["paciente_id_1", "enviada_1", "fecha_creacion_1", "agrupacion_1_estado_1"],
+}
+
+
+async def aplicar_indices(db, forzar: bool = False) -> bool:
+    """Crear los índices definidos si la versión guardada es anterior a INDEX_VERSION"""
+    estado = await db.schema_info.find_one({"_id": "indices"})
+    version_actual = estado.get("version", 0) if estado else 0
+
+    if version_actual >= INDEX_VERSION and not forzar:
+        return False
+
+    for coleccion, indices in INDICES.items():
+        await db[coleccion].create_indexes(indices)
+
+    for coleccion, nombres in OBSOLETOS.items():
+        for nombre in nombres:
+            try:
+                await db[coleccion].drop_index(nombre)
+            except OperationFailure:
+                # El índice no existe (instalación nueva o ya eliminado)
+                pass
+
+    await db.schema_info.update_one(
+        {"_id": "indices"},
+        {"$set": {"version": INDEX_VERSION, "fecha_actualizacion": datetime.now()}},
+        upsert=True,
+    )
+    logging.info(f"Índices actualizados de la versión {version_actual} a {INDEX_VERSION}")
+    return True
+
+
+def consultas_frecuentes():
+    """Catálogo de las formas de consulta que usa la aplicación, con valores representativos"""
+    hoy = datetime(datetime.now().year, datetime.now().month, datetime.now().day)
+    inicio = hoy - timedelta(days=30)
+    fin = hoy + timedelta(days=1)
+    paciente_id = "000000000000000000000000"
+
+    return [
+        {
+            "nombre": "get_estudios por estado y fecha",
+            "coleccion": "estudios",
+            "filtro": {"estado": "pendiente", "fecha_solicitud": {"$gte": hoy, "$lt": fin}},
+            "orden": [("fecha_solicitud", DESCENDING)],
+        },
+        {
+            "nombre": "get_estudios sin filtros",
+            "coleccion": "estudios",
+            "filtro": {},
+            "orden": [("fecha_solicitud", DESCENDING)],
+        },
+        {
+            "nombre": "estudios de un paciente",
+            "coleccion": "estudios",
+            "filtro": {"paciente_id": paciente_id},
+            "orden": [("fecha_solicitud", DESCENDING)],
+        },
+        {
+            "nombre": "rollup diario de estudios",
+            "coleccion": "estudios",
+            "filtro": {"$or": [
+                {"fecha_solicitud": {"$gte": inicio, "$lt": fin}},
+                {"estado": "completado", "fecha_realizacion": {"$gte": inicio, "$lt": fin}},
+            ]},
+            "orden": None,
+        },
+        {
+            "nombre": "get_citas por estado y día",
+            "coleccion": "citas",
+            "filtro": {"estado": "programada", "fecha_cita": {"$gte": hoy, "$lt": fin}},
+            "orden": [("fecha_cita", ASCENDING)],
+        },
+        {
+            "nombre": "get_citas sin filtros",
+            "coleccion": "citas",
+            "filtro": {},
+            "orden": [("fecha_cita", ASCENDING)],
+        },
+        {
+            "nombre": "delete_estudio citas activas",
+            "coleccion": "citas",
+            "filtro": {"estudio_id": paciente_id, "estado": {"$in": ["programada", "en_proceso"]}},
+            "orden": None,
+        },
+        {
+            "nombre": "rollup diario de citas",
+            "coleccion": "citas",
+            "filtro": {"fecha_creacion": {"$gte": inicio, "$lt": fin}},
+            "orden": None,
+        },
+        {
+            "nombre": "rollup diario de ocupación",
+            "coleccion": "citas",
+            "filtro": {"fecha_cita": {"$gte": inicio, "$lt": fin}, "estado": {"$ne": "cancelada"}},
+            "orden": None,
+        },
+        {
+            "nombre": "conflictos de agenda de una sala",
+            "coleccion": "citas",
+            "filtro": {
+                "sala": "Sala 1",
+                "fecha_cita": {"$gte": hoy - timedelta(hours=12), "$lt": fin},
+                "fecha_fin": {"$gt": hoy},
+                "estado": {"$nin": ["cancelada"]},
+            },
+            "orden": None,
+        },
+        {
+            "nombre": "búsqueda de pacientes por prefijo",
+            "coleccion": "pacientes",
+            "filtro": {"tokens_busqueda": {"$regex": "^jua"}},
+            "orden": None,
+        },
+        {
+            "nombre": "informe por identificador heredado",
+            "coleccion": "informes",
+            "filtro": {"id": "00000000-0000-0000-0000-000000000000"},
+            "orden": None,
+        },
+        {
+            "nombre": "get_informes",
+            "coleccion": "informes",
+            "filtro": {},
+            "orden": [("fecha_creacion", DESCENDING)],
+        },
+        {
+            "nombre": "lista de trabajo de radiólogos",
+            "coleccion": "informes",
+            "filtro": {"firmado": False, "$or": [
+                {"asignado_hasta": None}, {"asignado_hasta": {"$lte": hoy}},
+            ]},
+            "orden": [("lista_prioridad", DESCENDING), ("fecha_creacion", ASCENDING)],
+        },
+        {
+            "nombre": "notificaciones de un paciente",
+            "coleccion": "notificaciones",
+            "filtro": {"paciente_id": paciente_id},
+            "orden": [("fecha_creacion", DESCENDING)],
+        },
+        {
+            "nombre": "notificaciones pendientes",
+            "coleccion": "notificaciones",
+            "filtro": {"enviada": False},
+            "orden": [("fecha_creacion", DESCENDING)],
+        },
+        {
+            "nombre": "outbox de notificaciones",
+            "coleccion": "notificaciones",
+            "filtro": {"$or": [
+                {"estado": "pendiente", "disponible_desde": {"$lte": hoy}},
+                {"estado": "enviando", "reclamada_hasta": {"$lte": hoy}},
+            ]},
+            "orden": [("disponible_desde", ASCENDING)],
+        },
+        {
+            "nombre": "citas para recordatorios del día siguiente",
+            "coleccion": "citas",
+            "filtro": {"estado": "programada", "fecha_cita": {"$gte": hoy, "$lt": fin}},
+            "orden": None,
+        },
+        {
+            "nombre": "recordatorios ya encolados",
+            "coleccion": "notificaciones",
+            "filtro": {"idempotency_key": {"$in": ["recordatorio:"]}},
+            "orden": None,
+        },
+        {
+            "nombre": "aviso agrupado pendiente de un paciente",
+            "coleccion": "notificaciones",
+            "filtro": {"agrupacion": f"estados:{paciente_id}:email", "estado": "pendiente"},
+            "orden": None,
+        },
+        {
+            "nombre": "change feed por polling",
+            "coleccion": "estudios",
+            "filtro": {"fecha_actualizacion": {"$gt": hoy}},
+            "orden": [("fecha_actualizacion", ASCENDING)],
+        },
+        {
+            "nombre": "métricas de entrega de notificaciones",
+            "coleccion": "notificaciones",
+            "filtro": {"fecha_creacion": {"$gte": inicio}},
+            "orden": None,
+        },
+    ]
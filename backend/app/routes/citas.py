@@ -1,62 +1,57 @@
-from fastapi import APIRouter, HTTPException, BackgroundTasks
+from fastapi import APIRouter, HTTPException, Response
 from datetime import datetime, timedelta
-from app.schemas import CitaCreate, Cita, CitaUpdate
+from app.schemas import CitaCreate, Cita, CitaUpdate, DURACION_MAXIMA_CITA
 from app.database import get_database
 from app.services.email_service import EmailService
 from app.services.sms_service import SMSService
+from app.services.search_service import HEADER_FILTRO_TRUNCADO, SearchService
+from app.services.estadisticas_service import estadisticas_service
+from app.services.event_bus import event_bus
+from app.services.outbox_service import encolar, nueva_notificacion
+from app.services.plantilla_service import plantilla_service
+from app.services.agenda_service import agenda_service, calcular_fecha_fin, ESTADOS_LIBRES
+from app.services.recordatorios_service import recordatorios_service
 from bson import ObjectId
 from typing import List
+import re
+import logging
 
 router = APIRouter()
 email_service = EmailService()
 sms_service = SMSService()
+search_service = SearchService()
 
 
-async def send_appointment_notifications(
-    email: str, telefono: str, fecha_cita: datetime, tipo_estudio: str
-):
-    """Enviar notificaciones de cita por email y SMS"""
-    try:
-        # Formatear fecha para mostrar
-        fecha_formateada = fecha_cita.strftime("%d/%m/%Y a las %H:%M")
-
-        # Enviar email solo si el servicio está configurado
-        if email:
-            try:
-                subject = "Confirmación de Cita - Imagenología"
-                body = f"""
-                Estimado paciente,
-
-                Su cita ha sido programada exitosamente:
-
-                Fecha y Hora: {fecha_formateada}
-                Tipo de Estudio: {tipo_estudio}
-
-                Por favor, llegue 15 minutos antes de su cita.
-
-                Saludos,
-                Centro de Imagenología
-                """
-                await email_service.send_email(email, subject, body)
-                print(f"Email enviado a {email}")
-            except Exception as e:
-                print(f"No se pudo enviar email (servicio no configurado): {e}")
-
-        # Enviar SMS solo si el servicio está configurado
-        if telefono:
-            try:
-                mensaje = f"Cita confirmada: {tipo_estudio} el {fecha_formateada}. Centro de Imagenología."
-                await sms_service.send_sms(telefono, mensaje)
-                print(f"SMS enviado a {telefono}")
-            except Exception as e:
-                print(f"No se pudo enviar SMS (servicio no configurado): {e}")
+def notificaciones_cita(paciente: dict, cita: dict) -> list:
+    """Confirmación de cita por email y SMS según los datos de contacto del paciente"""
+    mensaje = plantilla_service.renderizar("confirmacion_cita", {
+        "fecha_cita": cita["fecha_cita"].strftime("%d/%m/%Y a las %H:%M"),
+        "tipo_estudio": cita["tipo_estudio"],
+    }, paciente.get("idioma"))
+    paciente_id = str(paciente["_id"])
+    notificaciones = []
 
-    except Exception as e:
-        print(f"Error general enviando notificaciones: {e}")
+    if paciente.get("email"):
+        notificaciones.append(nueva_notificacion(
+            paciente_id, "email", mensaje.texto,
+            titulo=mensaje.asunto,
+            estudio_id=cita.get("estudio_id"),
+            cita_id=str(cita["_id"]),
+        ))
+
+    if paciente.get("telefono"):
+        notificaciones.append(nueva_notificacion(
+            paciente_id, "sms", mensaje.sms,
+            estudio_id=cita.get("estudio_id"),
+            cita_id=str(cita["_id"]),
+        ))
+
+    return notificaciones
 
 
 @router.get("/citas", response_model=List[Cita])
 async def get_citas(
+    response: Response,
     fecha: str = None,
     estado: str = None,
     tipo_estudio: str = None,
@@ -87,26 +82,22 @@ async def get_citas(
 
     # Filtro por tipo de estudio
     if tipo_estudio and tipo_estudio != "Todos":
-        query["tipo_estudio"] = {"$regex": tipo_estudio, "$options": "i"}
+        query["tipo_estudio"] = {"$regex": re.escape(tipo_estudio), "$options": "i"}
 
     # Filtro por tipo de cita (nuevo)
     if tipo_cita and tipo_cita != "Todos":
-        query["tipo_cita"] = {"$regex": tipo_cita, "$options": "i"}
+        query["tipo_cita"] = {"$regex": re.escape(tipo_cita), "$options": "i"}
 
     citas = []
     cursor = db.citas.find(query).skip(skip).limit(limit).sort("fecha_cita", 1)
 
     # Aplicar filtro por nombre de paciente en la consulta de MongoDB si se especifica
     if paciente_nombre:
-        # Buscar pacientes que coincidan con el nombre
-        nombre_regex = {"$regex": paciente_nombre, "$options": "i"}
-        pacientes_coincidentes = db.pacientes.find(
-            {"$or": [{"nombre": nombre_regex}, {"apellidos": nombre_regex}]}
-        )
-
-        pacientes_ids = []
-        async for p in pacientes_coincidentes:
-            pacientes_ids.append(str(p["_id"]))
+        # Buscar pacientes por prefijos normalizados usando el índice de tokens
+        pacientes_ids, truncado = await search_service.ids_pacientes_por_nombre(paciente_nombre)
+        if truncado:
+            # Demasiados pacientes coinciden: el resultado solo cubre los primeros
+            response.headers[HEADER_FILTRO_TRUNCADO] = "true"
 
         if pacientes_ids:
             query["paciente_id"] = {"$in": pacientes_ids}
@@ -150,6 +141,57 @@ async def get_citas(
     return citas
 
 
+@router.get("/citas/disponibilidad")
+async def get_disponibilidad(
+    fecha: str,
+    hasta: str = None,
+    sala: str = None,
+    tecnico: str = None,
+    duracion_minutos: int = 30,
+    paso_minutos: int = None,
+):
+    """Horarios libres de una sala y/o técnico entre fecha y hasta (YYYY-MM-DD, inclusive)"""
+    if not sala and not tecnico:
+        raise HTTPException(status_code=400, detail="Debe indicar una sala o un técnico")
+    if not 0 < duracion_minutos <= DURACION_MAXIMA_CITA or (paso_minutos is not None and paso_minutos <= 0):
+        raise HTTPException(status_code=400, detail="Duración o paso inválidos")
+
+    try:
+        inicio = datetime.strptime(fecha, "%Y-%m-%d")
+        fin = datetime.strptime(hasta or fecha, "%Y-%m-%d") + timedelta(days=1)
+    except ValueError:
+        raise HTTPException(
+            status_code=400, detail="Formato de fecha inválido. Use YYYY-MM-DD"
+        )
+    if fin <= inicio or (fin - inicio).days > 31:
+        raise HTTPException(status_code=400, detail="El rango debe cubrir entre 1 y 31 días")
+
+    dias = await agenda_service.disponibilidad(
+        inicio, fin, duracion_minutos, sala=sala, tecnico=tecnico, paso_minutos=paso_minutos
+    )
+    return {
+        "sala": sala,
+        "tecnico": tecnico,
+        "duracion_minutos": duracion_minutos,
+        "dias": dias,
+    }
+
+
+@router.post("/citas/recordatorios")
+async def generar_recordatorios(fecha: str = None):
+    """Encolar los recordatorios de las citas de un día (YYYY-MM-DD, por defecto mañana).
+
+    Es idempotente: las citas que ya tienen recordatorio no se vuelven a encolar.
+    """
+    try:
+        dia = datetime.strptime(fecha, "%Y-%m-%d").date() if fecha else None
+    except ValueError:
+        raise HTTPException(
+            status_code=400, detail="Formato de fecha inválido. Use YYYY-MM-DD"
+        )
+    return await recordatorios_service.generar(dia)
+
+
 @router.get("/citas/{cita_id}", response_model=Cita)
 async def get_cita(cita_id: str):
     """Obtener una cita específica por ID"""
@@ -179,7 +221,7 @@ async def get_citas_estudio(estudio_id: str):
 
         citas = []
         async for cita in db.citas.find({"estudio_id": estudio_id}).sort(
-            "fecha_hora", 1
+            "fecha_cita", 1
         ):
             cita["id"] = str(cita["_id"])
             citas.append(Cita(**cita))
@@ -190,7 +232,7 @@ async def get_citas_estudio(estudio_id: str):
 
 
 @router.post("/citas", response_model=Cita)
-async def create_cita(cita: CitaCreate, background_tasks: BackgroundTasks):
+async def create_cita(cita: CitaCreate):
     """Crear una nueva cita"""
     db = get_database()
 
@@ -201,25 +243,30 @@ async def create_cita(cita: CitaCreate, background_tasks: BackgroundTasks):
 
     # Crear la cita
     cita_dict = cita.dict()
+    cita_dict["fecha_fin"] = calcular_fecha_fin(cita.fecha_cita, cita.duracion_minutos)
     cita_dict["fecha_creacion"] = datetime.now()
     cita_dict["fecha_actualizacion"] = datetime.now()
 
-    result = await db.citas.insert_one(cita_dict)
+    # Verificar que la sala y el técnico estén libres y guardar mientras siguen bloqueados
+    async with agenda_service.reservar(
+        cita_dict["fecha_cita"], cita_dict["fecha_fin"], cita.sala, cita.tecnico_asignado
+    ):
+        result = await db.citas.insert_one(cita_dict)
+    await estadisticas_service.registrar_cambio_cita(cita_dict)
+    event_bus.publicar_local("citas", "insert", cita_dict)
     nueva_cita = await db.citas.find_one({"_id": result.inserted_id})
     nueva_cita["id"] = str(nueva_cita["_id"])
     nueva_cita["paciente_nombre"] = paciente["nombre"]
     nueva_cita["paciente_apellidos"] = paciente.get("apellidos")
     del nueva_cita["_id"]
 
-    # Enviar notificaciones
-    if paciente.get("email"):
-        background_tasks.add_task(
-            send_appointment_notifications,
-            paciente["email"],
-            paciente.get("telefono"),
-            nueva_cita["fecha_cita"],
-            nueva_cita["tipo_estudio"],
-        )
+    # Confirmación al paciente por el outbox de notificaciones; la cita ya está
+    # guardada, así que un error de plantilla no debe hacer fallar la petición
+    await plantilla_service.actualizar()
+    try:
+        await encolar(*notificaciones_cita(paciente, cita_dict))
+    except ValueError as e:
+        logging.error(f"No se pudo generar la confirmación de la cita {result.inserted_id}: {str(e)}")
 
     return Cita(**nueva_cita)
 
@@ -254,35 +301,45 @@ async def update_cita(cita_id: str, cita: CitaUpdate):
 
         update_data["fecha_actualizacion"] = datetime.now()
 
-        # Si se está cambiando la fecha/hora, verificar disponibilidad
-        if "fecha_hora" in update_data:
-            cita_existente = await db.citas.find_one(
-                {
-                    "fecha_hora": update_data["fecha_hora"],
-                    "_id": {"$ne": ObjectId(cita_id)},
-                    "$or": [
-                        {"sala": update_data.get("sala", existing_appointment["sala"])},
-                        {
-                            "tecnico_asignado": update_data.get(
-                                "tecnico_asignado",
-                                existing_appointment["tecnico_asignado"],
-                            )
-                        },
-                    ],
-                }
+        cita_final = {**existing_appointment, **update_data}
+        cambia_horario = "fecha_cita" in update_data or "duracion_minutos" in update_data
+        if cita_final.get("fecha_cita") and (cambia_horario or "fecha_fin" not in cita_final):
+            update_data["fecha_fin"] = calcular_fecha_fin(
+                cita_final["fecha_cita"], cita_final.get("duracion_minutos")
             )
-
-            if cita_existente:
-                raise HTTPException(
-                    status_code=400,
-                    detail="Conflicto de horario: sala o técnico no disponible",
+            cita_final["fecha_fin"] = update_data["fecha_fin"]
+
+        # Si cambia el horario, la sala o el técnico, o se reactiva una cita cancelada,
+        # verificar disponibilidad y guardar mientras la agenda sigue bloqueada
+        campos_agenda = {"fecha_cita", "duracion_minutos", "sala", "tecnico_asignado"}
+        reactivada = existing_appointment.get("estado") in ESTADOS_LIBRES
+        if cita_final.get("fecha_fin") and cita_final.get("estado") not in ESTADOS_LIBRES and (
+            campos_agenda & update_data.keys() or ("estado" in update_data and reactivada)
+        ):
+            async with agenda_service.reservar(
+                cita_final["fecha_cita"],
+                cita_final["fecha_fin"],
+                cita_final.get("sala"),
+                cita_final.get("tecnico_asignado"),
+                excluir_id=existing_appointment["_id"],
+            ):
+                result = await db.citas.update_one(
+                    {"_id": ObjectId(cita_id)}, {"$set": update_data}
                 )
-
-        result = await db.citas.update_one(
-            {"_id": ObjectId(cita_id)}, {"$set": update_data}
-        )
+        else:
+            result = await db.citas.update_one(
+                {"_id": ObjectId(cita_id)}, {"$set": update_data}
+            )
+        await estadisticas_service.registrar_cambio_cita(existing_appointment, update_data)
+        event_bus.publicar_local("citas", "update", {**existing_appointment, **update_data})
 
         if result.modified_count == 1:
+            # Los recordatorios ya encolados son del horario anterior o de una cita que no se hará
+            if cita_final.get("estado") != "programada":
+                await recordatorios_service.cancelar(existing_appointment, f"Cita {cita_final.get('estado')}")
+            elif cita_final.get("fecha_cita") != existing_appointment.get("fecha_cita"):
+                await recordatorios_service.cancelar(existing_appointment, "Cita reprogramada")
+
             updated_cita = await db.citas.find_one({"_id": ObjectId(cita_id)})
 
             # Obtener información del paciente
@@ -332,12 +389,16 @@ async def delete_cita(cita_id: str):
             {"_id": ObjectId(cita_id)},
             {"$set": {"estado": "cancelada", "fecha_actualizacion": datetime.now()}},
         )
+        await estadisticas_service.registrar_cambio_cita(existing_appointment)
+        event_bus.publicar_local("citas", "update", {**existing_appointment, "estado": "cancelada"})
 
         if result.modified_count == 1:
+            await recordatorios_service.cancelar(existing_appointment, "Cita cancelada")
+
             # Actualizar estado del estudio si existe estudio_id
             if existing_appointment.get("estudio_id"):
                 try:
-                    await db.estudios.update_one(
+                    estudio = await db.estudios.find_one_and_update(
                         {"_id": ObjectId(existing_appointment["estudio_id"])},
                         {
                             "$set": {
@@ -346,6 +407,9 @@ async def delete_cita(cita_id: str):
                             }
                         },
                     )
+                    await estadisticas_service.registrar_cambio_estudio(estudio)
+                    if estudio:
+                        event_bus.publicar_local("estudios", "update", {**estudio, "estado": "pendiente"})
                 except Exception as e:
                     print(f"Error actualizando estudio: {e}")
 
@@ -384,6 +448,8 @@ async def update_asistencia_cita(cita_id: str, asistio: bool):
         result = await db.citas.update_one(
             {"_id": ObjectId(cita_id)}, {"$set": update_data}
         )
+        await estadisticas_service.registrar_cambio_cita(existing_appointment, update_data)
+        event_bus.publicar_local("citas", "update", {**existing_appointment, **update_data})
 
         if result.modified_count == 1:
             return {"message": "Asistencia actualizada correctamente"}
@@ -12,10 +12,15 @@ import logging
 import shutil
 from datetime import datetime
 import uuid
+from bson import ObjectId
 
 from ..auth import get_current_user, UserRole, User
-from ..database import db
+from ..database import db, buscar_por_id
 from ..models import Estudio, Paciente
+from ..services.informes_snapshot_service import campos_snapshot
+from ..services.worklist_service import prioridad_lista
+from ..services.estadisticas_service import estadisticas_service
+from ..services.event_bus import event_bus
 
 router = APIRouter(prefix="/api/dicom", tags=["dicom"])
 
@@ -29,23 +34,8 @@ os.makedirs(UPLOAD_DIR, exist_ok=True)
 
 
 async def find_estudio_by_id(estudio_id: str):
-    """Helper function to find a study by id or _id"""
-    from bson import ObjectId
-
-    # Try to find by id field
-    estudio = await db.estudios.find_one({"id": estudio_id})
-    if estudio:
-        return estudio
-
-    # Try to find by _id
-    try:
-        estudio = await db.estudios.find_one({"_id": ObjectId(estudio_id)})
-        if estudio:
-            return estudio
-    except:
-        pass
-
-    return None
+    """Helper function to find a study by its canonical _id or legacy id"""
+    return await buscar_por_id("estudios", estudio_id)
 
 
 @router.get("/pacientes-con-estudios")
@@ -68,14 +58,14 @@ async def get_pacientes_con_estudios(current_user: User = Depends(get_current_us
     # Build patient list with study count
     pacientes = []
     for paciente in pacientes_db:
-        # Count studies for this patient (using both id and _id for compatibility)
-        paciente_id = paciente.get("id") or str(paciente.get("_id"))
+        # Count studies for this patient (canonical _id or legacy id not yet migrated)
+        paciente_id = str(paciente.get("_id"))
         estudios_count = len(
             [
                 e
                 for e in estudios
                 if e.get("paciente_id") == paciente_id
-                or e.get("paciente_id") == str(paciente.get("_id"))
+                or (paciente.get("id") and e.get("paciente_id") == paciente.get("id"))
             ]
         )
 
@@ -110,28 +100,23 @@ async def get_estudios_por_paciente(
     """
     Get all studies for a specific patient
     """
-    from bson import ObjectId
-
-    # Verify patient exists (try both id and _id)
-    paciente = await db.pacientes.find_one({"id": paciente_id})
-    if not paciente:
-        # Try with _id
-        try:
-            paciente = await db.pacientes.find_one({"_id": ObjectId(paciente_id)})
-        except:
-            pass
-
+    # Verify patient exists (single lookup on _id or legacy id)
+    paciente = await buscar_por_id("pacientes", paciente_id)
     if not paciente:
         raise HTTPException(status_code=404, detail="Paciente no encontrado")
 
-    # Get ALL studies for this patient (not just pending)
-    estudios = await db.estudios.find({"paciente_id": paciente_id}).to_list(length=None)
+    # Get ALL studies for this patient (not just pending), referenced by the
+    # canonical id or by a legacy id not yet migrated
+    paciente_id = str(paciente["_id"])
+    referencias = [paciente_id] + ([paciente["id"]] if paciente.get("id") else [])
+    estudios = await db.estudios.find(
+        {"paciente_id": {"$in": referencias}}
+    ).to_list(length=None)
 
     # Format studies with patient info
     estudios_formateados = []
     for estudio in estudios:
-        # Usar _id si no existe id
-        estudio_id = estudio.get("id") or str(estudio.get("_id"))
+        estudio_id = str(estudio["_id"])
         estudios_formateados.append(
             {
                 "id": estudio_id,
@@ -212,19 +197,15 @@ async def upload_dicom_files(
             status_code=400, detail="Estudio no tiene paciente asignado"
         )
 
-    # Verify patient exists (try both id and _id)
-    from bson import ObjectId
-
-    paciente = await db.pacientes.find_one({"id": paciente_id})
-    if not paciente:
-        try:
-            paciente = await db.pacientes.find_one({"_id": ObjectId(paciente_id)})
-        except:
-            pass
-
+    # Verify patient exists (single lookup on _id or legacy id)
+    paciente = await buscar_por_id("pacientes", paciente_id)
     if not paciente:
         raise HTTPException(status_code=404, detail="Paciente no encontrado")
 
+    # Reference patient and study by their canonical ids from here on
+    paciente_id = str(paciente["_id"])
+    estudio_id = str(estudio["_id"])
+
     logger.info(
         f"Subiendo archivos DICOM para estudio {estudio_id} del paciente {paciente.get('nombre')} {paciente.get('apellidos', '')}"
     )
@@ -257,7 +238,7 @@ async def upload_dicom_files(
                     "saved_name": filename,
                     "preview_name": png_filename,
                     "size": os.path.getsize(file_path),
-                    "uploaded_at": datetime.utcnow(),
+                    "uploaded_at": datetime.now(),
                     "uploaded_by": current_user.email,
                     "paciente_id": paciente_id,
                 }
@@ -280,93 +261,59 @@ async def upload_dicom_files(
 
     # Update study with DICOM files
     if uploaded_files:
-        from bson import ObjectId
-
-        # Try to update by id or _id
-        try:
-            result = await db.estudios.update_one(
-                {"id": estudio_id},
-                {
-                    "$push": {"archivos_dicom": {"$each": uploaded_files}},
-                    "$set": {
-                        "estado": "completado",
-                        "fecha_actualizacion": datetime.utcnow(),
-                    },
+        await db.estudios.update_one(
+            {"_id": estudio["_id"]},
+            {
+                "$push": {"archivos_dicom": {"$each": uploaded_files}},
+                "$set": {
+                    "estado": "completado",
+                    "fecha_actualizacion": datetime.now(),
                 },
-            )
-            if result.matched_count == 0:
-                # Try with _id
-                await db.estudios.update_one(
-                    {"_id": ObjectId(estudio_id)},
-                    {
-                        "$push": {"archivos_dicom": {"$each": uploaded_files}},
-                        "$set": {
-                            "estado": "completado",
-                            "fecha_actualizacion": datetime.utcnow(),
-                        },
-                    },
-                )
-        except:
-            pass
+            },
+        )
+        await estadisticas_service.registrar_cambio_estudio(estudio)
+        event_bus.publicar_local("estudios", "update", {**estudio, "estado": "completado"})
 
         # Find or create report for this study and automatically attach images
-        informe = await db.informes.find_one({"estudio_id": estudio_id})
+        referencias_estudio = [estudio_id] + ([estudio["id"]] if estudio.get("id") else [])
+        informe = await db.informes.find_one(
+            {"estudio_id": {"$in": referencias_estudio}}, {"_id": 1}
+        )
 
         if informe:
             # Update existing report with new images
-            from bson import ObjectId
-
-            informe_id = informe.get("id") or str(informe.get("_id"))
-            try:
-                result = await db.informes.update_one(
-                    {"id": informe_id},
-                    {
-                        "$push": {"imagenes_dicom": {"$each": imagenes_para_informe}},
-                        "$set": {"fecha_actualizacion": datetime.utcnow()},
-                    },
-                )
-                if result.matched_count == 0:
-                    # Try with _id
-                    await db.informes.update_one(
-                        {"_id": informe["_id"]},
-                        {
-                            "$push": {
-                                "imagenes_dicom": {"$each": imagenes_para_informe}
-                            },
-                            "$set": {"fecha_actualizacion": datetime.utcnow()},
-                        },
-                    )
-            except:
-                pass
-            logger.info(f"Imágenes anexadas automáticamente al informe {informe_id}")
+            await db.informes.update_one(
+                {"_id": informe["_id"]},
+                {
+                    "$push": {"imagenes_dicom": {"$each": imagenes_para_informe}},
+                    "$set": {"fecha_actualizacion": datetime.now()},
+                },
+            )
+            logger.info(f"Imágenes anexadas automáticamente al informe {informe['_id']}")
         else:
             # Create a draft report with the images
-            nuevo_informe_id = str(uuid.uuid4())
+            nuevo_informe_id = ObjectId()
             nuevo_informe = {
-                "id": nuevo_informe_id,
+                "_id": nuevo_informe_id,
                 "estudio_id": estudio_id,
                 "paciente_id": paciente_id,
                 "medico_radiologo": current_user.email
                 if current_user.role == UserRole.RADIOLOGO
                 else "Por asignar",
-                "fecha_informe": datetime.utcnow().isoformat(),
+                "fecha_informe": datetime.now().isoformat(),
                 "hallazgos": "Pendiente de análisis",
                 "impresion_diagnostica": "Pendiente de análisis",
                 "estado": "Borrador",
                 "imagenes_dicom": imagenes_para_informe,
-                "fecha_creacion": datetime.utcnow(),
-                "fecha_actualizacion": datetime.utcnow(),
+                "fecha_creacion": datetime.now(),
+                "fecha_actualizacion": datetime.now(),
                 "firmado": False,
                 "urgente": False,
                 "validado": False,
-                # Patient info
-                "paciente_nombre": paciente.get("nombre"),
-                "paciente_apellidos": paciente.get("apellidos"),
-                "paciente_cedula": paciente.get("identificacion"),
-                # Study info
-                "estudio_tipo": estudio.get("tipo_estudio"),
-                "estudio_fecha": estudio.get("fecha_solicitud"),
             }
+            # Patient and study snapshot used by report listings
+            nuevo_informe.update(campos_snapshot(estudio_id, estudio, paciente))
+            nuevo_informe["lista_prioridad"] = prioridad_lista(nuevo_informe)
             await db.informes.insert_one(nuevo_informe)
             logger.info(
                 f"Informe borrador creado automáticamente con ID {nuevo_informe_id} e imágenes anexadas"
@@ -463,6 +410,9 @@ async def get_dicom_preview(
                 status_code=403, detail="No tiene permiso para acceder a este estudio"
             )
 
+        # Los archivos están en el directorio del _id canónico, aunque la URL use un id heredado
+        estudio_id = str(estudio["_id"])
+
         # Check if file exists
         file_path = os.path.join(UPLOAD_DIR, estudio_id, filename)
         logger.info(f"Buscando archivo en ruta: {file_path}")
@@ -510,8 +460,8 @@ async def download_dicom_file(
     if not estudio:
         raise HTTPException(status_code=404, detail="Estudio no encontrado")
 
-    # Check if file exists
-    file_path = os.path.join(UPLOAD_DIR, estudio_id, filename)
+    # Check if file exists (directory named after the canonical _id)
+    file_path = os.path.join(UPLOAD_DIR, str(estudio["_id"]), filename)
     if not os.path.exists(file_path):
         raise HTTPException(status_code=404, detail="Archivo no encontrado")
 
@@ -524,10 +474,18 @@ async def download_dicom_file(
 
 
 # ENDPOINTS PÚBLICOS PARA IMPRESIÓN (sin autenticación)
+async def directorio_estudio(estudio_id: str) -> str:
+    """Directorio de archivos de un estudio, resolviendo ids heredados al _id canónico"""
+    estudio = await find_estudio_by_id(estudio_id)
+    if not estudio:
+        raise HTTPException(status_code=404, detail="Estudio no encontrado")
+    return os.path.join(UPLOAD_DIR, str(estudio["_id"]))
+
+
 @router.get("/public/preview/{estudio_id}/{filename}")
 async def get_public_dicom_preview(estudio_id: str, filename: str):
     try:
-        file_path = os.path.join(UPLOAD_DIR, estudio_id, filename)
+        file_path = os.path.join(await directorio_estudio(estudio_id), filename)
         if not os.path.exists(file_path):
             raise HTTPException(status_code=404, detail="Archivo no encontrado")
         return FileResponse(file_path, media_type="image/png")
@@ -541,7 +499,7 @@ async def get_public_dicom_preview(estudio_id: str, filename: str):
 @router.get("/public/base64/{estudio_id}/{filename}")
 async def get_public_dicom_base64(estudio_id: str, filename: str):
     try:
-        file_path = os.path.join(UPLOAD_DIR, estudio_id, filename)
+        file_path = os.path.join(await directorio_estudio(estudio_id), filename)
         if not os.path.exists(file_path):
             raise HTTPException(status_code=404, detail="Archivo no encontrado")
         with open(file_path, "rb") as f:
@@ -560,7 +518,7 @@ async def get_public_dicom_base64(estudio_id: str, filename: str):
 async def list_public_pngs(estudio_id: str):
     """Listar archivos PNG disponibles para un estudio (sin auth)."""
     try:
-        study_dir = os.path.join(UPLOAD_DIR, estudio_id)
+        study_dir = await directorio_estudio(estudio_id)
         if not os.path.exists(study_dir):
             raise HTTPException(status_code=404, detail="Directorio de estudio no encontrado")
         png_files = [f for f in os.listdir(study_dir) if f.lower().endswith(".png")]
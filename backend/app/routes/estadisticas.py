@@ -0,0 +1,422 @@
+from fastapi import APIRouter, HTTPException, Query
+from fastapi.responses import StreamingResponse
+from datetime import datetime, timedelta
+from typing import Optional
+from app.services.estadisticas_service import (
+    DIAS_ATENCION,
+    HORA_APERTURA,
+    HORA_CIERRE,
+    BASE_HISTOGRAMA,
+    es_hora_atencion,
+    estadisticas_service,
+    horas_disponibles,
+    percentil,
+    sumar_histogramas,
+    sumar_por_clave,
+    tramos_tiempos,
+)
+from app.services.cache_service import estadisticas_cache
+from app.services.tarifas_service import tarifas_service
+from app.services.export_service import (
+    CONSULTAS_FILAS,
+    FORMATOS,
+    export_service,
+    parquet_disponible,
+)
+
+# Las rutas de estadísticas se registran antes que informes para que
+# /informes/{informe_id} no capture /informes/estadisticas y similares.
+router = APIRouter()
+
+
+def parse_periodo(inicio: str, fin: str):
+    """Convertir el periodo YYYY-MM-DD a [fecha_inicio, fecha_fin)"""
+    try:
+        fecha_inicio = datetime.strptime(inicio, "%Y-%m-%d")
+        fecha_fin = datetime.strptime(fin, "%Y-%m-%d") + timedelta(days=1)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Formato de fecha inválido, use YYYY-MM-DD")
+
+    if fecha_fin <= fecha_inicio:
+        raise HTTPException(status_code=400, detail="La fecha de inicio debe ser anterior a la fecha fin")
+
+    return fecha_inicio, fecha_fin
+
+
+def periodo(fecha_inicio: datetime, fecha_fin: datetime) -> dict:
+    return {
+        "inicio": fecha_inicio.strftime("%Y-%m-%d"),
+        "fin": (fecha_fin - timedelta(days=1)).strftime("%Y-%m-%d"),
+    }
+
+
+@router.get("/informes/estadisticas")
+async def get_estadisticas(inicio: str, fin: str):
+    fecha_inicio, fecha_fin = parse_periodo(inicio, fin)
+    return await estadisticas_cache.obtener(
+        "estadisticas", fecha_inicio, fecha_fin, lambda: calcular_estadisticas(fecha_inicio, fecha_fin)
+    )
+
+
+async def calcular_estadisticas(fecha_inicio: datetime, fecha_fin: datetime):
+    buckets = await estadisticas_service.obtener_buckets(fecha_inicio, fecha_fin)
+
+    estudios_por_estado = [
+        {"estado": clave, "cantidad": valores["cantidad"]}
+        for clave, valores in sumar_por_clave(buckets, "estudios_por_estado").items()
+    ]
+
+    estudios_por_tipo = [
+        {"tipo_estudio": clave, "cantidad": valores["cantidad"]}
+        for clave, valores in sumar_por_clave(buckets, "estudios_por_tipo").items()
+    ]
+    estudios_por_tipo.sort(key=lambda item: item["cantidad"], reverse=True)
+
+    citas_por_estado = [
+        {"estado": clave, "cantidad": valores["cantidad"]}
+        for clave, valores in sumar_por_clave(buckets, "citas_por_estado").items()
+    ]
+
+    # Tasa de asistencia
+    asistencia = sumar_por_clave(buckets, "citas_asistencia")
+    total_citas = sum(valores["cantidad"] for valores in asistencia.values())
+    citas_asistidas = asistencia.get(True, {}).get("cantidad", 0)
+
+    tasa_asistencia = (citas_asistidas / total_citas * 100) if total_citas > 0 else 0
+
+    return {
+        "periodo": periodo(fecha_inicio, fecha_fin),
+        "estudios": {
+            "por_estado": estudios_por_estado,
+            "por_tipo": estudios_por_tipo,
+            "total": sum(item["cantidad"] for item in estudios_por_estado),
+        },
+        "citas": {
+            "por_estado": citas_por_estado,
+            "total": total_citas,
+            "asistencia": {
+                "asistidas": citas_asistidas,
+                "no_asistidas": total_citas - citas_asistidas,
+                "tasa": round(tasa_asistencia, 2),
+            },
+        },
+    }
+
+
+@router.get("/informes/rendimiento")
+async def get_informe_rendimiento(inicio: str, fin: str):
+    fecha_inicio, fecha_fin = parse_periodo(inicio, fin)
+    return await estadisticas_cache.obtener(
+        "rendimiento", fecha_inicio, fecha_fin, lambda: calcular_rendimiento(fecha_inicio, fecha_fin)
+    )
+
+
+async def calcular_rendimiento(fecha_inicio: datetime, fecha_fin: datetime):
+    buckets = await estadisticas_service.obtener_buckets(fecha_inicio, fecha_fin)
+
+    # Tiempos de solicitud a realización por estudio, con percentiles
+    tiempos_estudio = []
+    completados = sumar_por_clave(buckets, "completados_por_tipo", ("cantidad", "horas"))
+    histogramas = sumar_histogramas(buckets, "solicitud_realizacion")
+    for tipo_estudio, valores in completados.items():
+        histograma = histogramas.get(tipo_estudio, {}).get("histograma", {})
+        tiempos_estudio.append(
+            {
+                "tipo_estudio": tipo_estudio,
+                "tiempo_promedio_horas": round(valores["horas"] / valores["cantidad"], 2),
+                "total_estudios": valores["cantidad"],
+                **percentiles_horas(histograma),
+            }
+        )
+
+    # Productividad por técnico
+    productividad_tecnico = [
+        {"tecnico": clave, "total_citas": valores["cantidad"]}
+        for clave, valores in sumar_por_clave(buckets, "citas_completadas_por_tecnico").items()
+    ]
+    productividad_tecnico.sort(key=lambda item: item["total_citas"], reverse=True)
+
+    # Utilización de salas y técnicos con la duración real de las citas
+    disponibles = horas_disponibles(fecha_inicio, fecha_fin)
+
+    def utilizacion(campo: str, nombre: str) -> list:
+        resultado = []
+        for clave, valores in sumar_por_clave(buckets, campo, ("cantidad", "minutos")).items():
+            horas_utilizadas = valores["minutos"] / 60
+            resultado.append(
+                {
+                    nombre: clave,
+                    "total_citas": valores["cantidad"],
+                    "horas_utilizadas": round(horas_utilizadas, 2),
+                    "horas_disponibles": disponibles,
+                    "utilizacion": round(horas_utilizadas / disponibles * 100, 2) if disponibles else 0,
+                }
+            )
+        resultado.sort(key=lambda item: item["utilizacion"], reverse=True)
+        return resultado
+
+    utilizacion_salas = utilizacion("ocupacion_por_sala", "sala")
+    utilizacion_tecnicos = utilizacion("ocupacion_por_tecnico", "tecnico")
+
+    return {
+        "periodo": periodo(fecha_inicio, fecha_fin),
+        "tiempos_estudio": tiempos_estudio,
+        "productividad_tecnico": productividad_tecnico,
+        "utilizacion_salas": utilizacion_salas,
+        "utilizacion_tecnicos": utilizacion_tecnicos,
+        "mapa_ocupacion": mapa_ocupacion(buckets),
+        "horario": {
+            "hora_apertura": HORA_APERTURA,
+            "hora_cierre": HORA_CIERRE,
+            "dias_atencion": sorted(DIAS_ATENCION),
+        },
+    }
+
+
+def mapa_ocupacion(buckets: list) -> list:
+    """Mapas de calor por sala: ocupación por día y por día de la semana × hora.
+
+    La ocupación es el porcentaje de los minutos de atención ocupados por citas.
+    """
+    horas_dia = max(0, HORA_CIERRE - HORA_APERTURA)
+    salas = {}
+    for bucket in buckets:
+        dia = bucket["fecha"]
+        for item in bucket.get("ocupacion_por_sala_hora", []):
+            sala = salas.setdefault(item["clave"].get("sala"), {
+                "por_dia": {},
+                "por_hora": [[0] * 24 for _ in range(7)],
+            })
+            if es_hora_atencion(dia, item["clave"]["hora"]):
+                sala["por_dia"][dia] = sala["por_dia"].get(dia, 0) + item["minutos"]
+            sala["por_hora"][dia.weekday()][item["clave"]["hora"]] += item["minutos"]
+
+    # Cuántas veces aparece cada día de la semana en el rango
+    semanas = [0] * 7
+    for bucket in buckets:
+        semanas[bucket["fecha"].weekday()] += 1
+
+    mapas = []
+    for sala, datos in salas.items():
+        por_dia = [
+            {
+                "fecha": dia.strftime("%Y-%m-%d"),
+                "minutos": minutos,
+                "ocupacion": round(minutos / (horas_dia * 60) * 100, 2) if horas_dia else 0,
+            }
+            for dia, minutos in sorted(datos["por_dia"].items())
+        ]
+        por_hora = [
+            [
+                round(minutos / (semanas[dia_semana] * 60) * 100, 2) if semanas[dia_semana] else 0
+                for minutos in horas
+            ]
+            for dia_semana, horas in enumerate(datos["por_hora"])
+        ]
+        mapas.append({"sala": sala, "por_dia": por_dia, "por_dia_semana_hora": por_hora})
+    return mapas
+
+
+@router.get("/informes/financiero")
+async def get_informe_financiero(inicio: str, fin: str):
+    fecha_inicio, fecha_fin = parse_periodo(inicio, fin)
+    # La versión del catálogo de tarifas forma parte de la clave de caché
+    await tarifas_service.catalogo()
+    return await estadisticas_cache.obtener(
+        f"financiero@{tarifas_service.version}",
+        fecha_inicio,
+        fecha_fin,
+        lambda: calcular_financiero(fecha_inicio, fecha_fin),
+    )
+
+
+async def calcular_financiero(fecha_inicio: datetime, fecha_fin: datetime):
+    buckets = await estadisticas_service.obtener_buckets(fecha_inicio, fecha_fin)
+
+    ingresos = []
+    total_ingresos = 0
+
+    completados = sumar_por_clave(
+        buckets, "completados_por_tipo", ("cantidad", "ingreso", "sin_tarifa")
+    )
+    for tipo_estudio, valores in completados.items():
+        total_ingresos += valores["ingreso"]
+        con_tarifa = valores["cantidad"] - valores["sin_tarifa"]
+        ingresos.append(
+            {
+                "tipo_estudio": tipo_estudio,
+                "cantidad": valores["cantidad"],
+                # Promedio del periodo: el precio puede cambiar dentro del rango
+                "precio_unitario": valores["ingreso"] // con_tarifa if con_tarifa else 0,
+                "ingreso_total": valores["ingreso"],
+                "sin_tarifa": valores["sin_tarifa"],
+            }
+        )
+
+    # Ingresos por mes
+    por_mes = {}
+    for bucket in buckets:
+        mes = (bucket["fecha"].year, bucket["fecha"].month)
+        por_mes.setdefault(mes, []).append(bucket)
+
+    ingresos_mensuales = []
+    for (year, month), buckets_mes in sorted(por_mes.items()):
+        mensual = sumar_por_clave(buckets_mes, "completados_por_tipo", ("cantidad", "ingreso"))
+        for tipo_estudio, valores in mensual.items():
+            ingresos_mensuales.append(
+                {
+                    "año": year,
+                    "mes": month,
+                    "tipo_estudio": tipo_estudio,
+                    "cantidad": valores["cantidad"],
+                    "ingreso": valores["ingreso"],
+                }
+            )
+
+    return {
+        "periodo": periodo(fecha_inicio, fecha_fin),
+        "ingresos_por_estudio": ingresos,
+        "ingresos_mensuales": ingresos_mensuales,
+        "total_ingresos": total_ingresos,
+        "estudios_sin_tarifa": sum(item["sin_tarifa"] for item in ingresos),
+    }
+
+
+PERCENTILES = (50, 90, 99)
+
+
+def _horas(minutos):
+    return round(minutos / 60, 2) if minutos is not None else None
+
+
+def percentiles_horas(histograma: dict) -> dict:
+    return {f"p{p}_horas": _horas(percentil(histograma, p)) for p in PERCENTILES}
+
+
+def resumen_tiempos(valores: dict) -> dict:
+    cantidad = valores["cantidad"]
+    return {
+        "cantidad": cantidad,
+        "promedio_horas": _horas(valores["minutos"] / cantidad) if cantidad else None,
+        **percentiles_horas(valores["histograma"]),
+    }
+
+
+@router.get("/informes/tiempos")
+async def get_tiempos(inicio: str, fin: str, metodo: str = "rollup"):
+    """Percentiles de los tramos solicitud → programación → realización → informe → firma.
+
+    metodo=rollup fusiona los histogramas diarios (error relativo <= 5%);
+    metodo=servidor usa $percentile sobre los datos originales (MongoDB >= 7.0).
+    """
+    if metodo not in ("rollup", "servidor"):
+        raise HTTPException(status_code=400, detail="Método no válido, use rollup o servidor")
+    fecha_inicio, fecha_fin = parse_periodo(inicio, fin)
+
+    if metodo == "servidor" and not await estadisticas_service.soporta_percentile():
+        raise HTTPException(status_code=501, detail="$percentile requiere MongoDB 7.0 o superior")
+
+    calcular = calcular_tiempos if metodo == "rollup" else calcular_tiempos_servidor
+    return await estadisticas_cache.obtener(
+        f"tiempos_{metodo}", fecha_inicio, fecha_fin, lambda: calcular(fecha_inicio, fecha_fin)
+    )
+
+
+async def calcular_tiempos(fecha_inicio: datetime, fecha_fin: datetime):
+    buckets = await estadisticas_service.obtener_buckets(fecha_inicio, fecha_fin)
+
+    etapas = {}
+    for etapa in tramos_tiempos({}):
+        por_tipo = sumar_histogramas(buckets, etapa)
+        total = {"cantidad": 0, "minutos": 0, "histograma": {}}
+        for valores in por_tipo.values():
+            total["cantidad"] += valores["cantidad"]
+            total["minutos"] += valores["minutos"]
+            for indice, cantidad in valores["histograma"].items():
+                total["histograma"][indice] = total["histograma"].get(indice, 0) + cantidad
+
+        etapas[etapa] = {
+            **resumen_tiempos(total),
+            "histograma": [
+                {"hasta_horas": _horas(BASE_HISTOGRAMA ** indice), "cantidad": cantidad}
+                for indice, cantidad in sorted(total["histograma"].items())
+            ],
+            "por_tipo": [
+                {"tipo_estudio": tipo, **resumen_tiempos(valores)} for tipo, valores in por_tipo.items()
+            ],
+        }
+
+    return {"periodo": periodo(fecha_inicio, fecha_fin), "metodo": "rollup", "etapas": etapas}
+
+
+async def calcular_tiempos_servidor(fecha_inicio: datetime, fecha_fin: datetime):
+    resultados = await estadisticas_service.percentiles_servidor(fecha_inicio, fecha_fin, PERCENTILES)
+
+    etapas = {}
+    for etapa, por_tipo in resultados.items():
+        etapas[etapa] = {
+            "por_tipo": [
+                {
+                    "tipo_estudio": tipo,
+                    "cantidad": doc["cantidad"],
+                    "promedio_horas": _horas(doc["minutos"] / doc["cantidad"]),
+                    **{f"p{p}_horas": _horas(valor) for p, valor in zip(PERCENTILES, doc["p"])},
+                }
+                for tipo, doc in por_tipo.items()
+            ],
+        }
+
+    return {"periodo": periodo(fecha_inicio, fecha_fin), "metodo": "servidor", "etapas": etapas}
+
+
+@router.get("/informes/cache/metricas")
+async def get_metricas_cache():
+    """Métricas de la caché de estadísticas (aciertos, fallos, invalidaciones)"""
+    return estadisticas_cache.resumen()
+
+
+@router.get("/informes/export/{tipo}")
+async def exportar_informe(
+    tipo: str,
+    inicio: str,
+    fin: str,
+    formato: str = "json",
+    modo: str = "agregado",
+    batch_size: Optional[int] = Query(None, ge=1, le=50000),
+):
+    """Exportar un informe agregado o sus filas originales (modo=filas) en JSON, CSV o Parquet"""
+    if tipo not in CONSULTAS_FILAS:
+        raise HTTPException(status_code=400, detail="Tipo de informe no válido")
+    if formato not in FORMATOS:
+        raise HTTPException(status_code=400, detail="Formato de exportación no válido")
+    if modo not in ("agregado", "filas"):
+        raise HTTPException(status_code=400, detail="Modo de exportación no válido")
+    if formato == "parquet" and not parquet_disponible():
+        raise HTTPException(
+            status_code=501, detail="Exportación Parquet no disponible: instale pyarrow"
+        )
+
+    fecha_inicio, fecha_fin = parse_periodo(inicio, fin)
+
+    if modo == "filas":
+        contenido = export_service.exportar_filas(
+            tipo, formato, fecha_inicio, fecha_fin, batch_size
+        )
+    else:
+        calcular = {
+            "estadisticas": get_estadisticas,
+            "rendimiento": get_informe_rendimiento,
+            "financiero": get_informe_financiero,
+        }[tipo]
+        data = await calcular(inicio, fin)
+        if formato == "json":
+            return data
+        contenido = export_service.exportar_agregado(data, formato)
+
+    rango = periodo(fecha_inicio, fecha_fin)
+    nombre = f"{tipo}_{modo}_{rango['inicio']}_{rango['fin']}.{formato}"
+    return StreamingResponse(
+        contenido,
+        media_type=FORMATOS[formato],
+        headers={"Content-Disposition": f'attachment; filename="{nombre}"'},
+    )
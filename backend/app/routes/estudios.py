@@ -1,15 +1,21 @@
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, HTTPException, Response
 from app.schemas import EstudioCreate, Estudio, EstudioUpdate
 from app.database import get_database
+from app.services.search_service import HEADER_FILTRO_TRUNCADO, SearchService
+from app.services.estadisticas_service import estadisticas_service
+from app.services.event_bus import event_bus
 from bson import ObjectId
 from datetime import datetime, timedelta
 from typing import List
+import re
 
 router = APIRouter()
+search_service = SearchService()
 
 
 @router.get("/estudios", response_model=List[Estudio])
 async def get_estudios(
+    response: Response,
     skip: int = 0,
     limit: int = 100,
     estado: str = None,
@@ -31,7 +37,7 @@ async def get_estudios(
 
     # Filtro por tipo de estudio
     if tipo_estudio and tipo_estudio != "Todos":
-        query["tipo_estudio"] = {"$regex": tipo_estudio, "$options": "i"}
+        query["tipo_estudio"] = {"$regex": re.escape(tipo_estudio), "$options": "i"}
 
     # Filtro por paciente específico
     if paciente_id:
@@ -39,7 +45,7 @@ async def get_estudios(
 
     # Filtro por médico solicitante
     if medico_solicitante and medico_solicitante != "Todos":
-        query["medico_solicitante"] = {"$regex": medico_solicitante, "$options": "i"}
+        query["medico_solicitante"] = {"$regex": re.escape(medico_solicitante), "$options": "i"}
 
     # Filtro por prioridad
     if prioridad and prioridad != "Todos":
@@ -72,15 +78,11 @@ async def get_estudios(
 
     # Aplicar filtro por nombre de paciente en la consulta de MongoDB si se especifica
     if paciente_nombre:
-        # Buscar pacientes que coincidan con el nombre
-        nombre_regex = {"$regex": paciente_nombre, "$options": "i"}
-        pacientes_coincidentes = db.pacientes.find(
-            {"$or": [{"nombre": nombre_regex}, {"apellidos": nombre_regex}]}
-        )
-
-        pacientes_ids = []
-        async for p in pacientes_coincidentes:
-            pacientes_ids.append(str(p["_id"]))
+        # Buscar pacientes por prefijos normalizados usando el índice de tokens
+        pacientes_ids, truncado = await search_service.ids_pacientes_por_nombre(paciente_nombre)
+        if truncado:
+            # Demasiados pacientes coinciden: el resultado solo cubre los primeros
+            response.headers[HEADER_FILTRO_TRUNCADO] = "true"
 
         if pacientes_ids:
             query["paciente_id"] = {"$in": pacientes_ids}
@@ -201,29 +203,6 @@ async def get_estudio(estudio_id: str):
         raise HTTPException(status_code=500, detail="Error interno del servidor")
 
 
-@router.get("/pacientes/{paciente_id}/estudios", response_model=List[Estudio])
-async def get_estudios_paciente(paciente_id: str):
-    """Obtener todos los estudios de un paciente específico"""
-    try:
-        db = get_database()
-
-        # Verificar que el paciente existe
-        paciente = await db.pacientes.find_one({"_id": ObjectId(paciente_id)})
-        if not paciente:
-            raise HTTPException(status_code=404, detail="Paciente no encontrado")
-
-        estudios = []
-        async for estudio in db.estudios.find({"paciente_id": paciente_id}).sort(
-            "fecha_solicitud", -1
-        ):
-            estudio["id"] = str(estudio["_id"])
-            estudios.append(Estudio(**estudio))
-
-        return estudios
-    except ValueError:
-        raise HTTPException(status_code=400, detail="ID de paciente inválido")
-
-
 @router.post("/estudios", response_model=Estudio)
 async def create_estudio(estudio: EstudioCreate):
     """Crear un nuevo estudio"""
@@ -242,6 +221,8 @@ async def create_estudio(estudio: EstudioCreate):
         estudio_dict["archivos_dicom"] = []
 
         result = await db.estudios.insert_one(estudio_dict)
+        await estadisticas_service.registrar_cambio_estudio(estudio_dict)
+        event_bus.publicar_local("estudios", "insert", estudio_dict)
         new_estudio = await db.estudios.find_one({"_id": result.inserted_id})
 
         new_estudio["id"] = str(new_estudio["_id"])
@@ -281,6 +262,8 @@ async def update_estudio(estudio_id: str, estudio: EstudioUpdate):
         result = await db.estudios.update_one(
             {"_id": ObjectId(estudio_id)}, {"$set": update_data}
         )
+        await estadisticas_service.registrar_cambio_estudio(existing_study, update_data)
+        event_bus.publicar_local("estudios", "update", {**existing_study, **update_data})
 
         if result.modified_count == 1:
             updated_estudio = await db.estudios.find_one({"_id": ObjectId(estudio_id)})
@@ -329,6 +312,8 @@ async def update_estado_estudio(estudio_id: str, estado: str):
         result = await db.estudios.update_one(
             {"_id": ObjectId(estudio_id)}, {"$set": update_data}
         )
+        await estadisticas_service.registrar_cambio_estudio(existing_study, update_data)
+        event_bus.publicar_local("estudios", "update", {**existing_study, **update_data})
 
         if result.modified_count == 1:
             updated_estudio = await db.estudios.find_one({"_id": ObjectId(estudio_id)})
@@ -399,6 +384,8 @@ async def delete_estudio(estudio_id: str):
             {"_id": ObjectId(estudio_id)},
             {"$set": {"estado": "cancelado", "fecha_actualizacion": datetime.now()}},
         )
+        await estadisticas_service.registrar_cambio_estudio(existing_study)
+        event_bus.publicar_local("estudios", "update", {**existing_study, "estado": "cancelado"})
 
         if result.modified_count == 1:
             return {"message": "Estudio marcado como cancelado correctamente"}
@@ -1,12 +1,18 @@
-from fastapi import APIRouter, HTTPException
-from datetime import datetime, timedelta
+from fastapi import APIRouter, Depends, HTTPException
+from app.auth import get_optional_user, User
+from datetime import datetime
 from app.schemas import InformeCreate, Informe, InformeUpdate
-from app.database import get_database
+from app.database import get_database, buscar_por_id
+from app.services.informes_snapshot_service import InformesSnapshotService
+from app.services.estadisticas_service import estadisticas_service
+from app.services.event_bus import event_bus
+from app.services.worklist_service import prioridad_lista, worklist_service
 from bson import ObjectId
-from typing import List
+from typing import List, Optional
 import json
 
 router = APIRouter()
+snapshot_service = InformesSnapshotService()
 
 
 @router.get("/informes", response_model=List[Informe])
@@ -14,65 +20,20 @@ async def get_informes(skip: int = 0, limit: int = 100):
     """Obtener lista de informes con información del paciente"""
     db = get_database()
 
-    cursor = db.informes.find().skip(skip).limit(limit).sort("fecha_creacion", -1)
-    informes = []
+    # Los datos de paciente y estudio están copiados en cada informe
+    cursor = db.informes.find().sort("fecha_creacion", -1).skip(skip).limit(limit)
+    informes = await cursor.to_list(length=limit)
 
-    async for informe in cursor:
-        # Obtener información del estudio y paciente
-        try:
-            estudio = await db.estudios.find_one(
-                {"_id": ObjectId(informe["estudio_id"])}
-            )
-            if estudio:
-                # Obtener información del paciente
-                try:
-                    paciente = await db.pacientes.find_one(
-                        {"_id": ObjectId(estudio["paciente_id"])}
-                    )
-                    if paciente:
-                        informe["paciente_nombre"] = paciente["nombre"]
-                        informe["paciente_apellidos"] = paciente.get("apellidos")
-                        informe["paciente_cedula"] = paciente.get("identificacion")
-                        informe["paciente_id"] = str(estudio["paciente_id"])
-                    else:
-                        informe["paciente_nombre"] = "Paciente no encontrado"
-                        informe["paciente_apellidos"] = None
-                        informe["paciente_cedula"] = None
-                        informe["paciente_id"] = str(estudio["paciente_id"])
-                except Exception as e:
-                    print(f"Error al cargar paciente: {e}")
-                    informe["paciente_nombre"] = "Error al cargar paciente"
-                    informe["paciente_apellidos"] = None
-                    informe["paciente_cedula"] = None
-                    informe["paciente_id"] = None
-
-                # Información del estudio
-                informe["estudio_tipo"] = estudio.get("tipo_estudio", "No especificado")
-                informe["estudio_modalidad"] = estudio.get(
-                    "modalidad", "No especificada"
-                )
-                informe["estudio_fecha"] = estudio.get("fecha_realizacion")
-            else:
-                informe["paciente_nombre"] = "Estudio no encontrado"
-                informe["paciente_apellidos"] = None
-                informe["paciente_cedula"] = None
-                informe["paciente_id"] = None
-                informe["estudio_tipo"] = "No especificado"
-                informe["estudio_modalidad"] = "No especificada"
-                informe["estudio_fecha"] = None
-        except Exception as e:
-            print(f"Error al cargar estudio {informe.get('estudio_id')}: {e}")
-            informe["paciente_nombre"] = "Error al cargar datos"
-            informe["paciente_apellidos"] = None
-            informe["paciente_cedula"] = None
-            informe["paciente_id"] = None
-            informe["estudio_tipo"] = "Error"
-            informe["estudio_modalidad"] = "Error"
-            informe["estudio_fecha"] = None
+    # Informes anteriores al snapshot: calcularlo en lote y guardarlo
+    sin_snapshot = [i for i in informes if "snapshot_estudio_id" not in i]
+    if sin_snapshot:
+        snapshots = await snapshot_service.refrescar_informes(sin_snapshot)
+        for informe in sin_snapshot:
+            informe.update(snapshots[informe["_id"]])
 
+    for informe in informes:
         informe["id"] = str(informe["_id"])
         del informe["_id"]
-        informes.append(informe)
 
     return informes
 
@@ -86,9 +47,15 @@ async def create_informe(informe: InformeCreate):
     informe_dict = informe.dict()
     informe_dict["fecha_creacion"] = datetime.now()
     informe_dict["fecha_actualizacion"] = datetime.now()
+    snapshots = await snapshot_service.snapshots_para_estudios([informe.estudio_id])
+    informe_dict.update(snapshots[informe.estudio_id])
+    informe_dict["firmado"] = False
+    informe_dict["lista_prioridad"] = prioridad_lista(informe_dict)
 
     # Insertar en la base de datos
     result = await db.informes.insert_one(informe_dict)
+    await estadisticas_service.registrar_cambio_informe(informe_dict)
+    event_bus.publicar_local("informes", "insert", informe_dict)
 
     # Obtener el informe creado
     nuevo_informe = await db.informes.find_one({"_id": result.inserted_id})
@@ -117,8 +84,10 @@ async def get_informe(informe_id: str):
 
 
 @router.put("/informes/{informe_id}", response_model=Informe)
-async def update_informe(informe_id: str, informe: InformeUpdate):
-    """Actualizar un informe"""
+async def update_informe(
+    informe_id: str, informe: InformeUpdate, current_user: Optional[User] = Depends(get_optional_user)
+):
+    """Actualizar un informe; si otro radiólogo lo tiene asignado en la lista de trabajo, 409"""
     try:
         db = get_database()
 
@@ -131,10 +100,37 @@ async def update_informe(informe_id: str, informe: InformeUpdate):
         update_data = informe.dict(exclude_unset=True)
         update_data["fecha_actualizacion"] = datetime.now()
 
-        # Actualizar en la base de datos
+        # Validar el informe equivale a firmarlo; la primera validación fija la fecha de firma
+        if update_data.get("validado") and not existing_informe.get("firmado"):
+            update_data["firmado"] = True
+            update_data["fecha_firma"] = datetime.now()
+
+        # Si cambia el estudio, actualizar también el snapshot de paciente y estudio
+        nuevo_estudio_id = update_data.get("estudio_id")
+        if nuevo_estudio_id and nuevo_estudio_id != existing_informe.get("snapshot_estudio_id"):
+            snapshots = await snapshot_service.snapshots_para_estudios([nuevo_estudio_id])
+            update_data.update(snapshots[nuevo_estudio_id])
+
+        # Un informe firmado sale de la lista de trabajo
+        if update_data.get("firmado"):
+            update_data["asignado_a"] = None
+            update_data["asignado_hasta"] = None
+        update_data["lista_prioridad"] = prioridad_lista({**existing_informe, **update_data})
+
+        # Actualizar en la base de datos solo si nadie más tiene el lease vigente
+        usuario = current_user.email if current_user else None
         result = await db.informes.update_one(
-            {"_id": ObjectId(informe_id)}, {"$set": update_data}
+            {"_id": ObjectId(informe_id), **worklist_service.filtro_editable(usuario, datetime.now())},
+            {"$set": update_data},
         )
+        if result.matched_count == 0:
+            asignado = await db.informes.find_one({"_id": ObjectId(informe_id)}, {"asignado_a": 1})
+            raise HTTPException(
+                status_code=409,
+                detail=f"El informe está asignado a {(asignado or {}).get('asignado_a')} en la lista de trabajo",
+            )
+        await estadisticas_service.registrar_cambio_informe(existing_informe, update_data)
+        event_bus.publicar_local("informes", "update", {**existing_informe, **update_data})
 
         if result.modified_count == 1:
             # Obtener el informe actualizado
@@ -167,6 +163,8 @@ async def delete_informe(informe_id: str):
         result = await db.informes.delete_one({"_id": ObjectId(informe_id)})
 
         if result.deleted_count == 1:
+            await estadisticas_service.registrar_cambio_informe(existing_informe)
+            event_bus.publicar_local("informes", "delete", existing_informe)
             return {"message": "Informe eliminado correctamente"}
         else:
             raise HTTPException(status_code=500, detail="Error al eliminar el informe")
@@ -175,287 +173,12 @@ async def delete_informe(informe_id: str):
         raise HTTPException(status_code=400, detail="ID de informe inválido")
 
 
-@router.get("/informes/estadisticas")
-async def get_estadisticas(inicio: str, fin: str):
-    db = get_database()
-
-    fecha_inicio = datetime.strptime(inicio, "%Y-%m-%d")
-    fecha_fin = datetime.strptime(fin, "%Y-%m-%d") + timedelta(days=1)
-
-    # Estadísticas de estudios
-    pipeline_estudios = [
-        {"$match": {"fecha_solicitud": {"$gte": fecha_inicio, "$lt": fecha_fin}}},
-        {"$group": {"_id": "$estado", "count": {"$sum": 1}}},
-    ]
-
-    estudios_por_estado = []
-    async for doc in db.estudios.aggregate(pipeline_estudios):
-        estudios_por_estado.append({"estado": doc["_id"], "cantidad": doc["count"]})
-
-    # Estudios por tipo
-    pipeline_tipos = [
-        {"$match": {"fecha_solicitud": {"$gte": fecha_inicio, "$lt": fecha_fin}}},
-        {"$group": {"_id": "$tipo_estudio", "count": {"$sum": 1}}},
-        {"$sort": {"count": -1}},
-    ]
-
-    estudios_por_tipo = []
-    async for doc in db.estudios.aggregate(pipeline_tipos):
-        estudios_por_tipo.append({"tipo_estudio": doc["_id"], "cantidad": doc["count"]})
-
-    # Citas por estado
-    pipeline_citas = [
-        {"$match": {"fecha_creacion": {"$gte": fecha_inicio, "$lt": fecha_fin}}},
-        {"$group": {"_id": "$estado", "count": {"$sum": 1}}},
-    ]
-
-    citas_por_estado = []
-    async for doc in db.citas.aggregate(pipeline_citas):
-        citas_por_estado.append({"estado": doc["_id"], "cantidad": doc["count"]})
-
-    # Tasa de asistencia
-    pipeline_asistencia = [
-        {"$match": {"fecha_creacion": {"$gte": fecha_inicio, "$lt": fecha_fin}}},
-        {"$group": {"_id": "$asistio", "count": {"$sum": 1}}},
-    ]
-
-    asistencia_data = []
-    total_citas = 0
-    citas_asistidas = 0
-
-    async for doc in db.citas.aggregate(pipeline_asistencia):
-        total_citas += doc["count"]
-        if doc["_id"] == True:
-            citas_asistidas = doc["count"]
-
-    tasa_asistencia = (citas_asistidas / total_citas * 100) if total_citas > 0 else 0
-
-    return {
-        "periodo": {"inicio": inicio, "fin": fin},
-        "estudios": {
-            "por_estado": estudios_por_estado,
-            "por_tipo": estudios_por_tipo,
-            "total": sum(item["cantidad"] for item in estudios_por_estado),
-        },
-        "citas": {
-            "por_estado": citas_por_estado,
-            "total": total_citas,
-            "asistencia": {
-                "asistidas": citas_asistidas,
-                "no_asistidas": total_citas - citas_asistidas,
-                "tasa": round(tasa_asistencia, 2),
-            },
-        },
-    }
-
-
-@router.get("/informes/rendimiento")
-async def get_informe_rendimiento(inicio: str, fin: str):
-    db = get_database()
-
-    fecha_inicio = datetime.strptime(inicio, "%Y-%m-%d")
-    fecha_fin = datetime.strptime(fin, "%Y-%m-%d") + timedelta(days=1)
-
-    # Tiempos promedio por estudio
-    pipeline_tiempos = [
-        {
-            "$match": {
-                "estado": "completado",
-                "fecha_solicitud": {"$gte": fecha_inicio},
-                "fecha_realizacion": {"$lt": fecha_fin},
-            }
-        },
-        {
-            "$project": {
-                "tipo_estudio": 1,
-                "tiempo_procesamiento": {
-                    "$divide": [
-                        {"$subtract": ["$fecha_realizacion", "$fecha_solicitud"]},
-                        3600000,  # Convertir a horas
-                    ]
-                },
-            }
-        },
-        {
-            "$group": {
-                "_id": "$tipo_estudio",
-                "tiempo_promedio": {"$avg": "$tiempo_procesamiento"},
-                "total_estudios": {"$sum": 1},
-            }
-        },
-    ]
-
-    tiempos_estudio = []
-    async for doc in db.estudios.aggregate(pipeline_tiempos):
-        tiempos_estudio.append(
-            {
-                "tipo_estudio": doc["_id"],
-                "tiempo_promedio_horas": round(doc["tiempo_promedio"], 2),
-                "total_estudios": doc["total_estudios"],
-            }
-        )
-
-    # Productividad por técnico
-    pipeline_tecnico = [
-        {
-            "$match": {
-                "estado": "completada",
-                "fecha_creacion": {"$gte": fecha_inicio, "$lt": fecha_fin},
-            }
-        },
-        {"$group": {"_id": "$tecnico_asignado", "total_citas": {"$sum": 1}}},
-        {"$sort": {"total_citas": -1}},
-    ]
-
-    productividad_tecnico = []
-    async for doc in db.citas.aggregate(pipeline_tecnico):
-        productividad_tecnico.append(
-            {"tecnico": doc["_id"], "total_citas": doc["total_citas"]}
-        )
-
-    # Utilización de salas
-    pipeline_salas = [
-        {"$match": {"fecha_creacion": {"$gte": fecha_inicio, "$lt": fecha_fin}}},
-        {
-            "$group": {
-                "_id": "$sala",
-                "total_citas": {"$sum": 1},
-                "horas_utilizadas": {
-                    "$sum": 0.5  # Cada cita dura 30 minutos aprox
-                },
-            }
-        },
-    ]
-
-    utilizacion_salas = []
-    async for doc in db.citas.aggregate(pipeline_salas):
-        # 10 horas diarias * días laborales (asumiendo 22 días/mes)
-        horas_disponibles = 10 * 22
-        utilizacion = (doc["horas_utilizadas"] / horas_disponibles) * 100
-
-        utilizacion_salas.append(
-            {
-                "sala": doc["_id"],
-                "total_citas": doc["total_citas"],
-                "horas_utilizadas": doc["horas_utilizadas"],
-                "utilizacion": round(utilizacion, 2),
-            }
-        )
-
-    return {
-        "periodo": {"inicio": inicio, "fin": fin},
-        "tiempos_estudio": tiempos_estudio,
-        "productividad_tecnico": productividad_tecnico,
-        "utilizacion_salas": utilizacion_salas,
-    }
-
-
-@router.get("/informes/financiero")
-async def get_informe_financiero(inicio: str, fin: str):
-    db = get_database()
-
-    fecha_inicio = datetime.strptime(inicio, "%Y-%m-%d")
-    fecha_fin = datetime.strptime(fin, "%Y-%m-%d") + timedelta(days=1)
-
-    # Precios por tipo de estudio (esto debería venir de una base de datos)
-    precios_estudios = {
-        "Radiografía de Tórax": 150000,
-        "Resonancia Magnética": 800000,
-        "Tomografía Computarizada": 600000,
-        "Ultrasonido Abdominal": 300000,
-        "Mamografía": 250000,
-        "Densitometría Ósea": 350000,
-    }
-
-    pipeline_ingresos = [
-        {
-            "$match": {
-                "estado": "completado",
-                "fecha_realizacion": {"$gte": fecha_inicio, "$lt": fecha_fin},
-            }
-        },
-        {"$group": {"_id": "$tipo_estudio", "cantidad": {"$sum": 1}}},
-    ]
-
-    ingresos = []
-    total_ingresos = 0
-
-    async for doc in db.estudios.aggregate(pipeline_ingresos):
-        precio = precios_estudios.get(doc["_id"], 0)
-        ingreso = precio * doc["cantidad"]
-        total_ingresos += ingreso
-
-        ingresos.append(
-            {
-                "tipo_estudio": doc["_id"],
-                "cantidad": doc["cantidad"],
-                "precio_unitario": precio,
-                "ingreso_total": ingreso,
-            }
-        )
-
-    # Ingresos por mes
-    pipeline_mensual = [
-        {
-            "$match": {
-                "estado": "completado",
-                "fecha_realizacion": {"$gte": fecha_inicio, "$lt": fecha_fin},
-            }
-        },
-        {
-            "$project": {
-                "year": {"$year": "$fecha_realizacion"},
-                "month": {"$month": "$fecha_realizacion"},
-                "tipo_estudio": 1,
-            }
-        },
-        {
-            "$group": {
-                "_id": {
-                    "year": "$year",
-                    "month": "$month",
-                    "tipo_estudio": "$tipo_estudio",
-                },
-                "cantidad": {"$sum": 1},
-            }
-        },
-        {"$sort": {"_id.year": 1, "_id.month": 1}},
-    ]
-
-    ingresos_mensuales = []
-    async for doc in db.estudios.aggregate(pipeline_mensual):
-        precio = precios_estudios.get(doc["_id"]["tipo_estudio"], 0)
-        ingreso = precio * doc["cantidad"]
-
-        ingresos_mensuales.append(
-            {
-                "año": doc["_id"]["year"],
-                "mes": doc["_id"]["month"],
-                "tipo_estudio": doc["_id"]["tipo_estudio"],
-                "cantidad": doc["cantidad"],
-                "ingreso": ingreso,
-            }
-        )
-
-    return {
-        "periodo": {"inicio": inicio, "fin": fin},
-        "ingresos_por_estudio": ingresos,
-        "ingresos_mensuales": ingresos_mensuales,
-        "total_ingresos": total_ingresos,
-    }
-
-
 @router.get("/informes/{informe_id}/debug/imagenes")
 async def debug_imagenes_informe(informe_id: str):
     """Debug endpoint para verificar el estado de las imágenes DICOM en un informe"""
     try:
-        db = get_database()
-
-        # Buscar informe por ID
-        informe = await db.informes.find_one({"_id": ObjectId(informe_id)})
-        if not informe:
-            # Intentar buscar por campo id
-            informe = await db.informes.find_one({"id": informe_id})
+        # Buscar informe por _id o por identificador heredado en una sola consulta
+        informe = await buscar_por_id("informes", informe_id)
 
         if not informe:
             raise HTTPException(status_code=404, detail="Informe no encontrado")
@@ -529,10 +252,8 @@ async def sync_imagenes_informe(informe_id: str):
     try:
         db = get_database()
 
-        # Buscar informe por _id o id
-        informe = await db.informes.find_one({"_id": ObjectId(informe_id)})
-        if not informe:
-            informe = await db.informes.find_one({"id": informe_id})
+        # Buscar informe por _id o por identificador heredado en una sola consulta
+        informe = await buscar_por_id("informes", informe_id)
         if not informe:
             raise HTTPException(status_code=404, detail="Informe no encontrado")
 
@@ -540,13 +261,7 @@ async def sync_imagenes_informe(informe_id: str):
         if not estudio_id:
             raise HTTPException(status_code=400, detail="Informe sin estudio asociado")
 
-        # Obtener estudio por id o _id
-        estudio = await db.estudios.find_one({"id": estudio_id})
-        if not estudio:
-            try:
-                estudio = await db.estudios.find_one({"_id": ObjectId(estudio_id)})
-            except Exception:
-                estudio = None
+        estudio = await buscar_por_id("estudios", estudio_id)
         if not estudio:
             raise HTTPException(status_code=404, detail="Estudio no encontrado")
 
@@ -575,9 +290,8 @@ async def sync_imagenes_informe(informe_id: str):
         if not imagenes:
             return {"message": "No se generaron imágenes a anexar", "sincronizadas": 0}
 
-        filtro = {"_id": informe.get("_id")} if informe.get("_id") else {"id": informe.get("id")}
         await db.informes.update_one(
-            filtro,
+            {"_id": informe["_id"]},
             {"$set": {"imagenes_dicom": imagenes, "fecha_actualizacion": datetime.now()}},
         )
 
@@ -586,25 +300,3 @@ async def sync_imagenes_informe(informe_id: str):
         raise HTTPException(status_code=400, detail="ID de informe inválido")
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error interno: {str(e)}")
-
-
-@router.get("/informes/export/{tipo}")
-async def exportar_informe(tipo: str, inicio: str, fin: str, formato: str = "json"):
-    if tipo == "estadisticas":
-        data = await get_estadisticas(inicio, fin)
-    elif tipo == "rendimiento":
-        data = await get_informe_rendimiento(inicio, fin)
-    elif tipo == "financiero":
-        data = await get_informe_financiero(inicio, fin)
-    else:
-        raise HTTPException(status_code=400, detail="Tipo de informe no válido")
-
-    if formato == "json":
-        return data
-    elif formato == "csv":
-        # Implementar conversión a CSV
-        raise HTTPException(
-            status_code=501, detail="Exportación CSV no implementada aún"
-        )
-    else:
-        raise HTTPException(status_code=400, detail="Formato de exportación no válido")
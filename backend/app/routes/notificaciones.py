@@ -1,19 +1,22 @@
-from fastapi import APIRouter, HTTPException, BackgroundTasks
+from fastapi import APIRouter, HTTPException
+from fastapi.responses import PlainTextResponse
 from app.schemas import NotificacionCreate, Notificacion
 from app.database import get_database
-from app.services.email_service import EmailService
-from app.services.sms_service import SMSService
+from app.services.outbox_service import dispatcher, encolar, nueva_notificacion
+from app.services.agrupador_service import ESTADOS_NOTIFICADOS, agrupador_estados
+from app.services.metricas_notificaciones import metricas_notificaciones
 from bson import ObjectId
 from datetime import datetime
+from pymongo.errors import BulkWriteError
 from typing import List
 
 router = APIRouter()
-email_service = EmailService()
-sms_service = SMSService()
+
+MAX_NOTIFICACIONES_BULK = 1000
 
 @router.post("/notificaciones", response_model=Notificacion)
-async def create_notificacion(notificacion: NotificacionCreate, background_tasks: BackgroundTasks):
-    """Crear una nueva notificación"""
+async def create_notificacion(notificacion: NotificacionCreate):
+    """Crear una nueva notificación; el dispatcher la envía"""
     try:
         db = get_database()
         
@@ -28,16 +31,9 @@ async def create_notificacion(notificacion: NotificacionCreate, background_tasks
             if not estudio:
                 raise HTTPException(status_code=404, detail="Estudio no encontrado")
         
-        notificacion_dict = notificacion.dict()
-        notificacion_dict["enviada"] = False
-        notificacion_dict["fecha_creacion"] = datetime.now()
-        notificacion_dict["intentos_envio"] = 0
-        
-        result = await db.notificaciones.insert_one(notificacion_dict)
-        new_notificacion = await db.notificaciones.find_one({"_id": result.inserted_id})
-        
-        # Enviar notificación en segundo plano
-        background_tasks.add_task(send_notification, str(new_notificacion["_id"]))
+        # Guardar en el outbox
+        ids = await encolar(nueva_notificacion(**notificacion.dict()))
+        new_notificacion = await db.notificaciones.find_one({"_id": ids[0]})
         
         new_notificacion["id"] = str(new_notificacion["_id"])
         return Notificacion(**new_notificacion)
@@ -45,61 +41,60 @@ async def create_notificacion(notificacion: NotificacionCreate, background_tasks
     except ValueError:
         raise HTTPException(status_code=400, detail="ID de paciente o estudio inválido")
 
-async def send_notification(notificacion_id: str):
-    """Enviar notificación en segundo plano"""
-    try:
-        db = get_database()
-        notificacion = await db.notificaciones.find_one({"_id": ObjectId(notificacion_id)})
-        
-        if not notificacion:
-            return
-        
-        paciente = await db.pacientes.find_one({"_id": ObjectId(notificacion["paciente_id"])})
-        if not paciente:
-            return
-        
-        success = False
-        
+@router.post("/notificaciones/bulk")
+async def create_notificaciones_bulk(notificaciones: List[NotificacionCreate]):
+    """Crear muchas notificaciones en una sola pasada; retorna el resultado de cada una en orden"""
+    if len(notificaciones) > MAX_NOTIFICACIONES_BULK:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Máximo {MAX_NOTIFICACIONES_BULK} notificaciones por solicitud",
+        )
+    db = get_database()
+    
+    # Validar todas las referencias con una consulta $in por colección
+    paciente_ids = {n.paciente_id for n in notificaciones if ObjectId.is_valid(n.paciente_id)}
+    estudio_ids = {n.estudio_id for n in notificaciones if n.estudio_id and ObjectId.is_valid(n.estudio_id)}
+    pacientes = {
+        str(p["_id"])
+        async for p in db.pacientes.find({"_id": {"$in": [ObjectId(i) for i in paciente_ids]}}, {"_id": 1})
+    } if paciente_ids else set()
+    estudios = {
+        str(e["_id"])
+        async for e in db.estudios.find({"_id": {"$in": [ObjectId(i) for i in estudio_ids]}}, {"_id": 1})
+    } if estudio_ids else set()
+    
+    resultados = []
+    validas = []
+    for indice, notificacion in enumerate(notificaciones):
+        if not ObjectId.is_valid(notificacion.paciente_id):
+            error = "ID de paciente inválido"
+        elif notificacion.estudio_id and not ObjectId.is_valid(notificacion.estudio_id):
+            error = "ID de estudio inválido"
+        elif notificacion.paciente_id not in pacientes:
+            error = "Paciente no encontrado"
+        elif notificacion.estudio_id and notificacion.estudio_id not in estudios:
+            error = "Estudio no encontrado"
+        else:
+            error = None
+            validas.append((indice, nueva_notificacion(**notificacion.dict())))
+        resultados.append({"indice": indice, "id": None, "error": error})
+    
+    # Un solo insert_many sin orden; el dispatcher las toma del outbox en lotes
+    if validas:
         try:
-            if notificacion["tipo"] == "email":
-                success = await email_service.send_email(
-                    paciente["email"],
-                    notificacion.get("titulo", "Actualización de su estudio médico"),
-                    notificacion["mensaje"]
-                )
-            elif notificacion["tipo"] == "sms":
-                success = await sms_service.send_sms(
-                    paciente["telefono"],
-                    notificacion["mensaje"]
-                )
-            
-            if success:
-                # Marcar como enviada
-                await db.notificaciones.update_one(
-                    {"_id": ObjectId(notificacion_id)},
-                    {"$set": {
-                        "enviada": True,
-                        "fecha_envio": datetime.now(),
-                        "ultimo_intento": datetime.now()
-                    }}
-                )
-            else:
-                # Incrementar contador de intentos
-                await db.notificaciones.update_one(
-                    {"_id": ObjectId(notificacion_id)},
-                    {"$inc": {"intentos_envio": 1}, "$set": {"ultimo_intento": datetime.now()}}
-                )
-                
-        except Exception as e:
-            # Incrementar contador de intentos en caso de error
-            await db.notificaciones.update_one(
-                {"_id": ObjectId(notificacion_id)},
-                {"$inc": {"intentos_envio": 1}, "$set": {"ultimo_intento": datetime.now()}}
-            )
-            print(f"Error enviando notificación {notificacion_id}: {e}")
-            
-    except Exception as e:
-        print(f"Error en send_notification: {e}")
+            result = await db.notificaciones.insert_many([doc for _, doc in validas], ordered=False)
+            for (indice, _), inserted_id in zip(validas, result.inserted_ids):
+                resultados[indice]["id"] = str(inserted_id)
+        except BulkWriteError as e:
+            fallidas = {error["index"]: error.get("errmsg", "Error al guardar") for error in e.details["writeErrors"]}
+            for posicion, (indice, doc) in enumerate(validas):
+                if posicion in fallidas:
+                    resultados[indice]["error"] = fallidas[posicion]
+                else:
+                    resultados[indice]["id"] = str(doc["_id"])
+    
+    creadas = sum(1 for r in resultados if r["id"])
+    return {"creadas": creadas, "errores": len(resultados) - creadas, "resultados": resultados}
 
 @router.get("/notificaciones", response_model=List[Notificacion])
 async def get_notificaciones(skip: int = 0, limit: int = 100, enviada: bool = None):
@@ -117,6 +112,19 @@ async def get_notificaciones(skip: int = 0, limit: int = 100, enviada: bool = No
     
     return notificaciones
 
+@router.get("/notificaciones/metricas")
+async def get_metricas_notificaciones():
+    """Profundidad del outbox: notificaciones por estado, listas para enviar y en espera de reintento"""
+    return await dispatcher.metricas()
+
+@router.get("/notificaciones/metricas/prometheus", response_class=PlainTextResponse)
+async def get_metricas_prometheus():
+    """Métricas de entrega y de la cola en formato de texto de Prometheus"""
+    datos = await metricas_notificaciones.recolectar()
+    return PlainTextResponse(
+        metricas_notificaciones.prometheus(datos), media_type="text/plain; version=0.0.4; charset=utf-8"
+    )
+
 @router.get("/notificaciones/{notificacion_id}", response_model=Notificacion)
 async def get_notificacion(notificacion_id: str):
     """Obtener una notificación específica por ID"""
@@ -153,7 +161,7 @@ async def get_notificaciones_paciente(paciente_id: str, skip: int = 0, limit: in
         raise HTTPException(status_code=400, detail="ID de paciente inválido")
 
 @router.post("/estudios/{estudio_id}/notificaciones/estado")
-async def notificar_estado_estudio(estudio_id: str, background_tasks: BackgroundTasks):
+async def notificar_estado_estudio(estudio_id: str):
     """Crear notificaciones automáticas cuando cambia el estado de un estudio"""
     try:
         db = get_database()
@@ -166,41 +174,11 @@ async def notificar_estado_estudio(estudio_id: str, background_tasks: Background
         if not paciente:
             raise HTTPException(status_code=404, detail="Paciente no encontrado")
         
-        # Crear mensaje según el estado
-        if estudio["estado"] == "programado":
-            mensaje = f"Su estudio de {estudio['tipo_estudio']} ha sido programado."
-            titulo = "Estudio Programado"
-        elif estudio["estado"] == "en_proceso":
-            mensaje = f"Su estudio de {estudio['tipo_estudio']} está en proceso."
-            titulo = "Estudio en Proceso"
-        elif estudio["estado"] == "completado":
-            mensaje = f"Su estudio de {estudio['tipo_estudio']} ha sido completado. Los resultados estarán disponibles pronto."
-            titulo = "Estudio Completado"
-        else:
+        if estudio["estado"] not in ESTADOS_NOTIFICADOS:
             return {"message": "No se requiere notificación para este estado"}
         
-        # Crear notificación por email
-        notificacion_email = NotificacionCreate(
-            paciente_id=str(paciente["_id"]),
-            tipo="email",
-            titulo=titulo,
-            mensaje=mensaje,
-            estudio_id=estudio_id,
-            prioridad="normal"
-        )
-        
-        # Crear notificación por SMS
-        notificacion_sms = NotificacionCreate(
-            paciente_id=str(paciente["_id"]),
-            tipo="sms",
-            mensaje=mensaje,
-            estudio_id=estudio_id,
-            prioridad="normal"
-        )
-        
-        # Crear las notificaciones en segundo plano
-        background_tasks.add_task(create_notificacion, notificacion_email, BackgroundTasks())
-        background_tasks.add_task(create_notificacion, notificacion_sms, BackgroundTasks())
+        # Se agrupa con los cambios de estado recientes del paciente en un solo aviso por canal
+        await agrupador_estados.agregar(paciente, estudio)
         
         return {"message": "Notificaciones programadas"}
         
@@ -208,7 +186,7 @@ async def notificar_estado_estudio(estudio_id: str, background_tasks: Background
         raise HTTPException(status_code=400, detail="ID de estudio inválido")
 
 @router.post("/notificaciones/{notificacion_id}/reenviar")
-async def reenviar_notificacion(notificacion_id: str, background_tasks: BackgroundTasks):
+async def reenviar_notificacion(notificacion_id: str):
     """Reenviar una notificación fallida"""
     try:
         db = get_database()
@@ -222,8 +200,19 @@ async def reenviar_notificacion(notificacion_id: str, background_tasks: Backgrou
         if notificacion["enviada"]:
             raise HTTPException(status_code=400, detail="La notificación ya fue enviada exitosamente")
         
-        # Reenviar en segundo plano
-        background_tasks.add_task(send_notification, notificacion_id)
+        # Devolver al outbox con los intentos en cero; solo las fallidas, para no
+        # pisar una que un dispatcher está enviando ni una que ya espera reintento
+        result = await db.notificaciones.update_one(
+            {"_id": ObjectId(notificacion_id), "estado": "fallida"},
+            {"$set": {
+                "estado": "pendiente",
+                "disponible_desde": datetime.now(),
+                "fecha_encolado": datetime.now(),
+                "intentos_envio": 0,
+            }}
+        )
+        if result.modified_count == 0:
+            raise HTTPException(status_code=400, detail="Solo se pueden reenviar notificaciones fallidas")
         
         return {"message": "Notificación programada para reenvío"}
         
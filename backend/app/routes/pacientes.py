@@ -1,11 +1,16 @@
 from fastapi import APIRouter, HTTPException
 from app.schemas import PacienteCreate, Paciente, PacienteUpdate
-from app.database import get_database, object_id_to_str
+from app.database import get_database, object_id_to_str, buscar_por_id
+from app.services.search_service import SearchService, campos_busqueda_paciente
 from bson import ObjectId
 from datetime import datetime
-from typing import List
+from typing import List, Optional
+import asyncio
+import base64
+import heapq
 
 router = APIRouter()
+search_service = SearchService()
 
 @router.get("/pacientes", response_model=List[Paciente])
 async def get_pacientes(skip: int = 0, limit: int = 100):
@@ -19,6 +24,13 @@ async def get_pacientes(skip: int = 0, limit: int = 100):
     
     return pacientes
 
+@router.get("/pacientes/search")
+async def search_pacientes(q: str, limit: int = 20):
+    """Buscar pacientes por nombre, apellidos o identificación (sin tildes, por prefijo)"""
+    limit = max(1, min(limit, 100))
+    resultados = await search_service.buscar_pacientes(q, limit)
+    return {"query": q, "total": len(resultados), "resultados": resultados}
+
 @router.get("/pacientes/{paciente_id}", response_model=Paciente)
 async def get_paciente(paciente_id: str):
     """Obtener un paciente específico por ID"""
@@ -52,6 +64,7 @@ async def create_paciente(paciente: PacienteCreate):
     paciente_dict = paciente.dict()
     paciente_dict["fecha_creacion"] = datetime.now()
     paciente_dict["fecha_actualizacion"] = datetime.now()
+    paciente_dict.update(campos_busqueda_paciente(paciente_dict))
     
     result = await db.pacientes.insert_one(paciente_dict)
     new_paciente = await db.pacientes.find_one({"_id": result.inserted_id})
@@ -81,6 +94,10 @@ async def update_paciente(paciente_id: str, paciente: PacienteUpdate):
         
         update_data["fecha_actualizacion"] = datetime.now()
         
+        # Mantener actualizados los campos de búsqueda si cambia el nombre o la identificación
+        if {"nombre", "apellidos", "identificacion"} & update_data.keys():
+            update_data.update(campos_busqueda_paciente({**existing_patient, **update_data}))
+        
         # Verificar duplicados si se está actualizando identificación o email
         if "identificacion" in update_data:
             existing_id = await db.pacientes.find_one({
@@ -166,11 +183,128 @@ async def get_estudios_paciente(paciente_id: str):
         
         estudios = []
         async for estudio in db.estudios.find({"paciente_id": paciente_id}).sort("fecha_solicitud", -1):
-            estudio["id"] = str(estudio["_id"])
+            estudio["id"] = str(estudio.pop("_id"))
             estudios.append(estudio)
         
+        paciente["id"] = str(paciente.pop("_id"))
         return {"paciente": paciente, "estudios": estudios}
         
     except ValueError:
         raise HTTPException(status_code=400, detail="ID de paciente inválido")
 
+# Fuentes del timeline: tipo de evento -> (colección, campo de fecha, campos proyectados)
+FUENTES_TIMELINE = {
+    "estudio": (
+        "estudios",
+        "fecha_solicitud",
+        ["tipo_estudio", "estado", "prioridad", "medico_solicitante", "fecha_realizacion"],
+    ),
+    "cita": (
+        "citas",
+        "fecha_cita",
+        ["tipo_estudio", "tipo_cita", "estado", "sala", "tecnico_asignado", "estudio_id"],
+    ),
+    "informe": (
+        "informes",
+        "fecha_creacion",
+        ["estudio_id", "estudio_tipo", "estado", "medico_radiologo", "firmado", "urgente"],
+    ),
+    "notificacion": (
+        "notificaciones",
+        "fecha_creacion",
+        ["tipo", "titulo", "mensaje", "enviada", "estudio_id"],
+    ),
+}
+
+def codificar_cursor(fecha: datetime, documento_id: ObjectId) -> str:
+    """Codificar la posición (fecha, _id) del último evento entregado"""
+    valor = f"{fecha.isoformat()}|{documento_id}"
+    return base64.urlsafe_b64encode(valor.encode()).decode()
+
+def decodificar_cursor(cursor: str):
+    """Decodificar un cursor de paginación del timeline"""
+    try:
+        fecha, documento_id = base64.urlsafe_b64decode(cursor.encode()).decode().split("|")
+        return datetime.fromisoformat(fecha), ObjectId(documento_id)
+    except Exception:
+        raise HTTPException(status_code=400, detail="Cursor de paginación inválido")
+
+async def leer_fuente_timeline(db, tipo: str, referencias: List[str], posicion, limit: int):
+    """Leer una página de eventos de una colección, ordenada por (fecha, _id) descendente"""
+    coleccion, campo_fecha, campos = FUENTES_TIMELINE[tipo]
+    filtro = {"paciente_id": {"$in": referencias}}
+    if posicion:
+        fecha, documento_id = posicion
+        filtro["$or"] = [
+            {campo_fecha: {"$lt": fecha}},
+            {campo_fecha: fecha, "_id": {"$lt": documento_id}},
+        ]
+    else:
+        filtro[campo_fecha] = {"$type": "date"}
+    
+    proyeccion = {campo: 1 for campo in campos}
+    proyeccion[campo_fecha] = 1
+    
+    cursor = db[coleccion].find(filtro, proyeccion).sort(
+        [(campo_fecha, -1), ("_id", -1)]
+    ).limit(limit)
+    
+    eventos = []
+    async for documento in cursor:
+        documento_id = documento.pop("_id")
+        fecha = documento.pop(campo_fecha)
+        eventos.append({
+            "tipo": tipo,
+            "id": str(documento_id),
+            "fecha": fecha,
+            "datos": documento,
+            "_orden": (fecha, documento_id),
+        })
+    return eventos
+
+@router.get("/pacientes/{paciente_id}/timeline")
+async def get_timeline_paciente(paciente_id: str, cursor: Optional[str] = None, limit: int = 50):
+    """Obtener estudios, citas, informes y notificaciones de un paciente en un solo flujo por fecha"""
+    db = get_database()
+    limit = max(1, min(limit, 200))
+    posicion = decodificar_cursor(cursor) if cursor else None
+    
+    paciente = await buscar_por_id(
+        "pacientes", paciente_id,
+        {"nombre": 1, "apellidos": 1, "identificacion": 1, "email": 1, "telefono": 1, "id": 1},
+    )
+    if not paciente:
+        raise HTTPException(status_code=404, detail="Paciente no encontrado")
+    
+    # Referencias al paciente: id canónico y, si existe, el id heredado aún no migrado
+    referencias = [str(paciente["_id"])] + ([paciente["id"]] if paciente.get("id") else [])
+    
+    # Leer las cuatro colecciones en paralelo; cada una ya viene ordenada
+    paginas = await asyncio.gather(*[
+        leer_fuente_timeline(db, tipo, referencias, posicion, limit)
+        for tipo in FUENTES_TIMELINE
+    ])
+    
+    eventos = list(heapq.merge(*paginas, key=lambda e: e["_orden"], reverse=True))
+    hay_mas = len(eventos) > limit or any(len(pagina) == limit for pagina in paginas)
+    eventos = eventos[:limit]
+    
+    siguiente = None
+    if hay_mas and eventos:
+        siguiente = codificar_cursor(*eventos[-1]["_orden"])
+    
+    for evento in eventos:
+        del evento["_orden"]
+    
+    return {
+        "paciente": {
+            "id": str(paciente["_id"]),
+            "nombre": paciente.get("nombre"),
+            "apellidos": paciente.get("apellidos"),
+            "identificacion": paciente.get("identificacion"),
+            "email": paciente.get("email"),
+            "telefono": paciente.get("telefono"),
+        },
+        "eventos": eventos,
+        "next_cursor": siguiente,
+    }
@@ -0,0 +1,53 @@
+from fastapi import APIRouter, Depends, HTTPException, status
+from app.auth import get_current_user, UserRole, User
+from app.schemas import PlantillaUpdate
+from app.services.plantilla_service import plantilla_service
+
+router = APIRouter()
+
+
+def _verificar_admin(current_user: User):
+    if current_user.role != UserRole.ADMIN:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Solo los administradores pueden modificar las plantillas",
+        )
+
+
+@router.get("/plantillas")
+async def get_plantillas():
+    """Plantillas de notificación vigentes con sus variables"""
+    await plantilla_service.actualizar(forzar=True)
+    return [plantilla.a_dict() for plantilla in plantilla_service.listar()]
+
+
+@router.get("/plantillas/{locale}/{nombre}")
+async def get_plantilla(locale: str, nombre: str):
+    """Obtener una plantilla (si no existe en el locale, la del locale por defecto)"""
+    await plantilla_service.actualizar(forzar=True)
+    try:
+        return plantilla_service.obtener(nombre, locale).a_dict()
+    except ValueError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+
+
+@router.put("/plantillas/{locale}/{nombre}")
+async def update_plantilla(
+    locale: str, nombre: str, plantilla: PlantillaUpdate, current_user: User = Depends(get_current_user)
+):
+    """Guardar una versión personalizada; los procesos la usan sin reiniciar"""
+    _verificar_admin(current_user)
+    try:
+        guardada = await plantilla_service.guardar(nombre, locale, plantilla.dict())
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return guardada.a_dict()
+
+
+@router.delete("/plantillas/{locale}/{nombre}")
+async def delete_plantilla(locale: str, nombre: str, current_user: User = Depends(get_current_user)):
+    """Eliminar la versión personalizada y volver a la plantilla por defecto"""
+    _verificar_admin(current_user)
+    if not await plantilla_service.eliminar(nombre, locale):
+        raise HTTPException(status_code=404, detail="La plantilla no tiene una versión personalizada")
+    return {"message": "Plantilla restablecida a la versión por defecto"}
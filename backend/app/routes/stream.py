@@ -0,0 +1,66 @@
+from fastapi import APIRouter, Request
+from fastapi.responses import StreamingResponse
+from app.services.event_bus import event_bus
+from typing import Optional
+import asyncio
+import json
+
+router = APIRouter()
+
+# Segundos sin eventos antes de enviar un comentario para mantener viva la conexión
+HEARTBEAT_SEGUNDOS = 15
+
+
+@router.get("/stream/events")
+async def stream_events(
+    request: Request,
+    tipos: Optional[str] = None,
+    sala: Optional[str] = None,
+    tecnico: Optional[str] = None,
+    radiologo: Optional[str] = None,
+    paciente_id: Optional[str] = None,
+    estudio_id: Optional[str] = None,
+):
+    """Eventos de estudios, citas e informes por Server-Sent Events.
+
+    tipos: lista separada por comas (estudio, cita, informe). Los demás
+    parámetros filtran por sala, técnico, radiólogo, paciente o estudio.
+    """
+    filtros = {
+        campo: valor
+        for campo, valor in {
+            "sala": sala,
+            "tecnico_asignado": tecnico,
+            "medico_radiologo": radiologo,
+            "paciente_id": paciente_id,
+            "estudio_id": estudio_id,
+        }.items()
+        if valor
+    }
+    tipos_evento = {t.strip() for t in tipos.split(",") if t.strip()} if tipos else None
+
+    async def eventos():
+        with event_bus.suscribir(filtros, tipos_evento) as suscripcion:
+            yield "retry: 3000\n\n"
+            while not await request.is_disconnected():
+                try:
+                    evento = await asyncio.wait_for(
+                        suscripcion.cola.get(), timeout=HEARTBEAT_SEGUNDOS
+                    )
+                except asyncio.TimeoutError:
+                    yield ": heartbeat\n\n"
+                    continue
+                datos = json.dumps(evento, default=str, ensure_ascii=False)
+                yield f"id: {evento['id']}\nevent: {evento['tipo']}\ndata: {datos}\n\n"
+
+    return StreamingResponse(
+        eventos(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@router.get("/stream/status")
+async def stream_status():
+    """Clientes conectados y origen de los eventos"""
+    return event_bus.resumen()
@@ -0,0 +1,45 @@
+from fastapi import APIRouter, HTTPException
+from app.schemas import TarifaCreate, Tarifa
+from app.database import get_database
+from app.services.tarifas_service import tarifas_service
+from datetime import datetime
+from typing import List, Optional
+
+router = APIRouter()
+
+
+def _tarifa(documento: dict) -> Tarifa:
+    documento["id"] = str(documento.pop("_id"))
+    return Tarifa(**documento)
+
+
+@router.get("/tarifas", response_model=List[Tarifa])
+async def get_tarifas(tipo_estudio: Optional[str] = None, vigente_en: Optional[str] = None):
+    """Listar tarifas, opcionalmente por tipo de estudio o vigentes en una fecha (YYYY-MM-DD)"""
+    db = get_database()
+    filtro = {}
+    if tipo_estudio:
+        filtro["tipo_estudio"] = tipo_estudio
+    if vigente_en:
+        try:
+            fecha = datetime.strptime(vigente_en, "%Y-%m-%d")
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Formato de fecha inválido, use YYYY-MM-DD")
+        filtro["vigente_desde"] = {"$lte": fecha}
+        filtro["$or"] = [{"vigente_hasta": None}, {"vigente_hasta": {"$gt": fecha}}]
+
+    cursor = db.tarifas.find(filtro).sort([("tipo_estudio", 1), ("vigente_desde", 1)])
+    return [_tarifa(documento) async for documento in cursor]
+
+
+@router.post("/tarifas", response_model=Tarifa)
+async def create_tarifa(tarifa: TarifaCreate):
+    """Registrar el precio de un tipo de estudio a partir de vigente_desde.
+
+    La tarifa anterior del mismo tipo deja de estar vigente en esa fecha y los
+    informes financieros se recalculan con el nuevo catálogo.
+    """
+    nueva = await tarifas_service.crear_tarifa(
+        tarifa.tipo_estudio.strip(), tarifa.precio, tarifa.vigente_desde
+    )
+    return _tarifa(nueva)
@@ -0,0 +1,76 @@
+from fastapi import APIRouter, Depends, HTTPException, status
+from app.auth import get_current_user, UserRole, User
+from app.schemas import Informe
+from app.services.event_bus import event_bus
+from app.services.worklist_service import worklist_service
+from bson import ObjectId
+from typing import List
+
+router = APIRouter()
+
+
+def _verificar_radiologo(current_user: User):
+    if current_user.role not in [UserRole.ADMIN, UserRole.RADIOLOGO]:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Solo los radiólogos pueden usar la lista de trabajo",
+        )
+
+
+def _object_id(informe_id: str) -> ObjectId:
+    if not ObjectId.is_valid(informe_id):
+        raise HTTPException(status_code=400, detail="ID de informe inválido")
+    return ObjectId(informe_id)
+
+
+def _informe(documento: dict) -> Informe:
+    event_bus.publicar_local("informes", "update", documento)
+    documento["id"] = str(documento.pop("_id"))
+    return Informe(**documento)
+
+
+@router.get("/worklist", response_model=List[Informe])
+async def get_worklist(
+    skip: int = 0, limit: int = 50, current_user: User = Depends(get_current_user)
+):
+    """Informes sin firmar en orden de asignación (prioridad y antigüedad)"""
+    _verificar_radiologo(current_user)
+    informes = await worklist_service.pendientes(skip, limit)
+    for informe in informes:
+        informe["id"] = str(informe.pop("_id"))
+    return informes
+
+
+@router.post("/worklist/next", response_model=Informe)
+async def tomar_siguiente(current_user: User = Depends(get_current_user)):
+    """Asignar al radiólogo el siguiente informe libre de la lista"""
+    _verificar_radiologo(current_user)
+    informe = await worklist_service.tomar_siguiente(current_user.email)
+    if not informe:
+        raise HTTPException(status_code=404, detail="No hay informes pendientes en la lista de trabajo")
+    return _informe(informe)
+
+
+@router.post("/worklist/{informe_id}/renew", response_model=Informe)
+async def renovar(informe_id: str, current_user: User = Depends(get_current_user)):
+    """Extender el lease de un informe asignado al radiólogo"""
+    _verificar_radiologo(current_user)
+    informe = await worklist_service.renovar(_object_id(informe_id), current_user.email)
+    if not informe:
+        raise HTTPException(
+            status_code=409, detail="El informe no está asignado a este usuario o el lease venció"
+        )
+    return _informe(informe)
+
+
+@router.post("/worklist/{informe_id}/release", response_model=Informe)
+async def liberar(informe_id: str, current_user: User = Depends(get_current_user)):
+    """Devolver un informe a la lista; un administrador puede liberar informes de otros"""
+    _verificar_radiologo(current_user)
+    usuario = None if current_user.role == UserRole.ADMIN else current_user.email
+    informe = await worklist_service.liberar(_object_id(informe_id), usuario)
+    if not informe and usuario is None:
+        raise HTTPException(status_code=404, detail="Informe no encontrado")
+    if not informe:
+        raise HTTPException(status_code=409, detail="El informe no está asignado a este usuario")
+    return _informe(informe)
@@ -96,6 +96,10 @@ class Estudio(EstudioBase):
         arbitrary_types_allowed = True
 
 
+# Límite de duración de una cita; acota la búsqueda de solapamientos en la agenda
+DURACION_MAXIMA_CITA = 720
+
+
 class CitaBase(BaseModel):
     paciente_id: str
     fecha_cita: datetime
@@ -109,7 +113,7 @@ class CitaCreate(CitaBase):
     estudio_id: Optional[str] = None
     tecnico_asignado: Optional[str] = None
     sala: Optional[str] = None
-    duracion_minutos: int = 30
+    duracion_minutos: int = Field(30, gt=0, le=DURACION_MAXIMA_CITA)
 
 
 class Cita(CitaBase):
@@ -179,6 +183,10 @@ class Informe(InformeBase):
     fecha_actualizacion: datetime
     firmado: bool = False
     fecha_firma: Optional[datetime] = None
+    # Lista de trabajo de radiólogos
+    lista_prioridad: int = 0
+    asignado_a: Optional[str] = None
+    asignado_hasta: Optional[datetime] = None
     # Campos adicionales para información del paciente y estudio
     paciente_id: Optional[str] = None
     paciente_nombre: Optional[str] = None
@@ -212,6 +220,35 @@ class Notificacion(NotificacionBase):
     fecha_envio: Optional[datetime] = None
     intentos_envio: int
     ultimo_intento: Optional[datetime] = None
+    estado: str = "pendiente"  # pendiente, enviando, enviada, fallida, cancelada
+    error: Optional[str] = None
+    disponible_desde: Optional[datetime] = None  # próximo intento de envío
+
+    class Config:
+        from_attributes = True
+
+
+class PlantillaUpdate(BaseModel):
+    asunto: Optional[str] = None
+    texto: Optional[str] = None
+    html: Optional[str] = None
+    sms: Optional[str] = None
+
+
+class TarifaBase(BaseModel):
+    tipo_estudio: str
+    precio: int = Field(..., ge=0)
+    vigente_desde: datetime
+
+
+class TarifaCreate(TarifaBase):
+    pass
+
+
+class Tarifa(TarifaBase):
+    id: str
+    vigente_hasta: Optional[datetime] = None
+    fecha_creacion: datetime
 
     class Config:
         from_attributes = True
@@ -234,7 +271,7 @@ class CitaUpdate(BaseModel):
     estado: Optional[str] = None
     tecnico_asignado: Optional[str] = None
     sala: Optional[str] = None
-    duracion_minutos: Optional[int] = None
+    duracion_minutos: Optional[int] = Field(None, gt=0, le=DURACION_MAXIMA_CITA)
     asistio: Optional[bool] = None
 
 
@@ -0,0 +1,223 @@
+import asyncio
+import itertools
+import os
+import time
+import uuid
+from bisect import bisect_left
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from bson import ObjectId
+from fastapi import HTTPException
+from pymongo.errors import DuplicateKeyError
+
+from app.database import get_database
+from app.schemas import DURACION_MAXIMA_CITA
+from app.services.estadisticas_service import (
+    DIAS_ATENCION,
+    DURACION_CITA_DEFECTO,
+    HORA_APERTURA,
+    HORA_CIERRE,
+)
+
+# Las citas canceladas no ocupan la sala ni el técnico
+ESTADOS_LIBRES = ["cancelada"]
+
+# Campo de la cita -> nombre del recurso en las claves de bloqueo
+RECURSOS = {"sala": "sala", "tecnico_asignado": "tecnico"}
+
+Intervalo = Tuple[datetime, datetime]
+
+
+def calcular_fecha_fin(fecha_cita: datetime, duracion_minutos: Optional[int]) -> datetime:
+    return fecha_cita + timedelta(minutes=duracion_minutos or DURACION_CITA_DEFECTO)
+
+
+class IntervalIndex:
+    """Intervalos [inicio, fin) ordenados por inicio con el máximo fin acumulado.
+
+    Un intervalo [a, b) se solapa con alguno del índice si, entre los que
+    empiezan antes de b (bisect), el mayor fin es posterior a a. Construirlo
+    cuesta O(n log n) y cada consulta O(log n).
+    """
+
+    def __init__(self, intervalos: Iterable[Intervalo]):
+        ordenados = sorted(intervalos)
+        self.inicios = [inicio for inicio, _ in ordenados]
+        self.fines_max = list(itertools.accumulate((fin for _, fin in ordenados), max))
+
+    def __len__(self) -> int:
+        return len(self.inicios)
+
+    def solapa(self, inicio: datetime, fin: datetime) -> bool:
+        i = bisect_left(self.inicios, fin)
+        return i > 0 and self.fines_max[i - 1] > inicio
+
+
+class AgendaService:
+    """Detección de conflictos y disponibilidad de salas y técnicos.
+
+    Cada cita guarda fecha_fin; los índices (sala, fecha_cita) y
+    (tecnico_asignado, fecha_cita) acotan la búsqueda de solapamientos a las
+    citas que empiezan entre inicio - DURACION_MAXIMA_CITA y fin. Las reservas
+    toman un bloqueo por recurso en agenda_bloqueos para que dos procesos no
+    puedan confirmar citas solapadas a la vez.
+    """
+
+    def __init__(self, bloqueo_segundos: float = 10, espera_bloqueo: float = 5):
+        self.bloqueo = timedelta(seconds=bloqueo_segundos)
+        self.espera_bloqueo = espera_bloqueo
+
+    @staticmethod
+    def _recursos(sala: Optional[str], tecnico: Optional[str]) -> Dict[str, str]:
+        recursos = {"sala": sala, "tecnico_asignado": tecnico}
+        return {campo: valor for campo, valor in recursos.items() if valor}
+
+    @staticmethod
+    def _filtro_rango(inicio: datetime, fin: datetime) -> dict:
+        return {
+            "fecha_cita": {"$gte": inicio - timedelta(minutes=DURACION_MAXIMA_CITA), "$lt": fin},
+            "fecha_fin": {"$gt": inicio},
+            "estado": {"$nin": ESTADOS_LIBRES},
+        }
+
+    async def buscar_conflicto(
+        self,
+        inicio: datetime,
+        fin: datetime,
+        sala: Optional[str],
+        tecnico: Optional[str],
+        excluir_id: Optional[ObjectId] = None,
+    ) -> Optional[dict]:
+        """Primera cita activa de la sala o el técnico que se solapa con [inicio, fin)"""
+        recursos = self._recursos(sala, tecnico)
+        if not recursos:
+            return None
+
+        db = get_database()
+        rango = self._filtro_rango(inicio, fin)
+        filtro = {"$or": [{campo: valor, **rango} for campo, valor in recursos.items()]}
+        if excluir_id:
+            filtro["_id"] = {"$ne": excluir_id}
+        return await db.citas.find_one(filtro, {"sala": 1, "tecnico_asignado": 1, "fecha_cita": 1})
+
+    async def _adquirir(self, clave: str, token: str):
+        db = get_database()
+        limite = time.monotonic() + self.espera_bloqueo
+        while True:
+            ahora = datetime.now()
+            try:
+                # Sin documento se inserta; vencido se toma; vigente choca con el _id existente
+                await db.agenda_bloqueos.find_one_and_update(
+                    {"_id": clave, "hasta": {"$lte": ahora}},
+                    {"$set": {"hasta": ahora + self.bloqueo, "token": token}},
+                    upsert=True,
+                )
+                return
+            except DuplicateKeyError:
+                if time.monotonic() > limite:
+                    raise HTTPException(
+                        status_code=409,
+                        detail="La agenda está siendo modificada, intente nuevamente",
+                    )
+                await asyncio.sleep(0.05)
+
+    @asynccontextmanager
+    async def _bloquear(self, recursos: Dict[str, str]):
+        db = get_database()
+        token = uuid.uuid4().hex
+        # Orden fijo de adquisición para que dos reservas no se esperen mutuamente
+        claves = sorted(f"{RECURSOS[campo]}:{valor}" for campo, valor in recursos.items())
+        adquiridas = []
+        try:
+            for clave in claves:
+                await self._adquirir(clave, token)
+                adquiridas.append(clave)
+            yield
+        finally:
+            if adquiridas:
+                await db.agenda_bloqueos.delete_many({"_id": {"$in": adquiridas}, "token": token})
+
+    @asynccontextmanager
+    async def reservar(
+        self,
+        inicio: datetime,
+        fin: datetime,
+        sala: Optional[str],
+        tecnico: Optional[str],
+        excluir_id: Optional[ObjectId] = None,
+    ):
+        """Verificar que la sala y el técnico estén libres y mantenerlos bloqueados
+        mientras se guarda la cita dentro del bloque async with"""
+        async with self._bloquear(self._recursos(sala, tecnico)):
+            conflicto = await self.buscar_conflicto(inicio, fin, sala, tecnico, excluir_id)
+            if conflicto:
+                ocupado = "sala" if sala and conflicto.get("sala") == sala else "técnico"
+                raise HTTPException(
+                    status_code=400,
+                    detail=(
+                        f"Conflicto de horario: {ocupado} no disponible "
+                        f"(cita de las {conflicto['fecha_cita'].strftime('%H:%M')})"
+                    ),
+                )
+            yield
+
+    async def indices_ocupacion(
+        self, inicio: datetime, fin: datetime, sala: Optional[str], tecnico: Optional[str]
+    ) -> List[IntervalIndex]:
+        """Un IntervalIndex con las citas activas de cada recurso en [inicio, fin)"""
+        db = get_database()
+        rango = self._filtro_rango(inicio, fin)
+        indices = []
+        for campo, valor in self._recursos(sala, tecnico).items():
+            cursor = db.citas.find({campo: valor, **rango}, {"fecha_cita": 1, "fecha_fin": 1})
+            indices.append(IntervalIndex([(c["fecha_cita"], c["fecha_fin"]) async for c in cursor]))
+        return indices
+
+    async def disponibilidad(
+        self,
+        inicio: datetime,
+        fin: datetime,
+        duracion_minutos: int,
+        sala: Optional[str] = None,
+        tecnico: Optional[str] = None,
+        paso_minutos: Optional[int] = None,
+    ) -> List[dict]:
+        """Horarios libres por día dentro del horario de atención"""
+        indices = await self.indices_ocupacion(inicio, fin, sala, tecnico)
+        duracion = timedelta(minutes=duracion_minutos)
+        paso = timedelta(minutes=paso_minutos or duracion_minutos)
+        ahora = datetime.now()
+
+        dias = []
+        dia = datetime(inicio.year, inicio.month, inicio.day)
+        while dia < fin:
+            horarios = []
+            if dia.weekday() in DIAS_ATENCION:
+                slot = max(dia + timedelta(hours=HORA_APERTURA), inicio)
+                cierre = min(dia + timedelta(hours=HORA_CIERRE), fin)
+                while slot + duracion <= cierre:
+                    if slot >= ahora and not any(i.solapa(slot, slot + duracion) for i in indices):
+                        horarios.append({"inicio": slot, "fin": slot + duracion})
+                    slot += paso
+            dias.append({"fecha": dia.strftime("%Y-%m-%d"), "horarios": horarios})
+            dia += timedelta(days=1)
+        return dias
+
+    async def preparar(self) -> int:
+        """Calcular fecha_fin de las citas creadas antes de la agenda"""
+        db = get_database()
+        result = await db.citas.update_many(
+            {"fecha_fin": {"$exists": False}, "fecha_cita": {"$type": "date"}},
+            [{"$set": {"fecha_fin": {"$add": [
+                "$fecha_cita",
+                {"$multiply": [{"$ifNull": ["$duracion_minutos", DURACION_CITA_DEFECTO]}, 60000]},
+            ]}}}],
+        )
+        return result.modified_count
+
+
+agenda_service = AgendaService(
+    bloqueo_segundos=float(os.getenv("AGENDA_BLOQUEO_SEGUNDOS", "10")),
+)
@@ -0,0 +1,125 @@
+import os
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional
+
+from bson import ObjectId
+from fastapi import HTTPException
+from pymongo.errors import DuplicateKeyError
+
+from app.database import get_database
+from app.services.outbox_service import nueva_notificacion
+from app.services.plantilla_service import Mensaje, PlantillaService, plantilla_service
+
+# Estados del estudio que se notifican al paciente (plantillas estudio_<estado>)
+ESTADOS_NOTIFICADOS = ["programado", "en_proceso", "completado"]
+
+CANALES = ("email", "sms")
+
+# Intentos de fusionar o crear el aviso mientras otros procesos lo modifican
+MAX_INTENTOS_FUSION = 5
+
+
+class AgrupadorEstados:
+    """Agrupa los cambios de estado de los estudios de un paciente en un solo aviso.
+
+    El primer cambio crea una notificación por canal con agrupacion
+    "estados:<paciente_id>:<canal>" y disponible_desde al final de la ventana.
+    Los cambios que llegan mientras sigue pendiente se fusionan en ella: cada
+    estudio queda con su último estado y, si hay más de uno, el mensaje pasa a
+    ser un resumen. Así un estudio que pasa por programado, en_proceso y
+    completado dentro de la ventana genera un email y un SMS en lugar de seis.
+    Un índice único parcial sobre los avisos pendientes impide que dos procesos
+    creen a la vez dos avisos para el mismo paciente y canal.
+    """
+
+    def __init__(self, ventana_segundos: float = 600, plantillas: Optional[PlantillaService] = None):
+        self.ventana = timedelta(seconds=ventana_segundos)
+        self.plantillas = plantillas or plantilla_service
+
+    def _mensaje(self, paciente: dict, estudios: Dict[str, dict]) -> Mensaje:
+        locale = paciente.get("idioma")
+        avisos = [
+            self.plantillas.renderizar(
+                f"estudio_{estudio['estado']}", {"tipo_estudio": estudio["tipo_estudio"]}, locale
+            )
+            for estudio in estudios.values()
+        ]
+        if len(avisos) == 1:
+            return avisos[0]
+        return self.plantillas.renderizar("resumen_estudios", {
+            "paciente_nombre": paciente.get("nombre", ""),
+            "detalle": "\n".join(f"- {aviso.texto.strip()}" for aviso in avisos),
+            "detalle_sms": " ".join(aviso.sms for aviso in avisos),
+        }, locale)
+
+    @staticmethod
+    def _contenido(canal: str, mensaje: Mensaje) -> dict:
+        if canal == "sms":
+            return {"mensaje": mensaje.sms, "titulo": None, "mensaje_html": None}
+        return {"mensaje": mensaje.texto, "titulo": mensaje.asunto, "mensaje_html": mensaje.html}
+
+    async def _agregar_canal(self, paciente: dict, estudio_id: str, estado: dict, canal: str) -> ObjectId:
+        db = get_database()
+        paciente_id = str(paciente["_id"])
+        clave = f"estados:{paciente_id}:{canal}"
+
+        for _ in range(MAX_INTENTOS_FUSION):
+            pendiente = await db.notificaciones.find_one({"agrupacion": clave, "estado": "pendiente"})
+            if not pendiente:
+                estudios = {estudio_id: estado}
+                contenido = self._contenido(canal, self._mensaje(paciente, estudios))
+                notificacion = nueva_notificacion(
+                    paciente_id, canal, contenido.pop("mensaje"),
+                    estudio_id=estudio_id,
+                    **contenido,
+                    agrupacion=clave,
+                    estudios=estudios,
+                    version=0,
+                    cambios_agrupados=1,
+                )
+                # La espera de la ventana no cuenta como latencia de entrega
+                notificacion["disponible_desde"] += self.ventana
+                notificacion["fecha_encolado"] = notificacion["disponible_desde"]
+                try:
+                    result = await db.notificaciones.insert_one(notificacion)
+                    return result.inserted_id
+                except DuplicateKeyError:
+                    # Otro proceso creó el aviso pendiente entre la consulta y el insert: fusionar en él
+                    continue
+
+            estudios = {**pendiente.get("estudios", {}), estudio_id: estado}
+            # Solo si nadie la reclamó ni la modificó desde que se leyó
+            result = await db.notificaciones.update_one(
+                {"_id": pendiente["_id"], "estado": "pendiente", "version": pendiente.get("version", 0)},
+                {
+                    "$set": {
+                        "estudios": estudios,
+                        "estudio_id": estudio_id,
+                        **self._contenido(canal, self._mensaje(paciente, estudios)),
+                        "fecha_actualizacion": datetime.now(),
+                    },
+                    "$inc": {"version": 1, "cambios_agrupados": 1},
+                },
+            )
+            if result.modified_count:
+                return pendiente["_id"]
+
+        raise HTTPException(status_code=409, detail="El aviso del paciente cambió varias veces; reintente")
+
+    async def agregar(self, paciente: dict, estudio: dict) -> List[ObjectId]:
+        """Sumar el estado actual del estudio al aviso pendiente del paciente (o crearlo).
+
+        Retorna los ids de las notificaciones creadas o actualizadas.
+        """
+        await self.plantillas.actualizar()
+        estudio_id = str(estudio["_id"])
+        estado = {"estado": estudio["estado"], "tipo_estudio": estudio["tipo_estudio"]}
+        return [
+            await self._agregar_canal(paciente, estudio_id, estado, canal)
+            for canal in CANALES
+        ]
+
+
+agrupador_estados = AgrupadorEstados(
+    ventana_segundos=float(os.getenv("NOTIFICACIONES_VENTANA_AGRUPACION", "600")),
+)
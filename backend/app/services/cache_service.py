@@ -0,0 +1,333 @@
+import asyncio
+import json
+import logging
+import os
+import time
+from collections import OrderedDict
+from datetime import datetime
+from typing import Any, Awaitable, Callable, Dict, Iterable, Optional, Tuple
+
+from pymongo import ReturnDocument
+
+from app.database import get_database
+
+try:
+    import redis.asyncio as redis_asyncio
+except ImportError:
+    redis_asyncio = None
+
+FORMATO_DIA = "%Y-%m-%d"
+
+
+def _intersecta(rango: Tuple[str, str], dias: Iterable[str]) -> bool:
+    """True si algún día YYYY-MM-DD cae en el rango [inicio, fin)"""
+    inicio, fin = rango
+    return any(inicio <= dia < fin for dia in dias)
+
+
+class AlmacenLocal:
+    """LRU en memoria con expiración por entrada"""
+
+    def __init__(self, max_entradas: int = 256):
+        self.max_entradas = max_entradas
+        self._entradas: "OrderedDict[str, Tuple[float, Tuple[str, str], Any]]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entradas)
+
+    async def get(self, clave: str) -> Optional[Any]:
+        entrada = self._entradas.get(clave)
+        if entrada is None:
+            return None
+        expira, _, valor = entrada
+        if expira < time.monotonic():
+            del self._entradas[clave]
+            return None
+        self._entradas.move_to_end(clave)
+        return valor
+
+    async def set(self, clave: str, valor: Any, ttl: float, rango: Tuple[str, str]):
+        self._entradas[clave] = (time.monotonic() + ttl, rango, valor)
+        self._entradas.move_to_end(clave)
+        while len(self._entradas) > self.max_entradas:
+            self._entradas.popitem(last=False)
+
+    async def invalidar(self, dias: Iterable[str]) -> int:
+        dias = list(dias)
+        claves = [c for c, (_, rango, _) in self._entradas.items() if _intersecta(rango, dias)]
+        for clave in claves:
+            del self._entradas[clave]
+        return len(claves)
+
+
+class AlmacenRedis:
+    """Caché compartida entre procesos.
+
+    Un sorted set guarda el rango de cada clave con su vencimiento como score,
+    para invalidar por día y podar los miembros de claves ya expiradas.
+    """
+
+    def __init__(self, url: str, prefijo: str):
+        self.cliente = redis_asyncio.from_url(url)
+        self.prefijo = prefijo
+        self.indice = f"{prefijo}:indice"
+
+    async def get(self, clave: str) -> Optional[Any]:
+        valor = await self.cliente.get(f"{self.prefijo}:{clave}")
+        return json.loads(valor) if valor is not None else None
+
+    async def set(self, clave: str, valor: Any, ttl: float, rango: Tuple[str, str]):
+        ahora = time.time()
+        await self.cliente.set(
+            f"{self.prefijo}:{clave}", json.dumps(valor, default=str), ex=max(1, int(ttl))
+        )
+        await self.cliente.zadd(self.indice, {f"{clave}|{rango[0]}|{rango[1]}": ahora + max(1, int(ttl))})
+        await self.cliente.zremrangebyscore(self.indice, "-inf", ahora)
+
+    async def invalidar(self, dias: Iterable[str]) -> int:
+        dias = list(dias)
+        miembros = []
+        for miembro in await self.cliente.zrangebyscore(self.indice, time.time(), "+inf"):
+            miembro = miembro.decode() if isinstance(miembro, bytes) else miembro
+            clave, inicio, fin = miembro.rsplit("|", 2)
+            if _intersecta((inicio, fin), dias):
+                miembros.append((miembro, clave))
+        if miembros:
+            await self.cliente.delete(*[f"{self.prefijo}:{clave}" for _, clave in miembros])
+            await self.cliente.zrem(self.indice, *[miembro for miembro, _ in miembros])
+        return len(miembros)
+
+
+class GeneracionesInvalidacion:
+    """Generación de invalidación por día, compartida entre procesos en schema_info.
+
+    Cada invalidación incrementa un contador global y anota en los días
+    afectados la generación en que ocurrió. Una entrada local guardada con la
+    generación g sigue siendo válida mientras ningún día de su rango tenga una
+    invalidación posterior a g. El documento se relee a lo sumo cada
+    verificar_segundos y los días cuya última invalidación es más vieja que
+    retencion_segundos (el TTL más largo de las entradas) se podan.
+    """
+
+    def __init__(self, nombre: str, retencion_segundos: float, verificar_segundos: float = 1.0):
+        self.id = f"cache:{nombre}"
+        self.retencion_ms = int(retencion_segundos * 1000)
+        self.verificar_segundos = verificar_segundos
+        self.generacion = 0
+        self.dias: Dict[str, int] = {}
+        self._leido = float("-inf")
+
+    def _cargar(self, documento: Optional[dict]):
+        documento = documento or {}
+        self.generacion = documento.get("generacion", 0)
+        self.dias = {dia: marca["g"] for dia, marca in documento.get("dias", {}).items()}
+        self._leido = time.monotonic()
+
+    async def actualizar(self):
+        if time.monotonic() - self._leido < self.verificar_segundos:
+            return
+        self._cargar(await get_database().schema_info.find_one({"_id": self.id}))
+
+    def vigente(self, rango: Tuple[str, str], generacion: int) -> bool:
+        return not any(g > generacion and _intersecta(rango, [dia]) for dia, g in self.dias.items())
+
+    async def invalidar(self, dias: Iterable[str]):
+        documento = await get_database().schema_info.find_one_and_update(
+            {"_id": self.id},
+            [
+                {"$set": {"generacion": {"$add": [{"$ifNull": ["$generacion", 0]}, 1]}}},
+                {"$set": {"dias": {"$arrayToObject": {"$filter": {
+                    "input": {"$objectToArray": {"$ifNull": ["$dias", {}]}},
+                    "cond": {"$gt": ["$$this.v.t", {"$subtract": ["$$NOW", self.retencion_ms]}]},
+                }}}}},
+                {"$set": {"dias": {"$mergeObjects": [
+                    "$dias", {dia: {"g": "$generacion", "t": "$$NOW"} for dia in dias},
+                ]}}},
+            ],
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
+        self._cargar(documento)
+
+
+def crear_almacen_compartido(prefijo: str):
+    """Almacén compartido si REDIS_URL está configurada y redis instalado; si no, None"""
+    url = os.getenv("REDIS_URL")
+    if not url:
+        return None
+    if redis_asyncio is None:
+        logging.warning("REDIS_URL configurada pero el paquete redis no está instalado; usando solo caché local")
+        return None
+    return AlmacenRedis(url, prefijo)
+
+
+class ResultCache:
+    """Caché de resultados por rango de fechas.
+
+    Combina un LRU en proceso con un almacén compartido opcional (Redis); sin
+    Redis el LRU local hace de sustituto. Antes de usar una entrada local se
+    comprueba que ningún proceso haya invalidado alguno de sus días después de
+    guardarla (GeneracionesInvalidacion). Las peticiones concurrentes con la
+    misma clave comparten un solo cálculo. Los rangos que incluyen el día en
+    curso expiran pronto; los cerrados solo caducan por TTL o por invalidación
+    de alguno de sus días.
+    """
+
+    def __init__(
+        self,
+        nombre: str,
+        ttl_cerrado: float = 3600,
+        ttl_abierto: float = 60,
+        max_entradas: int = 256,
+        verificar_segundos: float = 1.0,
+    ):
+        self.nombre = nombre
+        self.ttl_cerrado = ttl_cerrado
+        self.ttl_abierto = ttl_abierto
+        self.local = AlmacenLocal(max_entradas)
+        self.compartido = crear_almacen_compartido(f"cache:{nombre}")
+        # Invalidaciones hechas por otros procesos, para no servir entradas locales viejas
+        self.generaciones = GeneracionesInvalidacion(
+            nombre, max(ttl_cerrado, ttl_abierto), verificar_segundos
+        )
+        self._en_curso: Dict[str, asyncio.Future] = {}
+        # Cambia con cada invalidación para no guardar resultados calculados antes de ella
+        self._generacion = 0
+        self.metricas = {
+            "hits_local": 0,
+            "hits_compartido": 0,
+            "misses": 0,
+            "compartidas": 0,
+            "invalidaciones": 0,
+            "errores_compartido": 0,
+            "invalidadas_por_otro_proceso": 0,
+        }
+
+    async def obtener(
+        self,
+        consulta: str,
+        inicio: datetime,
+        fin: datetime,
+        calcular: Callable[[], Awaitable[Any]],
+    ) -> Any:
+        """Retornar el resultado de consulta para [inicio, fin), calculándolo si no está en caché"""
+        rango = (inicio.strftime(FORMATO_DIA), fin.strftime(FORMATO_DIA))
+        clave = f"{consulta}:{rango[0]}:{rango[1]}"
+
+        await self._actualizar_generaciones()
+        entrada = await self.local.get(clave)
+        if entrada is not None:
+            generacion_entrada, valor = entrada
+            if self.generaciones.vigente(rango, generacion_entrada):
+                self.metricas["hits_local"] += 1
+                return valor
+            self.metricas["invalidadas_por_otro_proceso"] += 1
+
+        if clave in self._en_curso:
+            self.metricas["compartidas"] += 1
+            return await asyncio.shield(self._en_curso[clave])
+
+        futuro = asyncio.get_running_loop().create_future()
+        self._en_curso[clave] = futuro
+        ttl = self._ttl(fin)
+        generacion = self._generacion
+        # Leída antes de calcular: si otro proceso invalida durante el cálculo, la entrada queda vencida
+        generacion_compartida = self.generaciones.generacion
+        try:
+            valor = await self._obtener_compartido(clave)
+            if valor is not None:
+                self.metricas["hits_compartido"] += 1
+            else:
+                self.metricas["misses"] += 1
+                valor = await calcular()
+                if generacion == self._generacion:
+                    await self._guardar_compartido(clave, valor, ttl, rango)
+            if generacion == self._generacion:
+                await self.local.set(clave, (generacion_compartida, valor), ttl, rango)
+            futuro.set_result(valor)
+            return valor
+        except asyncio.CancelledError:
+            futuro.cancel()
+            raise
+        except Exception as e:
+            futuro.set_exception(e)
+            # Evitar el aviso de excepción no recuperada si nadie más esperaba
+            futuro.exception()
+            raise
+        finally:
+            del self._en_curso[clave]
+
+    def _ttl(self, fin: datetime) -> float:
+        hoy = datetime.now()
+        hoy = datetime(hoy.year, hoy.month, hoy.day)
+        return self.ttl_abierto if fin > hoy else self.ttl_cerrado
+
+    async def _actualizar_generaciones(self):
+        try:
+            await self.generaciones.actualizar()
+        except Exception as e:
+            # Sin la generación compartida no se puede confiar en el LRU local
+            self.metricas["errores_compartido"] += 1
+            logging.warning(f"No se pudo leer la generación de invalidación: {str(e)}")
+            self.local = AlmacenLocal(self.local.max_entradas)
+
+    async def _obtener_compartido(self, clave: str) -> Optional[Any]:
+        if not self.compartido:
+            return None
+        try:
+            return await self.compartido.get(clave)
+        except Exception as e:
+            self.metricas["errores_compartido"] += 1
+            logging.warning(f"Caché compartida no disponible: {str(e)}")
+            return None
+
+    async def _guardar_compartido(self, clave: str, valor: Any, ttl: float, rango: Tuple[str, str]):
+        if not self.compartido:
+            return
+        try:
+            await self.compartido.set(clave, valor, ttl, rango)
+        except Exception as e:
+            self.metricas["errores_compartido"] += 1
+            logging.warning(f"No se pudo guardar en la caché compartida: {str(e)}")
+
+    async def invalidar_dias(self, dias: Iterable[str]):
+        """Eliminar las entradas cuyo rango incluye alguno de los días dados"""
+        dias = list(dias)
+        if not dias:
+            return
+        self._generacion += 1
+        eliminadas = await self.local.invalidar(dias)
+        try:
+            await self.generaciones.invalidar(dias)
+        except Exception as e:
+            self.metricas["errores_compartido"] += 1
+            logging.warning(f"No se pudo publicar la invalidación a los demás procesos: {str(e)}")
+        if self.compartido:
+            try:
+                eliminadas += await self.compartido.invalidar(dias)
+            except Exception as e:
+                self.metricas["errores_compartido"] += 1
+                logging.warning(f"No se pudo invalidar la caché compartida: {str(e)}")
+        self.metricas["invalidaciones"] += eliminadas
+
+    def resumen(self) -> dict:
+        """Métricas de uso con la tasa de aciertos"""
+        hits = self.metricas["hits_local"] + self.metricas["hits_compartido"]
+        consultas = hits + self.metricas["misses"] + self.metricas["compartidas"]
+        return {
+            "cache": self.nombre,
+            "backend": "redis" if self.compartido else "local",
+            **self.metricas,
+            "entradas_locales": len(self.local),
+            "tasa_aciertos": round((hits + self.metricas["compartidas"]) / consultas * 100, 2)
+            if consultas else 0,
+        }
+
+
+estadisticas_cache = ResultCache(
+    "estadisticas",
+    ttl_cerrado=float(os.getenv("ESTADISTICAS_CACHE_TTL", "3600")),
+    ttl_abierto=float(os.getenv("ESTADISTICAS_CACHE_TTL_ABIERTO", "60")),
+    max_entradas=int(os.getenv("ESTADISTICAS_CACHE_MAX_ENTRADAS", "256")),
+    verificar_segundos=float(os.getenv("ESTADISTICAS_CACHE_VERIFICAR_SEGUNDOS", "1")),
+)
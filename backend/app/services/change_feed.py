@@ -0,0 +1,150 @@
+import asyncio
+import logging
+import os
+from datetime import datetime
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from pymongo.errors import OperationFailure, PyMongoError
+
+from app.database import get_database
+
+# Código de error de MongoDB cuando el servidor no es un replica set
+CHANGE_STREAMS_NO_SOPORTADOS = 40573
+
+Handler = Callable[[str, str, dict], Awaitable[None]]
+
+
+class ChangeFeed:
+    """Distribuye los cambios de colecciones a los suscriptores.
+
+    Usa change streams cuando el servidor es un replica set y, si no, consulta
+    periódicamente los documentos con fecha_actualizacion posterior a la última vista.
+    """
+
+    def __init__(self, colecciones: List[str], intervalo_polling: float = 5.0):
+        self.colecciones = colecciones
+        self.intervalo_polling = intervalo_polling
+        self.handlers: List[Handler] = []
+        self.modo: Optional[str] = None
+        self._tarea: Optional[asyncio.Task] = None
+        self._resume_token = None
+        self._marcas: Dict[str, datetime] = {}
+
+    def suscribir(self, handler: Handler):
+        """Registrar una corrutina handler(coleccion, operacion, documento)"""
+        if handler not in self.handlers:
+            self.handlers.append(handler)
+
+    async def start(self):
+        """Iniciar el consumidor en segundo plano"""
+        if self._tarea is None or self._tarea.done():
+            self._tarea = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Detener el consumidor"""
+        if self._tarea:
+            self._tarea.cancel()
+            try:
+                await self._tarea
+            except asyncio.CancelledError:
+                pass
+            self._tarea = None
+
+    async def _notificar(self, coleccion: str, operacion: str, documento: dict):
+        for handler in self.handlers:
+            try:
+                await handler(coleccion, operacion, documento)
+            except Exception as e:
+                logging.error(f"Error procesando cambio de {coleccion}: {str(e)}")
+
+    async def _run(self):
+        try:
+            await self._consumir_change_stream()
+        except OperationFailure as e:
+            if e.code != CHANGE_STREAMS_NO_SOPORTADOS:
+                raise
+            logging.info("Change streams no disponibles; usando polling por fecha_actualizacion")
+            await self._consumir_polling()
+
+    async def _consumir_change_stream(self):
+        db = get_database()
+        pipeline = [
+            {"$match": {
+                "ns.coll": {"$in": self.colecciones},
+                "operationType": {"$in": ["insert", "update", "replace", "delete"]},
+            }}
+        ]
+        while True:
+            try:
+                async with db.watch(
+                    pipeline,
+                    full_document="updateLookup",
+                    resume_after=self._resume_token,
+                ) as stream:
+                    self.modo = "change_stream"
+                    logging.info("Change feed escuchando change streams")
+                    async for cambio in stream:
+                        self._resume_token = stream.resume_token
+                        documento = cambio.get("fullDocument") or cambio.get("documentKey", {})
+                        await self._notificar(
+                            cambio["ns"]["coll"], cambio["operationType"], documento
+                        )
+            except OperationFailure as e:
+                if e.code == CHANGE_STREAMS_NO_SOPORTADOS:
+                    raise
+                logging.error(f"Change stream interrumpido: {str(e)}")
+                await asyncio.sleep(self.intervalo_polling)
+            except PyMongoError as e:
+                logging.error(f"Change stream interrumpido: {str(e)}")
+                await asyncio.sleep(self.intervalo_polling)
+
+    async def _cargar_marcas(self):
+        """Marcas guardadas en schema_info para retomar los cambios hechos mientras el proceso no corría"""
+        db = get_database()
+        estado = await db.schema_info.find_one({"_id": "change_feed"}) or {}
+        guardadas = estado.get("marcas", {})
+        ahora = datetime.now()
+        for coleccion in self.colecciones:
+            self._marcas.setdefault(coleccion, guardadas.get(coleccion, ahora))
+
+    async def _guardar_marcas(self, colecciones: List[str]):
+        # $max: varios procesos pueden guardar a la vez y la marca nunca retrocede
+        db = get_database()
+        await db.schema_info.update_one(
+            {"_id": "change_feed"},
+            {"$max": {f"marcas.{coleccion}": self._marcas[coleccion] for coleccion in colecciones}},
+            upsert=True,
+        )
+
+    async def _consumir_polling(self):
+        db = get_database()
+        self.modo = "polling"
+        await self._cargar_marcas()
+
+        while True:
+            cambiadas = []
+            for coleccion in self.colecciones:
+                try:
+                    marca = self._marcas[coleccion]
+                    cursor = db[coleccion].find(
+                        {"fecha_actualizacion": {"$gt": marca}}
+                    ).sort("fecha_actualizacion", 1).limit(500)
+                    async for documento in cursor:
+                        self._marcas[coleccion] = documento["fecha_actualizacion"]
+                        await self._notificar(coleccion, "update", documento)
+                    if self._marcas[coleccion] != marca:
+                        cambiadas.append(coleccion)
+                except PyMongoError as e:
+                    logging.error(f"Error consultando cambios de {coleccion}: {str(e)}")
+            if cambiadas:
+                try:
+                    await self._guardar_marcas(cambiadas)
+                except PyMongoError as e:
+                    logging.error(f"Error guardando las marcas del change feed: {str(e)}")
+            await asyncio.sleep(self.intervalo_polling)
+
+
+change_feed = ChangeFeed(
+    ["pacientes", "estudios", "citas", "informes"],
+    intervalo_polling=float(os.getenv("CHANGE_FEED_POLL_INTERVAL", "5")),
+)
@@ -1,26 +1,224 @@
+import asyncio
 import smtplib
+import time
+from collections import deque
+from email.message import Message
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 import os
 from dotenv import load_dotenv
 import logging
-from typing import Optional
+from typing import Deque, List, Optional
+
+try:
+    import aiosmtplib
+except ImportError:
+    aiosmtplib = None
+
+from app.services.plantilla_service import plantilla_service
+
+# Errores que indican que el servidor cerró una conexión reutilizada
+ERRORES_DESCONEXION = (smtplib.SMTPServerDisconnected, ConnectionError) + (
+    (aiosmtplib.SMTPServerDisconnected,) if aiosmtplib else ()
+)
 
 load_dotenv()
 
+
+class ConexionSMTP:
+    """Sesión SMTP abierta; usa aiosmtplib si está instalado y si no smtplib en un hilo"""
+
+    def __init__(self, servidor: str, puerto: int, usuario: Optional[str], password: Optional[str],
+                 starttls: bool, timeout: float):
+        self.servidor = servidor
+        self.puerto = puerto
+        self.usuario = usuario
+        self.password = password
+        self.starttls = starttls
+        self.timeout = timeout
+        self.mensajes = 0
+        self.ultimo_uso = time.monotonic()
+        self._cliente = None
+
+    async def abrir(self):
+        if aiosmtplib:
+            self._cliente = aiosmtplib.SMTP(
+                hostname=self.servidor,
+                port=self.puerto,
+                timeout=self.timeout,
+                use_tls=self.puerto == 465,
+                start_tls=self.starttls and self.puerto != 465,
+            )
+            await self._cliente.connect()
+            if self.usuario and self.password:
+                await self._cliente.login(self.usuario, self.password)
+        else:
+            self._cliente = await asyncio.to_thread(self._abrir_sync)
+
+    def _abrir_sync(self) -> smtplib.SMTP:
+        if self.puerto == 465:
+            cliente = smtplib.SMTP_SSL(self.servidor, self.puerto, timeout=self.timeout)
+        else:
+            cliente = smtplib.SMTP(self.servidor, self.puerto, timeout=self.timeout)
+            if self.starttls:
+                cliente.starttls()
+        if self.usuario and self.password:
+            cliente.login(self.usuario, self.password)
+        return cliente
+
+    async def enviar(self, mensaje: Message):
+        if aiosmtplib:
+            await self._cliente.send_message(mensaje)
+        else:
+            await asyncio.to_thread(self._cliente.send_message, mensaje)
+        self.mensajes += 1
+        self.ultimo_uso = time.monotonic()
+
+    async def cerrar(self):
+        try:
+            if aiosmtplib:
+                await self._cliente.quit()
+            else:
+                await asyncio.to_thread(self._cliente.quit)
+        except Exception:
+            # La conexión ya estaba cerrada por el servidor
+            pass
+
+
+class PoolSMTP:
+    """Conexiones SMTP reutilizadas entre mensajes.
+
+    Como máximo max_conexiones envíos simultáneos, cada uno por una conexión
+    libre o nueva. Una conexión se descarta tras max_mensajes envíos o si
+    estuvo inactiva más de keepalive segundos; si el servidor la cerró, el
+    mensaje se reintenta una vez con una conexión nueva.
+    """
+
+    def __init__(self, servidor: str, puerto: int, usuario: Optional[str] = None,
+                 password: Optional[str] = None, starttls: bool = True, max_conexiones: int = 4,
+                 max_mensajes: int = 100, keepalive: float = 60, timeout: float = 30):
+        self.config = (servidor, puerto, usuario, password, starttls, timeout)
+        self.max_conexiones = max_conexiones
+        self.max_mensajes = max_mensajes
+        self.keepalive = keepalive
+        self._libres: Deque[ConexionSMTP] = deque()
+        self._semaforo: Optional[asyncio.Semaphore] = None
+        self.creadas = 0
+        self.enviados = 0
+        self.errores = 0
+
+    def _semaforo_actual(self) -> asyncio.Semaphore:
+        # Se crea dentro del event loop que lo usa
+        if self._semaforo is None:
+            self._semaforo = asyncio.Semaphore(self.max_conexiones)
+        return self._semaforo
+
+    async def _obtener(self) -> ConexionSMTP:
+        while self._libres:
+            conexion = self._libres.pop()
+            if time.monotonic() - conexion.ultimo_uso < self.keepalive:
+                return conexion
+            await conexion.cerrar()
+        conexion = ConexionSMTP(*self.config)
+        await conexion.abrir()
+        self.creadas += 1
+        return conexion
+
+    async def _devolver(self, conexion: ConexionSMTP):
+        if conexion.mensajes >= self.max_mensajes:
+            await conexion.cerrar()
+        else:
+            self._libres.append(conexion)
+
+    async def enviar(self, mensaje: Message):
+        """Enviar un mensaje por una conexión del pool; propaga el error si falla"""
+        async with self._semaforo_actual():
+            for intento in range(2):
+                conexion = await self._obtener()
+                try:
+                    await conexion.enviar(mensaje)
+                except ERRORES_DESCONEXION:
+                    await conexion.cerrar()
+                    if intento:
+                        self.errores += 1
+                        raise
+                    continue
+                except Exception:
+                    await conexion.cerrar()
+                    self.errores += 1
+                    raise
+                self.enviados += 1
+                await self._devolver(conexion)
+                return
+
+    async def enviar_lote(self, mensajes: List[Message]) -> List[bool]:
+        """Enviar varios mensajes en paralelo hasta max_conexiones a la vez"""
+        resultados = await asyncio.gather(
+            *(self.enviar(mensaje) for mensaje in mensajes), return_exceptions=True
+        )
+        for resultado in resultados:
+            if isinstance(resultado, Exception):
+                logging.error(f"Error enviando email: {resultado}")
+        return [not isinstance(resultado, Exception) for resultado in resultados]
+
+    async def cerrar(self):
+        """Cerrar las conexiones libres (al apagar la aplicación)"""
+        while self._libres:
+            await self._libres.pop().cerrar()
+
+    def resumen(self) -> dict:
+        return {
+            "transporte": "aiosmtplib" if aiosmtplib else "smtplib",
+            "conexiones_libres": len(self._libres),
+            "conexiones_creadas": self.creadas,
+            "enviados": self.enviados,
+            "errores": self.errores,
+        }
+
+
+smtp_pool = PoolSMTP(
+    servidor=os.getenv("SMTP_SERVER", "smtp.gmail.com"),
+    puerto=int(os.getenv("SMTP_PORT") or 587),
+    usuario=os.getenv("SMTP_USERNAME"),
+    password=os.getenv("SMTP_PASSWORD"),
+    starttls=os.getenv("SMTP_STARTTLS", "True").lower() == "true",
+    max_conexiones=int(os.getenv("SMTP_POOL_SIZE", "4")),
+    max_mensajes=int(os.getenv("SMTP_MAX_MENSAJES_CONEXION", "100")),
+    keepalive=float(os.getenv("SMTP_KEEPALIVE", "60")),
+)
+
+
 class EmailService:
-    def __init__(self):
+    def __init__(self, pool: PoolSMTP = smtp_pool):
         self.smtp_server = os.getenv("SMTP_SERVER", "smtp.gmail.com")
         smtp_port = os.getenv("SMTP_PORT", "587")
         self.smtp_port = int(smtp_port) if smtp_port else 587
         self.smtp_username = os.getenv("SMTP_USERNAME")
         self.smtp_password = os.getenv("SMTP_PASSWORD")
         self.from_name = os.getenv("FROM_NAME", "Centro de Imagenología")
+        self.pool = pool
         
         # Verificar configuración
         if not self.smtp_username or not self.smtp_password:
             logging.warning("Configuración SMTP incompleta. Los emails no se enviarán.")
     
+    def crear_mensaje(self, to_email: str, subject: str, body: str, html_body: Optional[str] = None) -> Message:
+        """Armar el mensaje con versión de texto plano y HTML opcional"""
+        msg = MIMEMultipart('alternative')
+        msg['From'] = f"{self.from_name} <{self.smtp_username}>"
+        msg['To'] = to_email
+        msg['Subject'] = subject
+        
+        # Agregar versión de texto plano
+        text_part = MIMEText(body, 'plain', 'utf-8')
+        msg.attach(text_part)
+        
+        # Agregar versión HTML si se proporciona
+        if html_body:
+            html_part = MIMEText(html_body, 'html', 'utf-8')
+            msg.attach(html_part)
+        return msg
+    
     async def send_email(self, to_email: str, subject: str, body: str, html_body: Optional[str] = None) -> bool:
         """Enviar email general"""
         try:
@@ -28,25 +226,8 @@ class EmailService:
                 logging.error("Configuración SMTP incompleta")
                 return False
             
-            msg = MIMEMultipart('alternative')
-            msg['From'] = f"{self.from_name} <{self.smtp_username}>"
-            msg['To'] = to_email
-            msg['Subject'] = subject
-            
-            # Agregar versión de texto plano
-            text_part = MIMEText(body, 'plain', 'utf-8')
-            msg.attach(text_part)
-            
-            # Agregar versión HTML si se proporciona
-            if html_body:
-                html_part = MIMEText(html_body, 'html', 'utf-8')
-                msg.attach(html_part)
-            
-            # Enviar email
-            with smtplib.SMTP(self.smtp_server, self.smtp_port) as server:
-                server.starttls()
-                server.login(self.smtp_username, self.smtp_password)
-                server.send_message(msg)
+            # Enviar por una conexión del pool, sin bloquear el event loop
+            await self.pool.enviar(self.crear_mensaje(to_email, subject, body, html_body))
             
             logging.info(f"Email enviado exitosamente a {to_email}")
             return True
@@ -55,145 +236,47 @@ class EmailService:
             logging.error(f"Error enviando email a {to_email}: {str(e)}")
             return False
 
+    async def send_bulk(self, mensajes: List[Message]) -> List[bool]:
+        """Enviar un lote de mensajes reutilizando las conexiones del pool"""
+        if not self.smtp_username or not self.smtp_password:
+            logging.error("Configuración SMTP incompleta")
+            return [False] * len(mensajes)
+        return await self.pool.enviar_lote(mensajes)
+
     async def send_appointment_reminder(self, paciente_email: str, paciente_nombre: str, 
                                       fecha_cita: str, tipo_estudio: str) -> bool:
         """Enviar recordatorio de cita"""
-        subject = f"Recordatorio de cita para {tipo_estudio}"
-        
-        body = f"""
-        Estimado/a {paciente_nombre},
-        
-        Le recordamos que tiene programada una cita para {tipo_estudio} 
-        el día {fecha_cita}.
-        
-        Por favor, presentarse 15 minutos antes de la hora programada.
-        
-        Saludos cordiales,
-        {self.from_name}
-        """
-        
-        html_body = f"""
-        <html>
-        <body>
-            <h2>Recordatorio de Cita</h2>
-            <p>Estimado/a <strong>{paciente_nombre}</strong>,</p>
-            <p>Le recordamos que tiene programada una cita para <strong>{tipo_estudio}</strong> 
-            el día <strong>{fecha_cita}</strong>.</p>
-            <p>Por favor, presentarse 15 minutos antes de la hora programada.</p>
-            <br>
-            <p>Saludos cordiales,<br>
-            <strong>{self.from_name}</strong></p>
-        </body>
-        </html>
-        """
-        
-        return await self.send_email(paciente_email, subject, body, html_body)
+        return await self.send_template(paciente_email, "recordatorio_cita", {
+            "paciente_nombre": paciente_nombre,
+            "fecha_cita": fecha_cita,
+            "tipo_estudio": tipo_estudio,
+        })
 
     async def send_study_results(self, paciente_email: str, paciente_nombre: str, 
                                tipo_estudio: str, fecha_estudio: str) -> bool:
         """Enviar notificación de resultados de estudio"""
-        subject = f"Resultados disponibles - {tipo_estudio}"
-        
-        body = f"""
-        Estimado/a {paciente_nombre},
-        
-        Los resultados de su estudio de {tipo_estudio} realizado el {fecha_estudio} 
-        están disponibles en su portal de paciente.
-        
-        Por favor, inicie sesión para consultarlos.
-        
-        Saludos cordiales,
-        {self.from_name}
-        """
-        
-        html_body = f"""
-        <html>
-        <body>
-            <h2>Resultados Disponibles</h2>
-            <p>Estimado/a <strong>{paciente_nombre}</strong>,</p>
-            <p>Los resultados de su estudio de <strong>{tipo_estudio}</strong> 
-            realizado el <strong>{fecha_estudio}</strong> están disponibles 
-            en su portal de paciente.</p>
-            <p>Por favor, inicie sesión para consultarlos.</p>
-            <br>
-            <p>Saludos cordiales,<br>
-            <strong>{self.from_name}</strong></p>
-        </body>
-        </html>
-        """
-        
-        return await self.send_email(paciente_email, subject, body, html_body)
+        return await self.send_template(paciente_email, "resultados_estudio", {
+            "paciente_nombre": paciente_nombre,
+            "tipo_estudio": tipo_estudio,
+            "fecha_estudio": fecha_estudio,
+        })
 
     async def send_welcome_message(self, paciente_email: str, paciente_nombre: str) -> bool:
         """Enviar mensaje de bienvenida"""
-        subject = "Bienvenido a nuestro centro médico"
-        
-        body = f"""
-        Estimado/a {paciente_nombre},
-        
-        Le damos la bienvenida a {self.from_name}.
-        
-        Su cuenta ha sido creada exitosamente y puede acceder a su portal 
-        de paciente para gestionar sus citas y consultar resultados.
-        
-        Saludos cordiales,
-        {self.from_name}
-        """
-        
-        html_body = f"""
-        <html>
-        <body>
-            <h2>¡Bienvenido!</h2>
-            <p>Estimado/a <strong>{paciente_nombre}</strong>,</p>
-            <p>Le damos la bienvenida a <strong>{self.from_name}</strong>.</p>
-            <p>Su cuenta ha sido creada exitosamente y puede acceder a su portal 
-            de paciente para gestionar sus citas y consultar resultados.</p>
-            <br>
-            <p>Saludos cordiales,<br>
-            <strong>{self.from_name}</strong></p>
-        </body>
-        </html>
-        """
-        
-        return await self.send_email(paciente_email, subject, body, html_body)
+        return await self.send_template(paciente_email, "bienvenida", {"paciente_nombre": paciente_nombre})
 
     async def send_password_reset(self, paciente_email: str, reset_token: str) -> bool:
         """Enviar enlace para restablecer contraseña"""
-        subject = "Restablecimiento de contraseña"
-        
         reset_url = f"{os.getenv('FRONTEND_URL', 'http://localhost:4200')}/reset-password?token={reset_token}"
-        
-        body = f"""
-        Ha solicitado restablecer su contraseña.
-        
-        Para continuar, haga clic en el siguiente enlace:
-        {reset_url}
-        
-        Este enlace expirará en 1 hora.
-        
-        Si no solicitó este cambio, ignore este mensaje.
-        
-        Saludos cordiales,
-        {self.from_name}
-        """
-        
-        html_body = f"""
-        <html>
-        <body>
-            <h2>Restablecimiento de Contraseña</h2>
-            <p>Ha solicitado restablecer su contraseña.</p>
-            <p>Para continuar, haga clic en el siguiente enlace:</p>
-            <p><a href="{reset_url}">Restablecer Contraseña</a></p>
-            <p>Este enlace expirará en 1 hora.</p>
-            <p>Si no solicitó este cambio, ignore este mensaje.</p>
-            <br>
-            <p>Saludos cordiales,<br>
-            <strong>{self.from_name}</strong></p>
-        </body>
-        </html>
-        """
-        
-        return await self.send_email(paciente_email, subject, body, html_body)
+        return await self.send_template(paciente_email, "restablecer_password", {"reset_url": reset_url})
+
+    async def send_template(self, to_email: str, plantilla: str, variables: dict,
+                            locale: Optional[str] = None) -> bool:
+        """Enviar un email renderizado desde una plantilla"""
+        mensaje = await plantilla_service.render(
+            plantilla, {"centro": self.from_name, **variables}, locale, variantes=("asunto", "texto", "html")
+        )
+        return await self.send_email(to_email, mensaje.asunto, mensaje.texto, mensaje.html)
 
     def test_connection(self) -> bool:
         """Probar conexión SMTP"""
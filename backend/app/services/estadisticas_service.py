@@ -0,0 +1,566 @@
+import asyncio
+import logging
+import math
+import os
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, List, Optional
+
+from pymongo import UpdateOne
+from pymongo.errors import DuplicateKeyError
+
+from app.database import get_database
+from app.services.cache_service import estadisticas_cache
+from app.services.tarifas_service import tarifas_service
+
+# Incrementar cuando cambie el contenido de los buckets para recalcularlos
+ROLLUP_VERSION = 4
+
+FORMATO_DIA = "%Y-%m-%d"
+
+# Horario de atención de las salas para calcular la disponibilidad (lunes = 0)
+HORA_APERTURA = int(os.getenv("HORA_APERTURA", "7"))
+HORA_CIERRE = int(os.getenv("HORA_CIERRE", "19"))
+DIAS_ATENCION = {int(d) for d in os.getenv("DIAS_ATENCION", "0,1,2,3,4,5").split(",") if d.strip()}
+
+DURACION_CITA_DEFECTO = 30
+
+# Minutos de cada cita repartidos en las horas del día que ocupa
+ETAPAS_MINUTOS_POR_HORA = [
+    {"$addFields": {
+        "_inicio": {"$add": [
+            {"$multiply": [{"$hour": "$fecha_cita"}, 60]}, {"$minute": "$fecha_cita"}
+        ]},
+        "_duracion": {"$ifNull": ["$duracion_minutos", DURACION_CITA_DEFECTO]},
+    }},
+    {"$addFields": {"_fin": {"$min": [{"$add": ["$_inicio", "$_duracion"]}, 1440]}}},
+    {"$addFields": {"_horas": {"$filter": {
+        "input": {"$map": {
+            "input": {"$range": [0, 24]},
+            "as": "h",
+            "in": {
+                "hora": "$$h",
+                "minutos": {"$max": [0, {"$subtract": [
+                    {"$min": ["$_fin", {"$multiply": [{"$add": ["$$h", 1]}, 60]}]},
+                    {"$max": ["$_inicio", {"$multiply": ["$$h", 60]}]},
+                ]}]},
+            },
+        }},
+        "as": "x",
+        "cond": {"$gt": ["$$x.minutos", 0]},
+    }}}},
+    {"$unwind": "$_horas"},
+]
+
+
+def inicio_dia(fecha: datetime) -> datetime:
+    return datetime(fecha.year, fecha.month, fecha.day)
+
+
+def clave_dia(fecha: datetime) -> str:
+    return fecha.strftime(FORMATO_DIA)
+
+
+def dias_en_rango(inicio: datetime, fin: datetime) -> List[str]:
+    """Días [inicio, fin) como claves YYYY-MM-DD"""
+    dias = []
+    dia = inicio_dia(inicio)
+    while dia < fin:
+        dias.append(clave_dia(dia))
+        dia += timedelta(days=1)
+    return dias
+
+
+def tramos_contiguos(dias: List[str]) -> List[List[str]]:
+    """Separar días YYYY-MM-DD ordenados en tramos de días consecutivos"""
+    tramos: List[List[str]] = []
+    anterior = None
+    for dia in dias:
+        fecha = datetime.strptime(dia, FORMATO_DIA)
+        if anterior is None or fecha - anterior != timedelta(days=1):
+            tramos.append([])
+        tramos[-1].append(dia)
+        anterior = fecha
+    return tramos
+
+
+# Histogramas de tiempos: el bucket i cubre (BASE^(i-1), BASE^i] minutos, error relativo <= 5%
+BASE_HISTOGRAMA = 1.05
+
+
+def _lookup_estudio(campos: List[str]) -> List[dict]:
+    """Unir el estudio referido por estudio_id (id canónico) usando el índice de _id"""
+    return [
+        {"$lookup": {
+            "from": "estudios",
+            "let": {"id": {"$convert": {
+                "input": "$estudio_id", "to": "objectId", "onError": None, "onNull": None
+            }}},
+            "pipeline": [
+                {"$match": {"$expr": {"$eq": ["$_id", "$$id"]}}},
+                {"$project": {campo: 1 for campo in campos}},
+            ],
+            "as": "_estudio",
+        }},
+        {"$unwind": "$_estudio"},
+    ]
+
+
+def tramos_tiempos(rango: dict) -> Dict[str, dict]:
+    """Tramos del flujo solicitud → programación → realización → informe → firma.
+
+    Cada tramo se atribuye al día en que termina (campo fin).
+    """
+    return {
+        "solicitud_programacion": {
+            "coleccion": "citas",
+            "match": {"fecha_creacion": rango, "estudio_id": {"$ne": None}},
+            "previas": _lookup_estudio(["fecha_solicitud", "tipo_estudio"]),
+            "inicio": "$_estudio.fecha_solicitud",
+            "fin": "fecha_creacion",
+            "tipo": "$_estudio.tipo_estudio",
+        },
+        "programacion_realizacion": {
+            "coleccion": "estudios",
+            "match": {"estado": "completado", "fecha_realizacion": rango},
+            "previas": [
+                {"$lookup": {
+                    "from": "citas",
+                    "let": {"id": {"$toString": "$_id"}},
+                    "pipeline": [
+                        {"$match": {"$expr": {"$eq": ["$estudio_id", "$$id"]}}},
+                        {"$sort": {"fecha_creacion": 1}},
+                        {"$limit": 1},
+                        {"$project": {"fecha_creacion": 1}},
+                    ],
+                    "as": "_cita",
+                }},
+                {"$unwind": "$_cita"},
+            ],
+            "inicio": "$_cita.fecha_creacion",
+            "fin": "fecha_realizacion",
+            "tipo": "$tipo_estudio",
+        },
+        "solicitud_realizacion": {
+            "coleccion": "estudios",
+            "match": {"estado": "completado", "fecha_realizacion": rango},
+            "previas": [],
+            "inicio": "$fecha_solicitud",
+            "fin": "fecha_realizacion",
+            "tipo": "$tipo_estudio",
+        },
+        # Los informes ya traen fecha y tipo del estudio en su snapshot
+        "realizacion_informe": {
+            "coleccion": "informes",
+            "match": {"fecha_creacion": rango},
+            "previas": [],
+            "inicio": "$estudio_fecha",
+            "fin": "fecha_creacion",
+            "tipo": "$estudio_tipo",
+        },
+        "informe_firma": {
+            "coleccion": "informes",
+            "match": {"fecha_firma": rango},
+            "previas": [],
+            "inicio": "$fecha_creacion",
+            "fin": "fecha_firma",
+            "tipo": "$estudio_tipo",
+        },
+        "solicitud_firma": {
+            "coleccion": "informes",
+            "match": {"fecha_firma": rango},
+            "previas": _lookup_estudio(["fecha_solicitud"]),
+            "inicio": "$_estudio.fecha_solicitud",
+            "fin": "fecha_firma",
+            "tipo": "$estudio_tipo",
+        },
+    }
+
+
+def etapas_minutos(tramo: dict) -> List[dict]:
+    """Etapas que dejan en _minutos la duración del tramo y en _tipo el tipo de estudio"""
+    return [
+        {"$match": tramo["match"]},
+        *tramo["previas"],
+        {"$addFields": {
+            "_minutos": {"$divide": [{"$subtract": [f"${tramo['fin']}", tramo["inicio"]]}, 60000]},
+            "_tipo": tramo["tipo"],
+        }},
+        {"$match": {"_minutos": {"$gte": 0}}},
+    ]
+
+
+def facetas_tiempos(rango: dict) -> Dict[str, Dict[str, tuple]]:
+    """Facetas de histogramas de tiempos agrupadas por colección"""
+    indice = {"$cond": [
+        {"$lte": ["$_minutos", 1]},
+        0,
+        {"$ceil": {"$divide": [{"$ln": "$_minutos"}, math.log(BASE_HISTOGRAMA)]}},
+    ]}
+    facetas: Dict[str, Dict[str, tuple]] = {}
+    for etapa, tramo in tramos_tiempos(rango).items():
+        facetas.setdefault(tramo["coleccion"], {})[f"tiempos_{etapa}"] = (
+            etapas_minutos(tramo) + [{"$addFields": {"_b": indice}}],
+            tramo["fin"],
+            {"tipo": "$_tipo", "b": "$_b"},
+            {"cantidad": {"$sum": 1}, "minutos": {"$sum": "$_minutos"}},
+        )
+    return facetas
+
+
+def percentil(histograma: Dict[int, int], p: float) -> Optional[float]:
+    """Percentil p (0-100) en minutos: límite superior del bucket que lo contiene"""
+    total = sum(histograma.values())
+    if not total:
+        return None
+    objetivo = max(1, math.ceil(p / 100 * total))
+    acumulado = 0
+    for indice in sorted(histograma):
+        acumulado += histograma[indice]
+        if acumulado >= objetivo:
+            return BASE_HISTOGRAMA ** indice
+    return BASE_HISTOGRAMA ** max(histograma)
+
+
+def sumar_histogramas(buckets: Iterable[dict], etapa: str) -> Dict[str, dict]:
+    """Fusionar por tipo de estudio los histogramas diarios de un tramo"""
+    por_tipo: Dict[str, dict] = {}
+    for bucket in buckets:
+        for item in bucket.get(f"tiempos_{etapa}", []):
+            tipo = item["clave"].get("tipo")
+            acumulado = por_tipo.setdefault(tipo, {"cantidad": 0, "minutos": 0, "histograma": {}})
+            acumulado["cantidad"] += item["cantidad"]
+            acumulado["minutos"] += item["minutos"]
+            indice = int(item["clave"]["b"])
+            acumulado["histograma"][indice] = acumulado["histograma"].get(indice, 0) + item["cantidad"]
+    return por_tipo
+
+
+def horas_disponibles(inicio: datetime, fin: datetime) -> float:
+    """Horas de atención de una sala en [inicio, fin) según el horario configurado"""
+    horas_dia = max(0, HORA_CIERRE - HORA_APERTURA)
+    dias = [datetime.strptime(d, FORMATO_DIA) for d in dias_en_rango(inicio, fin)]
+    return sum(horas_dia for dia in dias if dia.weekday() in DIAS_ATENCION)
+
+
+def es_hora_atencion(dia: datetime, hora: int) -> bool:
+    return dia.weekday() in DIAS_ATENCION and HORA_APERTURA <= hora < HORA_CIERRE
+
+
+def sumar_por_clave(buckets: Iterable[dict], campo: str, valores=("cantidad",)) -> Dict:
+    """Sumar las listas [{clave, cantidad, ...}] de varios buckets diarios"""
+    totales: Dict = {}
+    for bucket in buckets:
+        for item in bucket.get(campo, []):
+            acumulado = totales.setdefault(item["clave"], {v: 0 for v in valores})
+            for valor in valores:
+                acumulado[valor] += item.get(valor, 0)
+    return totales
+
+
+class EstadisticasService:
+    """Rollups diarios de estudios y citas.
+
+    Cada día se guarda en estadisticas_diarias. Las escrituras marcan sus días
+    como sucios y los días sucios, faltantes o abiertos (hoy en adelante) se
+    recalculan desde las colecciones al consultarlos o con compactar().
+    """
+
+    def __init__(self):
+        self._soporta_percentile: Optional[bool] = None
+
+    async def _facetas_por_dia(
+        self, coleccion: str, match: dict, facetas: Dict[str, tuple]
+    ) -> Dict[str, Dict[str, List[dict]]]:
+        """Calcular varias agrupaciones por día con un solo recorrido de la colección.
+
+        facetas: {nombre: (etapas previas, campo_fecha, expresión clave, acumuladores)}
+        Retorna {nombre: {dia: [{clave, ...acumuladores}]}}.
+        """
+        db = get_database()
+        etapas = {}
+        for nombre, (previas, campo_fecha, clave, acumuladores) in facetas.items():
+            grupo = {
+                "_id": {
+                    "dia": {"$dateToString": {"format": FORMATO_DIA, "date": f"${campo_fecha}"}},
+                    "clave": clave,
+                }
+            }
+            grupo.update(acumuladores)
+            etapas[nombre] = list(previas) + [{"$group": grupo}]
+
+        pipeline = [{"$match": match}, {"$facet": etapas}]
+        resultado = await db[coleccion].aggregate(pipeline).to_list(length=1)
+        documento = resultado[0] if resultado else {}
+
+        metricas = {}
+        for nombre, (_, _, _, acumuladores) in facetas.items():
+            por_dia: Dict[str, List[dict]] = {}
+            for doc in documento.get(nombre, []):
+                item = {"clave": doc["_id"]["clave"]}
+                item.update({campo: doc[campo] for campo in acumuladores})
+                por_dia.setdefault(doc["_id"]["dia"], []).append(item)
+            metricas[nombre] = por_dia
+        return metricas
+
+    async def _calcular_dias(self, inicio: datetime, fin: datetime) -> Dict[str, dict]:
+        """Calcular los buckets de todos los días en [inicio, fin) desde los datos originales"""
+        rango = {"$gte": inicio, "$lt": fin}
+        conteo = {"cantidad": {"$sum": 1}}
+        # Precio vigente a la fecha de realización según el catálogo de tarifas
+        precio = await tarifas_service.expresion_precio("$tipo_estudio", "$fecha_realizacion")
+
+        tiempos = facetas_tiempos(rango)
+
+        # Un $facet por consulta; todas se ejecutan en paralelo
+        duracion = {"$sum": {"$ifNull": ["$duracion_minutos", DURACION_CITA_DEFECTO]}}
+        ocupacion = {"cantidad": {"$sum": 1}, "minutos": duracion}
+
+        estudios, citas, agenda, informes = await asyncio.gather(
+            self._facetas_por_dia(
+                "estudios",
+                {"$or": [
+                    {"fecha_solicitud": rango},
+                    {"estado": "completado", "fecha_realizacion": rango},
+                ]},
+                {
+                    "estudios_por_estado": (
+                        [{"$match": {"fecha_solicitud": rango}}],
+                        "fecha_solicitud", "$estado", conteo,
+                    ),
+                    "estudios_por_tipo": (
+                        [{"$match": {"fecha_solicitud": rango}}],
+                        "fecha_solicitud", "$tipo_estudio", conteo,
+                    ),
+                    "completados_por_tipo": (
+                        [
+                            {"$match": {"estado": "completado", "fecha_realizacion": rango}},
+                            {"$addFields": {"precio": precio}},
+                        ],
+                        "fecha_realizacion",
+                        "$tipo_estudio",
+                        {
+                            "cantidad": {"$sum": 1},
+                            "horas": {"$sum": {"$divide": [
+                                {"$subtract": ["$fecha_realizacion", "$fecha_solicitud"]}, 3600000
+                            ]}},
+                            "ingreso": {"$sum": "$precio"},
+                            "sin_tarifa": {"$sum": {"$cond": [{"$eq": ["$precio", None]}, 1, 0]}},
+                        },
+                    ),
+                    **tiempos["estudios"],
+                },
+            ),
+            self._facetas_por_dia(
+                "citas",
+                {"fecha_creacion": rango},
+                {
+                    "citas_por_estado": ([], "fecha_creacion", "$estado", conteo),
+                    "citas_asistencia": ([], "fecha_creacion", "$asistio", conteo),
+                    "citas_completadas_por_tecnico": (
+                        [{"$match": {"estado": "completada"}}],
+                        "fecha_creacion", "$tecnico_asignado", conteo,
+                    ),
+                    "citas_por_sala": ([], "fecha_creacion", "$sala", conteo),
+                    **tiempos["citas"],
+                },
+            ),
+            # Ocupación real por día de la cita, sin contar las canceladas
+            self._facetas_por_dia(
+                "citas",
+                {"fecha_cita": rango, "estado": {"$ne": "cancelada"}},
+                {
+                    "ocupacion_por_sala": ([], "fecha_cita", "$sala", ocupacion),
+                    "ocupacion_por_tecnico": ([], "fecha_cita", "$tecnico_asignado", ocupacion),
+                    "ocupacion_por_sala_hora": (
+                        ETAPAS_MINUTOS_POR_HORA,
+                        "fecha_cita",
+                        {"sala": "$sala", "hora": "$_horas.hora"},
+                        {"minutos": {"$sum": "$_horas.minutos"}},
+                    ),
+                },
+            ),
+            self._facetas_por_dia(
+                "informes",
+                {"$or": [{"fecha_creacion": rango}, {"fecha_firma": rango}]},
+                tiempos["informes"],
+            ),
+        )
+        metricas = {**estudios, **citas, **agenda, **informes}
+
+        buckets = {}
+        for dia in dias_en_rango(inicio, fin):
+            bucket = {
+                "fecha": datetime.strptime(dia, FORMATO_DIA),
+                "version": ROLLUP_VERSION,
+                "tarifas_version": tarifas_service.version,
+            }
+            for metrica, por_dia in metricas.items():
+                bucket[metrica] = por_dia.get(dia, [])
+            buckets[dia] = bucket
+        return buckets
+
+    async def _guardar(self, buckets: Dict[str, dict], generaciones: Dict[str, int]):
+        """Guardar buckets recalculados si ninguna escritura los marcó mientras tanto"""
+        db = get_database()
+        hoy = clave_dia(datetime.now())
+        for dia, bucket in buckets.items():
+            generacion = generaciones.get(dia, 0)
+            documento = dict(bucket)
+            # El día en curso sigue abierto: se guarda, pero se recalcula en cada consulta
+            documento["sucio"] = dia >= hoy
+            try:
+                await db.estadisticas_diarias.update_one(
+                    {"_id": dia, "generacion": generacion},
+                    {"$set": documento},
+                    upsert=True,
+                )
+            except DuplicateKeyError:
+                # Otra escritura marcó el día durante el cálculo; queda sucio
+                pass
+
+    async def obtener_buckets(self, inicio: datetime, fin: datetime) -> List[dict]:
+        """Obtener los buckets diarios de [inicio, fin), recalculando los que lo requieran"""
+        db = get_database()
+        dias = dias_en_rango(inicio, fin)
+        if not dias:
+            return []
+
+        existentes = {
+            b["_id"]: b
+            async for b in db.estadisticas_diarias.find({"_id": {"$in": dias}})
+        }
+
+        # Un cambio de tarifas hace recalcular los ingresos de todos los días
+        await tarifas_service.catalogo()
+        pendientes = [
+            dia for dia in dias
+            if dia not in existentes
+            or existentes[dia].get("sucio", True)
+            or existentes[dia].get("version") != ROLLUP_VERSION
+            or existentes[dia].get("tarifas_version") != tarifas_service.version
+        ]
+
+        if pendientes:
+            generaciones = {
+                dia: existentes.get(dia, {}).get("generacion", 0) for dia in pendientes
+            }
+            # Un cálculo por tramo de días seguidos, sin recorrer los días vigentes entre ellos
+            calculados = {}
+            for tramo in tramos_contiguos(pendientes):
+                del_tramo = await self._calcular_dias(
+                    datetime.strptime(tramo[0], FORMATO_DIA),
+                    datetime.strptime(tramo[-1], FORMATO_DIA) + timedelta(days=1),
+                )
+                calculados.update({dia: del_tramo[dia] for dia in tramo})
+            await self._guardar(calculados, generaciones)
+            existentes.update(calculados)
+
+        return [existentes[dia] for dia in dias]
+
+    async def soporta_percentile(self) -> bool:
+        """$percentile está disponible desde MongoDB 7.0"""
+        if self._soporta_percentile is None:
+            info = await get_database().command("buildInfo")
+            self._soporta_percentile = info.get("versionArray", [0])[0] >= 7
+        return self._soporta_percentile
+
+    async def percentiles_servidor(
+        self, inicio: datetime, fin: datetime, percentiles: Iterable[float]
+    ) -> Dict[str, Dict[str, dict]]:
+        """Percentiles de cada tramo calculados con $percentile sobre los datos originales.
+
+        Retorna {etapa: {tipo: {cantidad, minutos, p: [minutos por percentil]}}}.
+        """
+        db = get_database()
+        tramos = tramos_tiempos({"$gte": inicio, "$lt": fin})
+        grupo = {
+            "_id": "$_tipo",
+            "cantidad": {"$sum": 1},
+            "minutos": {"$sum": "$_minutos"},
+            "p": {"$percentile": {
+                "input": "$_minutos",
+                "p": [p / 100 for p in percentiles],
+                "method": "approximate",
+            }},
+        }
+        resultados = await asyncio.gather(*[
+            db[tramo["coleccion"]].aggregate(etapas_minutos(tramo) + [{"$group": grupo}]).to_list(length=None)
+            for tramo in tramos.values()
+        ])
+        return {
+            etapa: {doc["_id"]: doc for doc in documentos}
+            for etapa, documentos in zip(tramos, resultados)
+        }
+
+    async def marcar_dias(self, fechas: Iterable[Optional[datetime]]):
+        """Marcar como sucios los días afectados por una escritura"""
+        dias = {clave_dia(f) for f in fechas if isinstance(f, datetime)}
+        if not dias:
+            return
+        db = get_database()
+        await db.estadisticas_diarias.bulk_write(
+            [
+                UpdateOne(
+                    {"_id": dia},
+                    {"$set": {"sucio": True}, "$inc": {"generacion": 1}},
+                    upsert=True,
+                )
+                for dia in dias
+            ],
+            ordered=False,
+        )
+        await estadisticas_cache.invalidar_dias(dias)
+
+    async def registrar_cambio_estudio(self, *estudios: Optional[dict]):
+        """Marcar los días de un estudio (antes y/o después del cambio)"""
+        fechas = []
+        for estudio in estudios:
+            if estudio:
+                fechas.extend([estudio.get("fecha_solicitud"), estudio.get("fecha_realizacion")])
+        await self.marcar_dias(fechas)
+
+    async def registrar_cambio_cita(self, *citas: Optional[dict]):
+        """Marcar los días de una cita (antes y/o después del cambio)"""
+        fechas = []
+        for cita in citas:
+            if cita:
+                fechas.extend([cita.get("fecha_creacion"), cita.get("fecha_cita")])
+        await self.marcar_dias(fechas)
+
+    async def registrar_cambio_informe(self, *informes: Optional[dict]):
+        """Marcar los días de creación y firma de un informe"""
+        fechas = []
+        for informe in informes:
+            if informe:
+                fechas.extend([informe.get("fecha_creacion"), informe.get("fecha_firma")])
+        await self.marcar_dias(fechas)
+
+    async def compactar(self, batch_dias: int = 31) -> int:
+        """Recalcular los días cerrados marcados como sucios"""
+        db = get_database()
+        hoy = clave_dia(datetime.now())
+        total = 0
+        while True:
+            sucios = await db.estadisticas_diarias.find(
+                {"sucio": True, "_id": {"$lt": hoy}}, {"_id": 1}
+            ).sort("_id", 1).limit(batch_dias).to_list(length=batch_dias)
+            if not sucios:
+                return total
+            desde = datetime.strptime(sucios[0]["_id"], FORMATO_DIA)
+            hasta = datetime.strptime(sucios[-1]["_id"], FORMATO_DIA) + timedelta(days=1)
+            await self.obtener_buckets(desde, hasta)
+            total += len(sucios)
+
+    async def ejecutar_compactador(self, intervalo: float):
+        """Compactar periódicamente los días sucios en segundo plano"""
+        while True:
+            try:
+                recalculados = await self.compactar()
+                if recalculados:
+                    logging.info(f"Rollups diarios recalculados: {recalculados} días")
+            except Exception as e:
+                logging.error(f"Error compactando estadísticas diarias: {str(e)}")
+            await asyncio.sleep(intervalo)
+
+
+estadisticas_service = EstadisticasService()
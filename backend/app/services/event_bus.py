@@ -0,0 +1,118 @@
+import asyncio
+import itertools
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Dict, Iterator, Optional, Set
+
+from app.services.change_feed import change_feed
+
+# Colección -> tipo de evento publicado
+TIPOS_EVENTO = {
+    "estudios": "estudio",
+    "citas": "cita",
+    "informes": "informe",
+}
+
+# Campos del documento que viajan en el evento y sirven para filtrar
+CAMPOS_EVENTO = [
+    "estado",
+    "paciente_id",
+    "estudio_id",
+    "sala",
+    "tecnico_asignado",
+    "medico_radiologo",
+    "prioridad",
+    "urgente",
+    "tipo_estudio",
+    "fecha_cita",
+    "asignado_a",
+]
+
+
+class Suscripcion:
+    """Cola de eventos de un cliente con sus filtros {campo: valor}"""
+
+    def __init__(self, filtros: Dict[str, str], tipos: Optional[Set[str]], max_eventos: int):
+        self.filtros = filtros
+        self.tipos = tipos
+        self.cola: asyncio.Queue = asyncio.Queue(maxsize=max_eventos)
+        self.descartados = 0
+
+    def acepta(self, evento: dict) -> bool:
+        if self.tipos and evento["tipo"] not in self.tipos:
+            return False
+        return all(str(evento.get(campo)) == valor for campo, valor in self.filtros.items())
+
+    def entregar(self, evento: dict):
+        # Un cliente lento pierde los eventos más antiguos en lugar de frenar a los demás
+        if self.cola.full():
+            self.cola.get_nowait()
+            self.descartados += 1
+        self.cola.put_nowait(evento)
+
+
+class EventBus:
+    """Reparte cambios de estudios, citas e informes a los clientes suscritos.
+
+    Con change streams los eventos llegan desde el change feed (de cualquier
+    proceso). Sin ellos, las rutas publican sus propias escrituras al momento
+    y el bus solo ve las del proceso actual.
+    """
+
+    def __init__(self, max_eventos_cliente: int = 100):
+        self.max_eventos_cliente = max_eventos_cliente
+        self.suscripciones: Set[Suscripcion] = set()
+        self._secuencia = itertools.count(1)
+
+    @contextmanager
+    def suscribir(
+        self, filtros: Dict[str, str], tipos: Optional[Set[str]] = None
+    ) -> Iterator[Suscripcion]:
+        suscripcion = Suscripcion(filtros, tipos, self.max_eventos_cliente)
+        self.suscripciones.add(suscripcion)
+        try:
+            yield suscripcion
+        finally:
+            self.suscripciones.discard(suscripcion)
+
+    def publicar(self, coleccion: str, operacion: str, documento: dict):
+        """Publicar el cambio de un documento a las suscripciones que lo aceptan"""
+        tipo = TIPOS_EVENTO.get(coleccion)
+        if not tipo or ("_id" not in documento and "id" not in documento):
+            return
+
+        evento = {
+            "id": next(self._secuencia),
+            "tipo": tipo,
+            "operacion": operacion,
+            "documento_id": str(documento.get("_id") or documento.get("id")),
+            "fecha": datetime.now().isoformat(),
+        }
+        for campo in CAMPOS_EVENTO:
+            valor = documento.get(campo)
+            if valor is not None:
+                evento[campo] = valor.isoformat() if isinstance(valor, datetime) else valor
+
+        for suscripcion in list(self.suscripciones):
+            if suscripcion.acepta(evento):
+                suscripcion.entregar(evento)
+
+    def publicar_local(self, coleccion: str, operacion: str, documento: Optional[dict]):
+        """Publicar una escritura de este proceso cuando no hay change streams que la traigan"""
+        if documento and change_feed.modo != "change_stream":
+            self.publicar(coleccion, operacion, documento)
+
+    async def procesar_cambio(self, coleccion: str, operacion: str, documento: dict):
+        """Handler del change feed; en modo polling las rutas ya publicaron sus cambios"""
+        if change_feed.modo == "change_stream":
+            self.publicar(coleccion, operacion, documento)
+
+    def resumen(self) -> dict:
+        return {
+            "clientes": len(self.suscripciones),
+            "origen": "change_stream" if change_feed.modo == "change_stream" else "local",
+            "descartados": sum(s.descartados for s in self.suscripciones),
+        }
+
+
+event_bus = EventBus()
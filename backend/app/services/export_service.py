@@ -0,0 +1,301 @@
+import csv
+import io
+import json
+import os
+from datetime import datetime
+from typing import AsyncIterator, List, Optional, Tuple
+
+from app.database import get_database
+from app.services.tarifas_service import tarifas_service
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+EXPORT_BATCH_SIZE = int(os.getenv("EXPORT_BATCH_SIZE", "1000"))
+
+FORMATOS = {
+    "json": "application/json",
+    "csv": "text/csv; charset=utf-8",
+    "parquet": "application/vnd.apache.parquet",
+}
+
+# Columnas: (nombre, tipo) con tipo en str, int, float, bool, fecha
+Columnas = List[Tuple[str, str]]
+
+
+def parquet_disponible() -> bool:
+    return pq is not None
+
+
+async def _precio() -> dict:
+    return await tarifas_service.expresion_precio("$tipo_estudio", "$fecha_realizacion")
+
+
+# Exportaciones fila a fila: colección, filtro, campo de orden, columnas y campos
+# calculados en la base de datos ({campo: corrutina que retorna la expresión})
+CONSULTAS_FILAS = {
+    "estadisticas": {
+        "coleccion": "estudios",
+        "filtro": lambda inicio, fin: {"fecha_solicitud": {"$gte": inicio, "$lt": fin}},
+        "orden": "fecha_solicitud",
+        "columnas": [
+            ("id", "str"),
+            ("fecha_solicitud", "fecha"),
+            ("estado", "str"),
+            ("tipo_estudio", "str"),
+            ("modalidad", "str"),
+            ("prioridad", "str"),
+            ("paciente_id", "str"),
+            ("medico_solicitante", "str"),
+        ],
+        "calculados": {},
+    },
+    "rendimiento": {
+        "coleccion": "citas",
+        "filtro": lambda inicio, fin: {"fecha_creacion": {"$gte": inicio, "$lt": fin}},
+        "orden": "fecha_creacion",
+        "columnas": [
+            ("id", "str"),
+            ("fecha_creacion", "fecha"),
+            ("fecha_cita", "fecha"),
+            ("estado", "str"),
+            ("tipo_estudio", "str"),
+            ("sala", "str"),
+            ("tecnico_asignado", "str"),
+            ("asistio", "bool"),
+            ("paciente_id", "str"),
+            ("estudio_id", "str"),
+        ],
+        "calculados": {},
+    },
+    "financiero": {
+        "coleccion": "estudios",
+        "filtro": lambda inicio, fin: {
+            "estado": "completado",
+            "fecha_realizacion": {"$gte": inicio, "$lt": fin},
+        },
+        "orden": "fecha_realizacion",
+        "columnas": [
+            ("id", "str"),
+            ("fecha_realizacion", "fecha"),
+            ("tipo_estudio", "str"),
+            ("modalidad", "str"),
+            ("prioridad", "str"),
+            ("paciente_id", "str"),
+            ("medico_solicitante", "str"),
+            ("precio", "int"),
+        ],
+        "calculados": {"precio": _precio},
+    },
+}
+
+
+def _valor(valor, tipo: str):
+    """Normalizar un valor de MongoDB al tipo de la columna"""
+    if valor is None:
+        return None
+    if tipo == "fecha":
+        return valor if isinstance(valor, datetime) else None
+    if tipo == "int":
+        return int(valor)
+    if tipo == "float":
+        return float(valor)
+    if tipo == "bool":
+        return bool(valor)
+    return str(valor)
+
+
+async def filas_documentos(
+    tipo: str, inicio: datetime, fin: datetime, batch_size: int
+) -> AsyncIterator[List[dict]]:
+    """Recorrer la consulta de exportación en lotes de filas ya normalizadas"""
+    consulta = CONSULTAS_FILAS[tipo]
+    db = get_database()
+    columnas = consulta["columnas"]
+    proyeccion = {nombre: 1 for nombre, _ in columnas}
+
+    pipeline = [
+        {"$match": consulta["filtro"](inicio, fin)},
+        {"$sort": {consulta["orden"]: 1}},
+    ]
+    if consulta["calculados"]:
+        pipeline.append({"$addFields": {
+            nombre: await expresion() for nombre, expresion in consulta["calculados"].items()
+        }})
+    pipeline.append({"$project": proyeccion})
+
+    cursor = db[consulta["coleccion"]].aggregate(pipeline, batchSize=batch_size)
+
+    lote = []
+    async for documento in cursor:
+        documento["id"] = str(documento.pop("_id"))
+        lote.append({nombre: _valor(documento.get(nombre), t) for nombre, t in columnas})
+        if len(lote) >= batch_size:
+            yield lote
+            lote = []
+    if lote:
+        yield lote
+
+
+def filas_agregado(data: dict) -> Tuple[Columnas, List[dict]]:
+    """Aplanar un informe agregado: cada lista es una sección y los escalares van a 'resumen'"""
+    filas = []
+    resumen = []
+
+    def recorrer(valor, ruta: str):
+        if isinstance(valor, dict):
+            for clave, subvalor in valor.items():
+                recorrer(subvalor, f"{ruta}.{clave}" if ruta else clave)
+        elif isinstance(valor, list):
+            for item in valor:
+                if isinstance(item, dict):
+                    filas.append({"seccion": ruta, **item})
+                else:
+                    filas.append({"seccion": ruta, "valor": item})
+        else:
+            resumen.append({"seccion": "resumen", "campo": ruta, "valor": valor})
+
+    recorrer(data, "")
+    filas = resumen + filas
+
+    nombres = []
+    for fila in filas:
+        for nombre in fila:
+            if nombre not in nombres:
+                nombres.append(nombre)
+    return [(nombre, "str") for nombre in nombres], filas
+
+
+async def _lotes(filas: List[dict]) -> AsyncIterator[List[dict]]:
+    yield filas
+
+
+def _texto(valor) -> str:
+    if valor is None:
+        return ""
+    if isinstance(valor, datetime):
+        return valor.isoformat()
+    return str(valor)
+
+
+async def generar_csv(columnas: Columnas, lotes: AsyncIterator[List[dict]]) -> AsyncIterator[bytes]:
+    """CSV con encabezado; cada lote se escribe y se entrega por separado"""
+    nombres = [nombre for nombre, _ in columnas]
+    buffer = io.StringIO()
+    escritor = csv.writer(buffer)
+
+    escritor.writerow(nombres)
+    # BOM para que Excel detecte UTF-8
+    yield ("\ufeff" + buffer.getvalue()).encode("utf-8")
+
+    async for lote in lotes:
+        buffer.seek(0)
+        buffer.truncate()
+        for fila in lote:
+            escritor.writerow([_texto(fila.get(nombre)) for nombre in nombres])
+        yield buffer.getvalue().encode("utf-8")
+
+
+async def generar_json(lotes: AsyncIterator[List[dict]]) -> AsyncIterator[bytes]:
+    """Arreglo JSON escrito por lotes"""
+    primero = True
+    yield b"["
+    async for lote in lotes:
+        partes = []
+        for fila in lote:
+            partes.append(("" if primero else ",") + json.dumps(fila, default=_texto, ensure_ascii=False))
+            primero = False
+        yield "".join(partes).encode("utf-8")
+    yield b"]"
+
+
+class _Sumidero(io.RawIOBase):
+    """Archivo de solo escritura que acumula bytes para entregarlos por partes"""
+
+    def __init__(self):
+        self.datos = bytearray()
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self.datos.extend(b)
+        return len(b)
+
+    def vaciar(self) -> bytes:
+        datos = bytes(self.datos)
+        self.datos.clear()
+        return datos
+
+
+def _esquema_arrow(columnas: Columnas):
+    tipos = {
+        "str": pa.string(),
+        "int": pa.int64(),
+        "float": pa.float64(),
+        "bool": pa.bool_(),
+        "fecha": pa.timestamp("ms"),
+    }
+    return pa.schema([(nombre, tipos[tipo]) for nombre, tipo in columnas])
+
+
+async def generar_parquet(columnas: Columnas, lotes: AsyncIterator[List[dict]]) -> AsyncIterator[bytes]:
+    """Parquet con un row group por lote; requiere pyarrow"""
+    esquema = _esquema_arrow(columnas)
+    sumidero = _Sumidero()
+    escritor = pq.ParquetWriter(sumidero, esquema)
+    try:
+        async for lote in lotes:
+            lote = [
+                {
+                    nombre: _texto(fila[nombre]) if tipo == "str" and fila.get(nombre) is not None
+                    else fila.get(nombre)
+                    for nombre, tipo in columnas
+                }
+                for fila in lote
+            ]
+            escritor.write_table(pa.Table.from_pylist(lote, schema=esquema))
+            datos = sumidero.vaciar()
+            if datos:
+                yield datos
+    finally:
+        escritor.close()
+    yield sumidero.vaciar()
+
+
+def exportar(
+    formato: str,
+    columnas: Columnas,
+    lotes: AsyncIterator[List[dict]],
+) -> AsyncIterator[bytes]:
+    """Generador de bytes para el formato pedido"""
+    if formato == "csv":
+        return generar_csv(columnas, lotes)
+    if formato == "parquet":
+        return generar_parquet(columnas, lotes)
+    return generar_json(lotes)
+
+
+class ExportService:
+    def __init__(self, batch_size: int = EXPORT_BATCH_SIZE):
+        self.batch_size = batch_size
+
+    def exportar_filas(
+        self, tipo: str, formato: str, inicio: datetime, fin: datetime, batch_size: Optional[int] = None
+    ) -> AsyncIterator[bytes]:
+        """Exportar las filas originales del informe leyendo el cursor por lotes"""
+        columnas = CONSULTAS_FILAS[tipo]["columnas"]
+        lotes = filas_documentos(tipo, inicio, fin, batch_size or self.batch_size)
+        return exportar(formato, columnas, lotes)
+
+    def exportar_agregado(self, data: dict, formato: str) -> AsyncIterator[bytes]:
+        """Exportar un informe agregado ya calculado como tabla"""
+        columnas, filas = filas_agregado(data)
+        return exportar(formato, columnas, _lotes(filas))
+
+
+export_service = ExportService()
@@ -0,0 +1,154 @@
+from typing import Dict, List, Optional
+
+from bson import ObjectId
+from pymongo import UpdateOne
+
+from app.database import get_database
+from app.services.worklist_service import prioridad_lista
+
+# Los informes guardan una copia de los datos de paciente y estudio que muestran los
+# listados; InformesSnapshotService la mantiene al día a partir del change feed.
+
+
+def campos_paciente(paciente: Optional[dict]) -> dict:
+    """Campos del snapshot que dependen del paciente"""
+    if not paciente:
+        return {
+            "paciente_nombre": "Paciente no encontrado",
+            "paciente_apellidos": None,
+            "paciente_cedula": None,
+        }
+    return {
+        "paciente_nombre": paciente.get("nombre"),
+        "paciente_apellidos": paciente.get("apellidos"),
+        "paciente_cedula": paciente.get("identificacion"),
+    }
+
+
+def campos_snapshot(estudio_id: str, estudio: Optional[dict], paciente: Optional[dict]) -> dict:
+    """Calcular el snapshot completo de un informe a partir de su estudio y paciente"""
+    if not estudio:
+        return {
+            "snapshot_estudio_id": estudio_id,
+            "paciente_id": None,
+            "paciente_nombre": "Estudio no encontrado",
+            "paciente_apellidos": None,
+            "paciente_cedula": None,
+            "estudio_tipo": "No especificado",
+            "estudio_modalidad": "No especificada",
+            "estudio_fecha": None,
+            "estudio_prioridad": None,
+        }
+    if paciente:
+        paciente_id = str(paciente["_id"])
+    else:
+        paciente_id = str(estudio["paciente_id"]) if estudio.get("paciente_id") else None
+    snapshot = {
+        "snapshot_estudio_id": estudio_id,
+        "paciente_id": paciente_id,
+        "estudio_tipo": estudio.get("tipo_estudio", "No especificado"),
+        "estudio_modalidad": estudio.get("modalidad", "No especificada"),
+        "estudio_fecha": estudio.get("fecha_realizacion"),
+        "estudio_prioridad": estudio.get("prioridad", "normal"),
+    }
+    snapshot.update(campos_paciente(paciente))
+    return snapshot
+
+
+def _filtro_ids(ids: List[str]) -> dict:
+    """Filtro $in que acepta ids canónicos (ObjectId) e ids heredados"""
+    object_ids = [ObjectId(i) for i in ids if ObjectId.is_valid(i)]
+    heredados = [i for i in ids if not ObjectId.is_valid(i)]
+    condiciones = []
+    if object_ids:
+        condiciones.append({"_id": {"$in": object_ids}})
+    if heredados:
+        condiciones.append({"id": {"$in": heredados}})
+    if not condiciones:
+        return {"_id": {"$in": []}}
+    return condiciones[0] if len(condiciones) == 1 else {"$or": condiciones}
+
+
+def _indexar(documentos: List[dict]) -> Dict[str, dict]:
+    """Indexar documentos por str(_id) y por id heredado"""
+    indice = {}
+    for documento in documentos:
+        indice[str(documento["_id"])] = documento
+        if documento.get("id"):
+            indice[str(documento["id"])] = documento
+    return indice
+
+
+class InformesSnapshotService:
+    async def snapshots_para_estudios(self, estudio_ids: List[str]) -> Dict[str, dict]:
+        """Calcular snapshots para varios estudios con una consulta por colección"""
+        db = get_database()
+        estudio_ids = [e for e in set(estudio_ids) if e]
+        if not estudio_ids:
+            return {}
+
+        estudios = _indexar(await db.estudios.find(
+            _filtro_ids(estudio_ids),
+            {"paciente_id": 1, "tipo_estudio": 1, "modalidad": 1,
+             "fecha_realizacion": 1, "prioridad": 1, "id": 1},
+        ).to_list(length=None))
+
+        paciente_ids = [str(e["paciente_id"]) for e in estudios.values() if e.get("paciente_id")]
+        pacientes = _indexar(await db.pacientes.find(
+            _filtro_ids(list(set(paciente_ids))),
+            {"nombre": 1, "apellidos": 1, "identificacion": 1, "id": 1},
+        ).to_list(length=None)) if paciente_ids else {}
+
+        snapshots = {}
+        for estudio_id in estudio_ids:
+            estudio = estudios.get(estudio_id)
+            paciente = pacientes.get(str(estudio.get("paciente_id"))) if estudio else None
+            snapshots[estudio_id] = campos_snapshot(estudio_id, estudio, paciente)
+        return snapshots
+
+    async def refrescar_informes(self, informes: List[dict]) -> Dict[str, dict]:
+        """Recalcular y guardar el snapshot de los informes dados; retorna {_id: snapshot}"""
+        db = get_database()
+        snapshots = await self.snapshots_para_estudios(
+            [str(i.get("estudio_id")) for i in informes if i.get("estudio_id")]
+        )
+
+        resultado = {}
+        operaciones = []
+        for informe in informes:
+            estudio_id = str(informe.get("estudio_id") or "")
+            snapshot = snapshots.get(estudio_id) or campos_snapshot(estudio_id, None, None)
+            # La prioridad del estudio forma parte de la prioridad en la lista de trabajo
+            snapshot["lista_prioridad"] = prioridad_lista({**informe, **snapshot})
+            resultado[informe["_id"]] = snapshot
+            operaciones.append(UpdateOne({"_id": informe["_id"]}, {"$set": snapshot}))
+
+        if operaciones:
+            await db.informes.bulk_write(operaciones, ordered=False)
+        return resultado
+
+    async def procesar_cambio(self, coleccion: str, operacion: str, documento: dict):
+        """Mantener los snapshots al día ante cambios en pacientes, estudios o informes"""
+        db = get_database()
+
+        if operacion == "delete" or "_id" not in documento:
+            return
+
+        if coleccion == "pacientes":
+            referencias = [str(documento["_id"])] + ([documento["id"]] if documento.get("id") else [])
+            await db.informes.update_many(
+                {"paciente_id": {"$in": referencias}},
+                {"$set": campos_paciente(documento)},
+            )
+
+        elif coleccion == "estudios":
+            referencias = [str(documento["_id"])] + ([documento["id"]] if documento.get("id") else [])
+            informes = await db.informes.find(
+                {"estudio_id": {"$in": referencias}}, {"estudio_id": 1, "urgente": 1}
+            ).to_list(length=None)
+            await self.refrescar_informes(informes)
+
+        elif coleccion == "informes":
+            # Solo recalcular si el informe es nuevo o cambió de estudio
+            if documento.get("snapshot_estudio_id") != documento.get("estudio_id"):
+                await self.refrescar_informes([documento])
@@ -0,0 +1,121 @@
+import math
+import os
+from datetime import timedelta
+from typing import Dict, List, Optional, Tuple
+
+from pymongo import ReturnDocument
+
+from app.database import get_database
+
+# Canal -> (mensajes por segundo, ráfaga máxima); una tasa de 0 desactiva el límite
+Limite = Tuple[float, float]
+
+
+class TokenBucket:
+    """Token bucket guardado en la colección limites_envio y compartido entre procesos.
+
+    Cada toma recarga y descuenta tokens en una sola actualización atómica del
+    documento, con la hora del servidor ($$NOW), así varios dispatchers
+    respetan juntos el límite del proveedor aunque sus relojes difieran.
+    """
+
+    def __init__(self, clave: str, tasa: float, rafaga: float):
+        self.clave = clave
+        self.tasa = tasa
+        self.rafaga = max(rafaga, 1)
+
+    async def tomar(self, solicitados: int) -> Tuple[int, float]:
+        """Tomar hasta solicitados tokens; retorna (concedidos, tokens que quedan)"""
+        db = get_database()
+        transcurrido = {"$divide": [{"$subtract": ["$$NOW", {"$ifNull": ["$actualizado", "$$NOW"]}]}, 1000]}
+        documento = await db.limites_envio.find_one_and_update(
+            {"_id": self.clave},
+            [
+                {"$set": {
+                    "tokens": {"$min": [self.rafaga, {"$add": [
+                        {"$ifNull": ["$tokens", self.rafaga]},
+                        {"$multiply": [transcurrido, self.tasa]},
+                    ]}]},
+                    "actualizado": "$$NOW",
+                    "tasa": self.tasa,
+                    "rafaga": self.rafaga,
+                }},
+                {"$set": {"concedidos": {"$min": [solicitados, {"$floor": "$tokens"}]}}},
+                {"$set": {"tokens": {"$subtract": ["$tokens", "$concedidos"]}}},
+            ],
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
+        return int(documento["concedidos"]), documento["tokens"]
+
+    async def devolver(self, cantidad: int):
+        """Reponer tokens tomados que no se usaron (sin pasar de la ráfaga)"""
+        db = get_database()
+        await db.limites_envio.update_one(
+            {"_id": self.clave},
+            [{"$set": {"tokens": {"$min": [self.rafaga, {"$add": ["$tokens", cantidad]}]}}}],
+        )
+
+    def espera(self, restantes: float) -> timedelta:
+        """Tiempo hasta que haya un token entero, dados los tokens que quedan"""
+        return timedelta(seconds=max(0.0, math.ceil((1 - restantes) / self.tasa * 1000) / 1000))
+
+
+class LimitadorEnvios:
+    """Límites de envío por canal y proveedor (un TokenBucket por combinación)"""
+
+    def __init__(self, limites: Dict[str, Limite]):
+        self.limites = {canal: limite for canal, limite in limites.items() if limite[0] > 0}
+        self._buckets: Dict[str, TokenBucket] = {}
+
+    def bucket(self, canal: str, proveedor: str) -> Optional[TokenBucket]:
+        if canal not in self.limites:
+            return None
+        clave = f"{canal}:{proveedor}"
+        if clave not in self._buckets:
+            self._buckets[clave] = TokenBucket(clave, *self.limites[canal])
+        return self._buckets[clave]
+
+    async def reservar(self, canal: str, proveedor: str, cantidad: int) -> Tuple[int, Optional[timedelta]]:
+        """Tomar hasta cantidad tokens antes de reclamar mensajes.
+
+        Retorna cuántos se concedieron y, si el canal tiene límite, cuánto falta
+        para el próximo token.
+        """
+        bucket = self.bucket(canal, proveedor)
+        if bucket is None:
+            return cantidad, None
+        concedidos, restantes = await bucket.tomar(cantidad)
+        return concedidos, bucket.espera(restantes)
+
+    async def devolver(self, canal: str, proveedor: str, cantidad: int):
+        """Reponer los tokens reservados que no se usaron (había menos mensajes en la cola)"""
+        bucket = self.bucket(canal, proveedor)
+        if bucket is not None and cantidad > 0:
+            await bucket.devolver(cantidad)
+
+    async def estado(self) -> List[dict]:
+        """Tokens de cada bucket según su última toma (de cualquier proceso)"""
+        db = get_database()
+        return [
+            {
+                "clave": documento["_id"],
+                "tokens": documento.get("tokens"),
+                "tasa": documento.get("tasa"),
+                "rafaga": documento.get("rafaga"),
+                "actualizado": documento.get("actualizado"),
+            }
+            async for documento in db.limites_envio.find({})
+        ]
+
+
+limitador_envios = LimitadorEnvios({
+    "email": (
+        float(os.getenv("NOTIFICACIONES_EMAIL_POR_SEGUNDO", "10")),
+        float(os.getenv("NOTIFICACIONES_EMAIL_RAFAGA", "20")),
+    ),
+    "sms": (
+        float(os.getenv("NOTIFICACIONES_SMS_POR_SEGUNDO", "5")),
+        float(os.getenv("NOTIFICACIONES_SMS_RAFAGA", "10")),
+    ),
+})
@@ -0,0 +1,192 @@
+import os
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from app.database import get_database
+from app.services.outbox_service import Dispatcher, dispatcher
+
+# Límites (segundos) de los buckets del histograma de latencia encolado -> envío
+BUCKETS_LATENCIA = (1, 5, 15, 60, 300, 900, 3600, 21600, 86400)
+
+Etiquetas = Dict[str, str]
+
+
+def _escapar(valor: str) -> str:
+    return str(valor).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _numero(valor: float) -> str:
+    if valor == float("inf"):
+        return "+Inf"
+    return repr(float(valor)) if isinstance(valor, float) else str(valor)
+
+
+class MetricasPrometheus:
+    """Acumula familias de métricas y las escribe en el formato de texto de Prometheus"""
+
+    def __init__(self):
+        self._lineas: List[str] = []
+
+    def _muestra(self, metrica: str, etiquetas: Etiquetas, valor: float):
+        if etiquetas:
+            pares = ",".join(f'{k}="{_escapar(v)}"' for k, v in etiquetas.items())
+            self._lineas.append(f"{metrica}{{{pares}}} {_numero(valor)}")
+        else:
+            self._lineas.append(f"{metrica} {_numero(valor)}")
+
+    def familia(self, nombre: str, tipo: str, ayuda: str, muestras: Iterable[Tuple[Etiquetas, float]]):
+        self._lineas.append(f"# HELP {nombre} {ayuda}")
+        self._lineas.append(f"# TYPE {nombre} {tipo}")
+        for etiquetas, valor in muestras:
+            self._muestra(nombre, etiquetas, valor)
+
+    def histograma(self, nombre: str, ayuda: str,
+                   series: Iterable[Tuple[Etiquetas, List[Tuple[float, int]], float, int]]):
+        """series: (etiquetas, [(límite, acumulado)], suma, cantidad)"""
+        self._lineas.append(f"# HELP {nombre} {ayuda}")
+        self._lineas.append(f"# TYPE {nombre} histogram")
+        for etiquetas, buckets, suma, cantidad in series:
+            for limite, acumulado in buckets + [(float("inf"), cantidad)]:
+                self._muestra(f"{nombre}_bucket", {**etiquetas, "le": _numero(float(limite))}, acumulado)
+            self._muestra(f"{nombre}_sum", etiquetas, float(suma))
+            self._muestra(f"{nombre}_count", etiquetas, cantidad)
+
+    def texto(self) -> str:
+        return "\n".join(self._lineas) + "\n"
+
+
+class MetricasNotificaciones:
+    """Métricas de entrega calculadas sobre el historial de notificaciones.
+
+    Una agregación sobre las notificaciones creadas en la ventana (índice de
+    fecha_creacion) cuenta resultados por canal, proveedor y estado, suma los
+    reintentos y arma el histograma de latencia entre fecha_encolado y el envío.
+    fecha_encolado es cuando la notificación quedó lista para salir: en los
+    avisos agrupados, el fin de la ventana de agrupación, que así no se mide
+    como demora; las anteriores a ese campo usan fecha_creacion. La profundidad
+    de la cola sale de Dispatcher.metricas(). Los conteos se recalculan sobre
+    una ventana móvil y por eso se exponen como gauges, no como counters.
+    """
+
+    def __init__(self, ventana_horas: float = 24, buckets: Tuple[float, ...] = BUCKETS_LATENCIA,
+                 dispatcher: Optional[Dispatcher] = None):
+        self.ventana = timedelta(hours=ventana_horas)
+        self.buckets = buckets
+        self.dispatcher = dispatcher
+
+    def _pipeline(self, desde: datetime) -> list:
+        encolado = {"$ifNull": ["$fecha_encolado", "$fecha_creacion"]}
+        latencia = {"$divide": [{"$subtract": ["$fecha_envio", encolado]}, 1000]}
+        enviada = {"$eq": ["$estado", "enviada"]}
+        return [
+            {"$match": {"fecha_creacion": {"$gte": desde}}},
+            {"$project": {
+                "tipo": 1,
+                "estado": 1,
+                "proveedor": {"$ifNull": ["$proveedor", "desconocido"]},
+                "reintentos": {"$max": [{"$subtract": [{"$ifNull": ["$intentos_envio", 0]}, 1]}, 0]},
+                "latencia": {"$cond": [
+                    {"$and": [enviada, {"$eq": [{"$type": "$fecha_envio"}, "date"]}]}, latencia, None,
+                ]},
+            }},
+            {"$group": {
+                "_id": {"tipo": "$tipo", "proveedor": "$proveedor", "estado": "$estado"},
+                "cantidad": {"$sum": 1},
+                "reintentos": {"$sum": "$reintentos"},
+                "latencia_suma": {"$sum": {"$ifNull": ["$latencia", 0]}},
+                "latencia_cantidad": {"$sum": {"$cond": [{"$ne": ["$latencia", None]}, 1, 0]}},
+                **{
+                    f"le_{i}": {"$sum": {"$cond": [
+                        {"$and": [{"$ne": ["$latencia", None]}, {"$lte": ["$latencia", limite]}]}, 1, 0,
+                    ]}}
+                    for i, limite in enumerate(self.buckets)
+                },
+            }},
+        ]
+
+    async def recolectar(self) -> dict:
+        """Grupos por (tipo, proveedor, estado) de la ventana y métricas de la cola"""
+        db = get_database()
+        grupos = await db.notificaciones.aggregate(
+            self._pipeline(datetime.now() - self.ventana)
+        ).to_list(length=None)
+        cola = await self.dispatcher.metricas() if self.dispatcher else None
+        return {"grupos": grupos, "cola": cola}
+
+    def prometheus(self, datos: dict) -> str:
+        """Texto para el endpoint de scraping"""
+        metricas = MetricasPrometheus()
+        ventana = f"{self.ventana.total_seconds() / 3600:g}h"
+        grupos = datos["grupos"]
+
+        metricas.familia(
+            "notificaciones_creadas", "gauge",
+            f"Notificaciones creadas en la ventana de {ventana} por canal, proveedor y estado",
+            ((g["_id"], g["cantidad"]) for g in grupos),
+        )
+        metricas.familia(
+            "notificaciones_reintentos", "gauge",
+            f"Intentos de envío repetidos de las notificaciones creadas en la ventana de {ventana}",
+            ((g["_id"], g["reintentos"]) for g in grupos),
+        )
+        metricas.histograma(
+            "notificaciones_latencia_envio_segundos",
+            f"Segundos desde que la notificación quedó lista para enviarse (sin la ventana de agrupación)"
+            f" hasta su envío, para las enviadas en la ventana de {ventana}",
+            (
+                (
+                    {"tipo": g["_id"]["tipo"], "proveedor": g["_id"]["proveedor"]},
+                    [(limite, g[f"le_{i}"]) for i, limite in enumerate(self.buckets)],
+                    g["latencia_suma"],
+                    g["latencia_cantidad"],
+                )
+                for g in grupos if g["_id"]["estado"] == "enviada"
+            ),
+        )
+
+        # Tasa de fallas por canal y proveedor (fallidas sobre finalizadas)
+        finalizadas: Dict[Tuple[str, str], List[int]] = {}
+        for grupo in grupos:
+            if grupo["_id"]["estado"] in ("enviada", "fallida"):
+                clave = (grupo["_id"]["tipo"], grupo["_id"]["proveedor"])
+                conteo = finalizadas.setdefault(clave, [0, 0])
+                conteo[grupo["_id"]["estado"] == "fallida"] += grupo["cantidad"]
+        metricas.familia(
+            "notificaciones_tasa_falla", "gauge",
+            f"Fracción de notificaciones finalizadas en la ventana de {ventana} que quedaron fallidas",
+            (({"tipo": tipo, "proveedor": proveedor}, fallidas / (enviadas_ + fallidas))
+             for (tipo, proveedor), (enviadas_, fallidas) in finalizadas.items()),
+        )
+
+        cola = datos.get("cola")
+        if cola:
+            metricas.familia(
+                "notificaciones_cola", "gauge", "Notificaciones en el outbox por estado",
+                (({"estado": estado}, cantidad) for estado, cantidad in cola["por_estado"].items()),
+            )
+            metricas.familia(
+                "notificaciones_cola_listas", "gauge", "Notificaciones pendientes listas para enviar",
+                [({}, cola["listas_para_enviar"])],
+            )
+            metricas.familia(
+                "notificaciones_cola_en_espera", "gauge",
+                "Notificaciones pendientes esperando un reintento o el fin de su ventana",
+                [({}, cola["en_espera_de_reintento"])],
+            )
+            metricas.familia(
+                "notificaciones_cola_retraso_segundos", "gauge",
+                "Antigüedad de la notificación lista más vieja sin reclamar",
+                [({}, float(cola["retraso_segundos"]))],
+            )
+            metricas.familia(
+                "notificaciones_limite_tokens", "gauge",
+                "Tokens disponibles de cada límite de envío según su última toma",
+                (({"bucket": limite["clave"]}, float(limite["tokens"] or 0)) for limite in cola.get("limites", [])),
+            )
+        return metricas.texto()
+
+
+metricas_notificaciones = MetricasNotificaciones(
+    ventana_horas=float(os.getenv("NOTIFICACIONES_METRICAS_VENTANA_HORAS", "24")),
+    dispatcher=dispatcher,
+)
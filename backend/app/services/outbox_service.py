@@ -0,0 +1,367 @@
+import asyncio
+import logging
+import os
+import random
+import socket
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Tuple
+
+from bson import ObjectId
+from pymongo import UpdateOne
+
+from app.database import get_database
+from app.services.email_service import EmailService
+from app.services.limitador_service import LimitadorEnvios, limitador_envios
+from app.services.sms_service import SMSService
+
+# La colección notificaciones es el outbox: las rutas solo insertan documentos
+# pendientes y el dispatcher (run_dispatcher.py) los reclama por lotes, los envía
+# y guarda el resultado. Estados: pendiente -> enviando -> enviada | fallida; un
+# recordatorio de una cita cancelada o reprogramada pasa de pendiente a cancelada.
+# Un envío fallido vuelve a pendiente con disponible_desde en el futuro (backoff
+# exponencial); al agotar max_intentos, o si el error no se arregla reintentando,
+# queda en fallida (dead letter). Cada ciclo toma primero los tokens del límite de
+# envío de cada canal y reclama solo esa cantidad; el resto sigue pendiente.
+
+ASUNTO_DEFECTO = "Actualización de su estudio médico"
+
+# Canales con límite de envío por proveedor
+CANALES = ("email", "sms")
+
+# Resultado de un envío: None si salió, o (error, reintentable)
+Resultado = Optional[Tuple[str, bool]]
+
+
+def nueva_notificacion(
+    paciente_id: str,
+    tipo: str,
+    mensaje: str,
+    titulo: Optional[str] = None,
+    estudio_id: Optional[str] = None,
+    prioridad: str = "normal",
+    **extra,
+) -> dict:
+    """Documento de notificación listo para insertar en el outbox"""
+    ahora = datetime.now()
+    return {
+        "paciente_id": paciente_id,
+        "tipo": tipo,
+        "mensaje": mensaje,
+        "titulo": titulo,
+        "estudio_id": estudio_id,
+        "prioridad": prioridad,
+        **extra,
+        "estado": "pendiente",
+        "enviada": False,
+        "intentos_envio": 0,
+        "fecha_creacion": ahora,
+        "disponible_desde": ahora,
+        # Desde cuándo está lista para enviarse; base de la latencia de entrega
+        "fecha_encolado": ahora,
+    }
+
+
+async def encolar(*notificaciones: dict) -> List[ObjectId]:
+    """Guardar notificaciones pendientes; el dispatcher las enviará"""
+    if not notificaciones:
+        return []
+    db = get_database()
+    result = await db.notificaciones.insert_many(list(notificaciones))
+    return result.inserted_ids
+
+
+class Dispatcher:
+    """Reclama lotes de notificaciones pendientes y las envía por los pools de email y SMS.
+
+    El reclamo es atómico por documento (update_many condicionado al estado),
+    así varios dispatchers pueden trabajar en paralelo sin enviar dos veces la
+    misma notificación. Un lote reclamado por un proceso que muere vuelve a
+    estar disponible cuando vence su lease.
+    """
+
+    def __init__(self, tamano_lote: int = 100, lease_segundos: float = 300,
+                 max_intentos: int = 5, backoff_base: float = 60, backoff_max: float = 3600,
+                 email_service: Optional[EmailService] = None,
+                 sms_service: Optional[SMSService] = None,
+                 limitador: Optional[LimitadorEnvios] = None):
+        self.tamano_lote = tamano_lote
+        self.lease = timedelta(seconds=lease_segundos)
+        self.max_intentos = max_intentos
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}"
+        self._email_service = email_service
+        self._sms_service = sms_service
+        self.limitador = limitador
+
+    @property
+    def email_service(self) -> EmailService:
+        if self._email_service is None:
+            self._email_service = EmailService()
+        return self._email_service
+
+    @property
+    def sms_service(self) -> SMSService:
+        if self._sms_service is None:
+            self._sms_service = SMSService()
+        return self._sms_service
+
+    @staticmethod
+    def _filtro_disponibles(ahora: datetime) -> dict:
+        return {"$or": [
+            {"estado": "pendiente", "disponible_desde": {"$lte": ahora}},
+            {"estado": "enviando", "reclamada_hasta": {"$lte": ahora}},
+        ]}
+
+    async def reclamar(self, limite: Optional[int] = None, tipo: Optional[object] = None) -> List[dict]:
+        """Marcar como 'enviando' hasta limite notificaciones disponibles (del tipo dado) y retornarlas"""
+        db = get_database()
+        limite = limite or self.tamano_lote
+        ahora = datetime.now()
+        filtro = self._filtro_disponibles(ahora)
+        if tipo is not None:
+            filtro["tipo"] = tipo
+
+        candidatos = await db.notificaciones.find(filtro, {"_id": 1}).sort(
+            "disponible_desde", 1
+        ).limit(limite).to_list(length=limite)
+        if not candidatos:
+            return []
+
+        ids = [c["_id"] for c in candidatos]
+        lote = ObjectId()
+        # Si otro dispatcher tomó alguna entre find y update, el filtro ya no la incluye.
+        # Un aviso agrupado deja de aceptar fusiones al reclamarse; sin agrupacion, si
+        # vuelve a pendiente para reintentarse no choca con el aviso siguiente del paciente
+        await db.notificaciones.update_many(
+            {"_id": {"$in": ids}, **filtro},
+            {
+                "$set": {
+                    "estado": "enviando",
+                    "lote": lote,
+                    "reclamada_por": self.worker_id,
+                    "reclamada_hasta": ahora + self.lease,
+                },
+                "$rename": {"agrupacion": "agrupacion_enviada"},
+            },
+        )
+        return await db.notificaciones.find({"_id": {"$in": ids}, "lote": lote}).to_list(length=limite)
+
+    async def _pacientes(self, notificaciones: List[dict]) -> Dict[str, dict]:
+        db = get_database()
+        ids = {n["paciente_id"] for n in notificaciones if ObjectId.is_valid(n.get("paciente_id", ""))}
+        pacientes = await db.pacientes.find(
+            {"_id": {"$in": [ObjectId(i) for i in ids]}},
+            {"email": 1, "telefono": 1, "nombre": 1},
+        ).to_list(length=None)
+        return {str(p["_id"]): p for p in pacientes}
+
+    def _proveedor(self, canal: str) -> str:
+        if canal == "email":
+            return getattr(self.email_service, "smtp_server", "smtp")
+        if canal == "sms":
+            return getattr(self.sms_service, "provider", "sms")
+        return canal
+
+    async def reclamar_limitado(self) -> Tuple[List[dict], bool, Optional[timedelta]]:
+        """Reclamar un lote respetando el límite de envío de cada canal.
+
+        Por cada canal con límite se toman primero los tokens y se reclaman solo
+        tantas notificaciones como tokens concedidos; los que sobran se devuelven.
+        Retorna (notificaciones, si puede quedar trabajo listo, espera hasta el
+        próximo token del canal que quedó cortado por el límite).
+        """
+        notificaciones, hay_mas, espera = [], False, None
+        limitados = []
+        if self.limitador is not None:
+            for canal in CANALES:
+                proveedor = self._proveedor(canal)
+                if self.limitador.bucket(canal, proveedor) is None:
+                    continue
+                limitados.append(canal)
+                concedidos, hasta_token = await self.limitador.reservar(canal, proveedor, self.tamano_lote)
+                reclamadas = await self.reclamar(concedidos, canal) if concedidos else []
+                if len(reclamadas) < concedidos:
+                    await self.limitador.devolver(canal, proveedor, concedidos - len(reclamadas))
+                elif concedidos < self.tamano_lote:
+                    espera = hasta_token if espera is None else min(espera, hasta_token)
+                else:
+                    hay_mas = True
+                notificaciones.extend(reclamadas)
+        otras = await self.reclamar(self.tamano_lote, {"$nin": limitados} if limitados else None)
+        return notificaciones + otras, hay_mas or len(otras) == self.tamano_lote, espera
+
+    async def enviar(self, notificaciones: List[dict]) -> Dict[ObjectId, Resultado]:
+        """Enviar un lote; retorna {_id: resultado}"""
+        pacientes = await self._pacientes(notificaciones)
+        resultados: Dict[ObjectId, Resultado] = {}
+        emails, sms = [], []
+
+        for notificacion in notificaciones:
+            paciente = pacientes.get(notificacion.get("paciente_id"))
+            if not paciente:
+                resultados[notificacion["_id"]] = ("Paciente no encontrado", False)
+            elif notificacion["tipo"] == "email":
+                if paciente.get("email"):
+                    emails.append((notificacion, paciente["email"]))
+                else:
+                    resultados[notificacion["_id"]] = ("Paciente sin email", False)
+            elif notificacion["tipo"] == "sms":
+                if paciente.get("telefono"):
+                    sms.append((notificacion, paciente["telefono"]))
+                else:
+                    resultados[notificacion["_id"]] = ("Paciente sin teléfono", False)
+            else:
+                resultados[notificacion["_id"]] = (
+                    f"Tipo de notificación no soportado: {notificacion['tipo']}", False
+                )
+
+        envios_email, envios_sms = await asyncio.gather(
+            self.email_service.send_bulk([
+                self.email_service.crear_mensaje(
+                    destino, n.get("titulo") or ASUNTO_DEFECTO, n["mensaje"], n.get("mensaje_html")
+                )
+                for n, destino in emails
+            ]),
+            self.sms_service.send_bulk([(destino, n["mensaje"]) for n, destino in sms]),
+        )
+        for (notificacion, _), ok in zip(emails, envios_email):
+            resultados[notificacion["_id"]] = None if ok else ("Error enviando email", True)
+        for (notificacion, _), ok in zip(sms, envios_sms):
+            resultados[notificacion["_id"]] = None if ok else ("Error enviando SMS", True)
+        return resultados
+
+    def espera_reintento(self, intentos: int) -> timedelta:
+        """Backoff exponencial con jitter antes del siguiente intento"""
+        espera = min(self.backoff_max, self.backoff_base * 2 ** max(intentos - 1, 0))
+        return timedelta(seconds=espera * random.uniform(0.8, 1.2))
+
+    async def registrar(self, notificaciones: List[dict], resultados: Dict[ObjectId, Resultado]):
+        """Guardar el resultado de cada notificación con un solo bulk_write"""
+        if not resultados:
+            return
+        db = get_database()
+        ahora = datetime.now()
+        operaciones = []
+        for notificacion in notificaciones:
+            resultado = resultados.get(notificacion["_id"])
+            intentos = notificacion.get("intentos_envio", 0) + 1
+            if resultado is None:
+                cambios = {"estado": "enviada", "enviada": True, "fecha_envio": ahora, "error": None}
+            else:
+                error, reintentable = resultado
+                if reintentable and intentos < self.max_intentos:
+                    cambios = {
+                        "estado": "pendiente",
+                        "error": error,
+                        "disponible_desde": ahora + self.espera_reintento(intentos),
+                    }
+                else:
+                    cambios = {"estado": "fallida", "error": error}
+            # Si el lease venció y otro dispatcher la reclamó, el resultado es de ese otro lote
+            operaciones.append(UpdateOne(
+                {"_id": notificacion["_id"], "lote": notificacion["lote"]},
+                {
+                    "$set": {
+                        **cambios,
+                        "ultimo_intento": ahora,
+                        "reclamada_hasta": None,
+                        "proveedor": self._proveedor(notificacion["tipo"]),
+                    },
+                    "$inc": {"intentos_envio": 1},
+                },
+            ))
+        await db.notificaciones.bulk_write(operaciones, ordered=False)
+
+    async def _procesar(self) -> Tuple[int, bool, Optional[timedelta]]:
+        notificaciones, hay_mas, espera = await self.reclamar_limitado()
+        if notificaciones:
+            await self.registrar(notificaciones, await self.enviar(notificaciones))
+        return len(notificaciones), hay_mas, espera
+
+    async def procesar_lote(self) -> int:
+        """Reclamar, enviar y registrar un lote; retorna cuántas notificaciones procesó"""
+        procesadas, _, _ = await self._procesar()
+        return procesadas
+
+    async def ejecutar(self, intervalo: float = 5.0, concurrencia: int = 1):
+        """Procesar lotes continuamente.
+
+        Sigue sin pausa mientras los lotes salen llenos; si el límite de envío
+        cortó un canal espera hasta su próximo token, y si la cola se vació
+        espera intervalo segundos.
+        """
+        async def trabajador():
+            while True:
+                try:
+                    _, hay_mas, espera = await self._procesar()
+                except Exception as e:
+                    logging.error(f"Error en el dispatcher de notificaciones: {str(e)}")
+                    hay_mas, espera = False, None
+                if hay_mas:
+                    continue
+                if espera is not None:
+                    await asyncio.sleep(min(intervalo, espera.total_seconds()))
+                else:
+                    await asyncio.sleep(intervalo)
+
+        logging.info(f"Dispatcher de notificaciones {self.worker_id} iniciado ({concurrencia} trabajadores)")
+        await asyncio.gather(*(trabajador() for _ in range(concurrencia)))
+
+    async def metricas(self) -> dict:
+        """Profundidad de la cola: cantidad por estado, vencidas y próximos reintentos"""
+        db = get_database()
+        ahora = datetime.now()
+        # Conteos por estado resueltos sobre el índice (estado, disponible_desde)
+        estados = ["pendiente", "enviando", "enviada", "fallida", "cancelada"]
+        conteos = await asyncio.gather(*(
+            db.notificaciones.count_documents({"estado": estado}) for estado in estados
+        ))
+        por_estado = dict(zip(estados, conteos))
+        listas = await db.notificaciones.count_documents(
+            {"estado": "pendiente", "disponible_desde": {"$lte": ahora}}
+        )
+        mas_antigua = await db.notificaciones.find_one(
+            {"estado": "pendiente", "disponible_desde": {"$lte": ahora}},
+            {"disponible_desde": 1},
+            sort=[("disponible_desde", 1)],
+        )
+        proximo = await db.notificaciones.find_one(
+            {"estado": "pendiente", "disponible_desde": {"$gt": ahora}},
+            {"disponible_desde": 1},
+            sort=[("disponible_desde", 1)],
+        )
+        return {
+            "por_estado": por_estado,
+            "listas_para_enviar": listas,
+            "en_espera_de_reintento": por_estado["pendiente"] - listas,
+            "retraso_segundos": (
+                (ahora - mas_antigua["disponible_desde"]).total_seconds() if mas_antigua else 0
+            ),
+            "proximo_reintento": proximo["disponible_desde"] if proximo else None,
+            "max_intentos": self.max_intentos,
+            "limites": await self.limitador.estado() if self.limitador else [],
+        }
+
+    async def preparar(self) -> int:
+        """Asignar estado a las notificaciones creadas antes del outbox.
+
+        Las no enviadas quedan como fallidas para no reenviar avisos viejos;
+        se pueden reenviar desde /notificaciones/{id}/reenviar.
+        """
+        db = get_database()
+        result = await db.notificaciones.update_many(
+            {"estado": {"$exists": False}},
+            [{"$set": {"estado": {"$cond": ["$enviada", "enviada", "fallida"]}}}],
+        )
+        return result.modified_count
+
+
+dispatcher = Dispatcher(
+    tamano_lote=int(os.getenv("NOTIFICACIONES_LOTE", "100")),
+    lease_segundos=float(os.getenv("NOTIFICACIONES_LEASE_SEGUNDOS", "300")),
+    max_intentos=int(os.getenv("NOTIFICACIONES_MAX_INTENTOS", "5")),
+    backoff_base=float(os.getenv("NOTIFICACIONES_BACKOFF_BASE", "60")),
+    backoff_max=float(os.getenv("NOTIFICACIONES_BACKOFF_MAX", "3600")),
+    limitador=limitador_envios,
+)
@@ -0,0 +1,251 @@
+import html
+import logging
+import os
+import time
+from datetime import datetime
+from string import Template
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+from app.database import get_database
+
+# Las plantillas por defecto viven en app/plantillas/<locale>/<nombre>/, un archivo
+# por variante (asunto.txt, texto.txt, html.html, sms.txt) con variables $nombre o
+# ${nombre}. La colección plantillas guarda versiones editadas (_id "<locale>:<nombre>")
+# que reemplazan a las del disco sin redeploy.
+
+DIRECTORIO_PLANTILLAS = os.path.join(os.path.dirname(os.path.dirname(__file__)), "plantillas")
+
+# Variante -> archivo en disco
+ARCHIVOS = {"asunto": "asunto.txt", "texto": "texto.txt", "html": "html.html", "sms": "sms.txt"}
+VARIANTES = tuple(ARCHIVOS)
+
+
+class Mensaje(NamedTuple):
+    asunto: Optional[str]
+    texto: Optional[str]
+    html: Optional[str]
+    sms: Optional[str]
+
+
+class Plantilla:
+    """Variantes de una plantilla compiladas a string.Template.
+
+    La compilación valida los placeholders una sola vez; renderizar solo sustituye.
+    """
+
+    def __init__(self, nombre: str, locale: str, variantes: Dict[str, Optional[str]], origen: str = "disco"):
+        self.nombre = nombre
+        self.locale = locale
+        self.origen = origen
+        self.fuentes = {v: variantes.get(v) for v in VARIANTES}
+        self.compiladas: Dict[str, Template] = {}
+        for variante, fuente in self.fuentes.items():
+            if fuente is None:
+                continue
+            template = Template(fuente.strip() if variante in ("asunto", "sms") else fuente)
+            if not template.is_valid():
+                raise ValueError(f"Variante '{variante}' de la plantilla '{nombre}' tiene placeholders inválidos")
+            self.compiladas[variante] = template
+        if not self.compiladas:
+            raise ValueError(f"La plantilla '{nombre}' no tiene variantes")
+        self.variables = sorted({
+            identificador
+            for template in self.compiladas.values()
+            for identificador in template.get_identifiers()
+        })
+
+    def renderizar(self, variables: dict, variantes: Tuple[str, ...] = VARIANTES) -> Mensaje:
+        """Las variantes pedidas en una pasada con los mismos valores; en HTML los valores se escapan.
+
+        Si no hay variante SMS, el SMS es el texto plano.
+        """
+        if "sms" in variantes and "sms" not in self.compiladas:
+            variantes = tuple(variantes) + ("texto",)
+        try:
+            resultado = {}
+            escapadas = None
+            for variante in variantes:
+                template = self.compiladas.get(variante)
+                if template is None:
+                    continue
+                if variante == "html":
+                    escapadas = escapadas or {k: html.escape(str(v)) for k, v in variables.items()}
+                    resultado[variante] = template.substitute(escapadas)
+                else:
+                    resultado[variante] = template.substitute(variables)
+        except KeyError as e:
+            raise ValueError(f"Falta la variable {e} para la plantilla '{self.nombre}'")
+        if "sms" in variantes and "sms" not in resultado and resultado.get("texto"):
+            resultado["sms"] = resultado["texto"].strip()
+        return Mensaje(**{v: resultado.get(v) for v in VARIANTES})
+
+    def a_dict(self) -> dict:
+        return {
+            "nombre": self.nombre,
+            "locale": self.locale,
+            "origen": self.origen,
+            "variables": self.variables,
+            **self.fuentes,
+        }
+
+
+class PlantillaService:
+    """Caché de plantillas compiladas por (locale, nombre).
+
+    Las del disco se compilan al primer uso; las de la colección se recargan
+    cuando cambia la firma (cantidad y última fecha_actualizacion), consultada a
+    lo sumo cada verificar_segundos. Así los envíos masivos renderizan desde
+    memoria y una plantilla editada se usa en todos los procesos sin reiniciar.
+    """
+
+    def __init__(self, directorio: str = DIRECTORIO_PLANTILLAS, locale_defecto: str = "es",
+                 verificar_segundos: float = 30, variables_globales: Optional[dict] = None):
+        self.directorio = directorio
+        self.locale_defecto = locale_defecto
+        self.verificar_segundos = verificar_segundos
+        self.variables_globales = variables_globales or {}
+        self._disco: Optional[Dict[Tuple[str, str], Plantilla]] = None
+        self._firma_disco: Optional[float] = None
+        self._personalizadas: Dict[Tuple[str, str], Plantilla] = {}
+        self._firma: Optional[tuple] = None
+        self._ultima_verificacion = 0.0
+
+    def _mtime_disco(self) -> float:
+        ultima = 0.0
+        for raiz, _, archivos in os.walk(self.directorio):
+            for archivo in archivos:
+                ultima = max(ultima, os.path.getmtime(os.path.join(raiz, archivo)))
+        return ultima
+
+    def _cargar_disco(self) -> Dict[Tuple[str, str], Plantilla]:
+        plantillas = {}
+        if not os.path.isdir(self.directorio):
+            return plantillas
+        for locale in sorted(os.listdir(self.directorio)):
+            ruta_locale = os.path.join(self.directorio, locale)
+            if not os.path.isdir(ruta_locale):
+                continue
+            for nombre in sorted(os.listdir(ruta_locale)):
+                variantes = {}
+                for variante, archivo in ARCHIVOS.items():
+                    ruta = os.path.join(ruta_locale, nombre, archivo)
+                    if os.path.isfile(ruta):
+                        with open(ruta, encoding="utf-8") as f:
+                            variantes[variante] = f.read()
+                try:
+                    plantillas[(locale, nombre)] = Plantilla(nombre, locale, variantes)
+                except ValueError as e:
+                    logging.error(f"Plantilla {locale}/{nombre} ignorada: {str(e)}")
+        return plantillas
+
+    def _plantillas_disco(self) -> Dict[Tuple[str, str], Plantilla]:
+        if self._disco is None:
+            self._firma_disco = self._mtime_disco()
+            self._disco = self._cargar_disco()
+        return self._disco
+
+    async def actualizar(self, forzar: bool = False):
+        """Recompilar las plantillas que cambiaron en el disco o en la colección"""
+        if not forzar and time.monotonic() - self._ultima_verificacion < self.verificar_segundos:
+            return
+        self._ultima_verificacion = time.monotonic()
+
+        if self._disco is not None and self._mtime_disco() != self._firma_disco:
+            self._disco = None
+
+        db = get_database()
+        cantidad = await db.plantillas.count_documents({})
+        ultima = await db.plantillas.find_one({}, {"fecha_actualizacion": 1}, sort=[("fecha_actualizacion", -1)])
+        firma = (cantidad, ultima["fecha_actualizacion"] if ultima else None)
+        if firma == self._firma:
+            return
+
+        personalizadas = {}
+        async for documento in db.plantillas.find({}):
+            try:
+                personalizadas[(documento["locale"], documento["nombre"])] = Plantilla(
+                    documento["nombre"], documento["locale"], documento, origen="personalizada"
+                )
+            except ValueError as e:
+                logging.error(f"Plantilla personalizada {documento['_id']} ignorada: {str(e)}")
+        self._personalizadas = personalizadas
+        self._firma = firma
+
+    def invalidar(self):
+        """Forzar la verificación en el próximo actualizar (tras editar una plantilla)"""
+        self._ultima_verificacion = 0.0
+        self._firma = None
+
+    def obtener(self, nombre: str, locale: Optional[str] = None) -> Plantilla:
+        """Plantilla del locale pedido o, si no existe, la del locale por defecto"""
+        disco = self._plantillas_disco()
+        for clave in ((locale or self.locale_defecto, nombre), (self.locale_defecto, nombre)):
+            plantilla = self._personalizadas.get(clave) or disco.get(clave)
+            if plantilla:
+                return plantilla
+        raise ValueError(f"Plantilla no encontrada: {nombre}")
+
+    def listar(self) -> List[Plantilla]:
+        """Plantillas vigentes (las personalizadas reemplazan a las del disco)"""
+        return list({**self._plantillas_disco(), **self._personalizadas}.values())
+
+    def renderizar(self, nombre: str, variables: dict, locale: Optional[str] = None,
+                   variantes: Tuple[str, ...] = VARIANTES) -> Mensaje:
+        """Renderizar desde la caché; llamar antes a actualizar() para ver ediciones recientes"""
+        return self.obtener(nombre, locale).renderizar({**self.variables_globales, **variables}, variantes)
+
+    async def render(self, nombre: str, variables: dict, locale: Optional[str] = None,
+                     variantes: Tuple[str, ...] = VARIANTES) -> Mensaje:
+        """actualizar() y renderizar()"""
+        await self.actualizar()
+        return self.renderizar(nombre, variables, locale, variantes)
+
+    def validar(self, plantilla: Plantilla):
+        """Rechazar una versión personalizada que use variables que el código no envía.
+
+        Las variables disponibles son las de la plantilla por defecto del disco
+        más las globales; cualquier otra haría fallar cada render en producción.
+        """
+        disco = self._plantillas_disco()
+        defecto = disco.get((plantilla.locale, plantilla.nombre)) or disco.get((self.locale_defecto, plantilla.nombre))
+        if defecto is None:
+            raise ValueError(f"Plantilla no encontrada: {plantilla.nombre}")
+        disponibles = set(defecto.variables) | set(self.variables_globales)
+        desconocidas = sorted(set(plantilla.variables) - disponibles)
+        if desconocidas:
+            raise ValueError(
+                f"La plantilla '{plantilla.nombre}' usa variables no disponibles: {', '.join(desconocidas)}"
+                f" (disponibles: {', '.join(sorted(disponibles))})"
+            )
+
+    async def guardar(self, nombre: str, locale: str, variantes: Dict[str, Optional[str]]) -> Plantilla:
+        """Guardar una versión personalizada; lanza ValueError si no compila o usa variables desconocidas"""
+        plantilla = Plantilla(nombre, locale, variantes, origen="personalizada")
+        self.validar(plantilla)
+        db = get_database()
+        await db.plantillas.replace_one(
+            {"_id": f"{locale}:{nombre}"},
+            {
+                "nombre": nombre,
+                "locale": locale,
+                **plantilla.fuentes,
+                "fecha_actualizacion": datetime.now(),
+            },
+            upsert=True,
+        )
+        self.invalidar()
+        return plantilla
+
+    async def eliminar(self, nombre: str, locale: str) -> bool:
+        """Borrar la versión personalizada y volver a la del disco"""
+        db = get_database()
+        result = await db.plantillas.delete_one({"_id": f"{locale}:{nombre}"})
+        self.invalidar()
+        return result.deleted_count == 1
+
+
+plantilla_service = PlantillaService(
+    locale_defecto=os.getenv("PLANTILLAS_LOCALE", "es"),
+    verificar_segundos=float(os.getenv("PLANTILLAS_VERIFICAR_SEGUNDOS", "30")),
+    variables_globales={"centro": os.getenv("FROM_NAME", "Centro de Imagenología")},
+)
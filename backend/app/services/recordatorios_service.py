@@ -0,0 +1,171 @@
+import asyncio
+import logging
+import os
+from datetime import date, datetime, timedelta
+from typing import Optional
+
+from bson import ObjectId
+from pymongo.errors import BulkWriteError
+
+from app.database import get_database
+from app.services.outbox_service import nueva_notificacion
+from app.services.plantilla_service import PlantillaService, plantilla_service
+
+# Código de error de MongoDB por clave duplicada
+CLAVE_DUPLICADA = 11000
+
+
+def clave_recordatorio(cita: dict, tipo: str) -> str:
+    """Clave de idempotencia: un recordatorio por cita, canal y horario.
+
+    Incluye la fecha de la cita para que una cita reprogramada reciba un
+    recordatorio nuevo.
+    """
+    return f"recordatorio:{cita['_id']}:{tipo}:{cita['fecha_cita'].isoformat()}"
+
+
+class RecordatoriosService:
+    """Genera por lotes los recordatorios de las citas del día siguiente.
+
+    Una consulta por rango sobre (estado, fecha_cita) trae las citas, otra con
+    $in los pacientes, y los recordatorios entran al outbox con insert_many.
+    El índice único de idempotency_key garantiza que ejecutar el job varias
+    veces (o en varios procesos) no duplique recordatorios.
+    """
+
+    def __init__(self, hora_envio: int = 18, plantillas: Optional[PlantillaService] = None):
+        self.hora_envio = hora_envio
+        self.plantillas = plantillas or plantilla_service
+
+    def _notificaciones(self, cita: dict, paciente: dict) -> list:
+        # Email y SMS salen de un solo render de la plantilla compilada
+        mensaje = self.plantillas.renderizar("recordatorio_cita", {
+            "paciente_nombre": paciente.get("nombre", ""),
+            "fecha_cita": cita["fecha_cita"].strftime("%d/%m/%Y a las %H:%M"),
+            "tipo_estudio": cita.get("tipo_estudio", "su estudio"),
+        }, paciente.get("idioma"))
+        base = {
+            "estudio_id": cita.get("estudio_id"),
+            "cita_id": str(cita["_id"]),
+        }
+        notificaciones = []
+
+        if paciente.get("email"):
+            notificaciones.append(nueva_notificacion(
+                str(paciente["_id"]), "email", mensaje.texto, titulo=mensaje.asunto, mensaje_html=mensaje.html,
+                idempotency_key=clave_recordatorio(cita, "email"), **base,
+            ))
+        if paciente.get("telefono"):
+            notificaciones.append(nueva_notificacion(
+                str(paciente["_id"]), "sms", mensaje.sms,
+                idempotency_key=clave_recordatorio(cita, "sms"), **base,
+            ))
+        return notificaciones
+
+    async def generar(self, dia: Optional[date] = None) -> dict:
+        """Encolar los recordatorios de las citas programadas del día (por defecto, mañana)"""
+        db = get_database()
+        dia = dia or (datetime.now() + timedelta(days=1)).date()
+        inicio = datetime(dia.year, dia.month, dia.day)
+        fin = inicio + timedelta(days=1)
+
+        citas = await db.citas.find(
+            {"estado": "programada", "fecha_cita": {"$gte": inicio, "$lt": fin}},
+            {"paciente_id": 1, "estudio_id": 1, "fecha_cita": 1, "tipo_estudio": 1},
+        ).to_list(length=None)
+
+        paciente_ids = {c["paciente_id"] for c in citas if ObjectId.is_valid(str(c.get("paciente_id", "")))}
+        pacientes = {
+            str(p["_id"]): p
+            for p in await db.pacientes.find(
+                {"_id": {"$in": [ObjectId(i) for i in paciente_ids]}},
+                {"nombre": 1, "email": 1, "telefono": 1, "idioma": 1},
+            ).to_list(length=None)
+        } if paciente_ids else {}
+
+        await self.plantillas.actualizar()
+        notificaciones = []
+        errores_plantilla = 0
+        for cita in citas:
+            paciente = pacientes.get(str(cita.get("paciente_id")))
+            if not paciente:
+                continue
+            try:
+                notificaciones.extend(self._notificaciones(cita, paciente))
+            except ValueError as e:
+                # Una plantilla rota (p. ej. de un locale) no frena los recordatorios del resto
+                errores_plantilla += 1
+                logging.error(f"Recordatorio de la cita {cita['_id']} no generado: {str(e)}")
+
+        # Saltar las que ya están en el outbox para no chocar con el índice en cada ejecución
+        claves = [n["idempotency_key"] for n in notificaciones]
+        existentes = {
+            n["idempotency_key"]
+            for n in await db.notificaciones.find(
+                {"idempotency_key": {"$in": claves}}, {"idempotency_key": 1}
+            ).to_list(length=None)
+        } if claves else set()
+        nuevas = [n for n in notificaciones if n["idempotency_key"] not in existentes]
+
+        encoladas = 0
+        if nuevas:
+            try:
+                result = await db.notificaciones.insert_many(nuevas, ordered=False)
+                encoladas = len(result.inserted_ids)
+            except BulkWriteError as e:
+                # Otro proceso encoló algunas entre la consulta y el insert
+                errores = e.details.get("writeErrors", [])
+                if any(error["code"] != CLAVE_DUPLICADA for error in errores):
+                    raise
+                encoladas = e.details.get("nInserted", 0)
+
+        resumen = {
+            "fecha": dia.isoformat(),
+            "citas": len(citas),
+            "encoladas": encoladas,
+            "ya_encoladas": len(notificaciones) - encoladas,
+            "sin_paciente": sum(1 for c in citas if str(c.get("paciente_id")) not in pacientes),
+            "errores_plantilla": errores_plantilla,
+        }
+        logging.info(f"Recordatorios del {resumen['fecha']}: {encoladas} encolados para {len(citas)} citas")
+        return resumen
+
+    async def cancelar(self, cita: dict, motivo: str) -> int:
+        """Cancelar los recordatorios aún pendientes de una cita cancelada o reprogramada.
+
+        Se buscan por la clave de idempotencia del horario anterior, que pasa a
+        idempotency_key_cancelada: si la cita vuelve a ese horario, el job puede
+        encolarle un recordatorio nuevo. Retorna cuántos se cancelaron.
+        """
+        if not isinstance(cita.get("fecha_cita"), datetime):
+            return 0
+        db = get_database()
+        result = await db.notificaciones.update_many(
+            {
+                "idempotency_key": {"$in": [clave_recordatorio(cita, tipo) for tipo in ("email", "sms")]},
+                "estado": "pendiente",
+            },
+            {
+                "$set": {"estado": "cancelada", "error": motivo, "fecha_actualizacion": datetime.now()},
+                "$rename": {"idempotency_key": "idempotency_key_cancelada"},
+            },
+        )
+        return result.modified_count
+
+    async def ejecutar(self, intervalo: float = 900):
+        """Generar los recordatorios de mañana a partir de hora_envio, revisando cada intervalo segundos.
+
+        Las ejecuciones repetidas solo encolan las citas agendadas desde la anterior.
+        """
+        while True:
+            if datetime.now().hour >= self.hora_envio:
+                try:
+                    await self.generar()
+                except Exception as e:
+                    logging.error(f"Error generando recordatorios de citas: {str(e)}")
+            await asyncio.sleep(intervalo)
+
+
+recordatorios_service = RecordatoriosService(
+    hora_envio=int(os.getenv("RECORDATORIOS_HORA", "18")),
+)
@@ -0,0 +1,164 @@
+import re
+import unicodedata
+from typing import List, Optional, Tuple
+
+from pymongo import UpdateOne
+
+from app.database import get_database
+
+# Campos derivados que se mantienen en cada paciente para búsquedas rápidas
+CAMPO_NOMBRE_BUSQUEDA = "nombre_busqueda"
+CAMPO_TOKENS_BUSQUEDA = "tokens_busqueda"
+
+# Límite de pacientes usados para filtrar otras colecciones por nombre; si el
+# nombre coincide con más, las rutas lo avisan con el encabezado HEADER_FILTRO_TRUNCADO
+MAX_PACIENTES_FILTRO = 500
+HEADER_FILTRO_TRUNCADO = "X-Filtro-Pacientes-Truncado"
+
+
+def normalizar_texto(texto: Optional[str]) -> str:
+    """Convertir texto a minúsculas sin tildes ni espacios redundantes"""
+    if not texto:
+        return ""
+    descompuesto = unicodedata.normalize("NFKD", str(texto))
+    sin_tildes = "".join(c for c in descompuesto if not unicodedata.combining(c))
+    limpio = re.sub(r"[^\w\s]", " ", sin_tildes.lower())
+    return " ".join(limpio.split())
+
+
+def tokenizar(texto: Optional[str]) -> List[str]:
+    """Separar un texto normalizado en tokens únicos conservando el orden"""
+    tokens = []
+    for token in normalizar_texto(texto).split():
+        if token not in tokens:
+            tokens.append(token)
+    return tokens
+
+
+def campos_busqueda_paciente(paciente: dict) -> dict:
+    """Calcular los campos de búsqueda de un paciente a partir de sus datos"""
+    nombre_completo = " ".join(
+        parte for parte in [paciente.get("nombre"), paciente.get("apellidos")] if parte
+    )
+    tokens = tokenizar(nombre_completo)
+    identificacion = normalizar_texto(paciente.get("identificacion")).replace(" ", "")
+    if identificacion and identificacion not in tokens:
+        tokens.append(identificacion)
+    return {
+        CAMPO_NOMBRE_BUSQUEDA: normalizar_texto(nombre_completo),
+        CAMPO_TOKENS_BUSQUEDA: tokens,
+    }
+
+
+def filtro_prefijos(tokens: List[str]) -> dict:
+    """Construir un filtro que exige que cada token sea prefijo de algún token indexado"""
+    condiciones = [
+        {CAMPO_TOKENS_BUSQUEDA: {"$regex": f"^{re.escape(token)}"}} for token in tokens
+    ]
+    if len(condiciones) == 1:
+        return condiciones[0]
+    return {"$and": condiciones}
+
+
+def puntuar(tokens_consulta: List[str], paciente: dict) -> float:
+    """Puntuar una coincidencia: exactas sobre prefijos y orden del nombre"""
+    tokens_paciente = paciente.get(CAMPO_TOKENS_BUSQUEDA, [])
+    puntaje = 0.0
+    for posicion, token in enumerate(tokens_consulta):
+        if token in tokens_paciente:
+            puntaje += 2.0
+            if tokens_paciente.index(token) == posicion:
+                puntaje += 0.5
+        elif any(t.startswith(token) for t in tokens_paciente):
+            puntaje += 1.0
+    if paciente.get(CAMPO_NOMBRE_BUSQUEDA, "").startswith(" ".join(tokens_consulta)):
+        puntaje += 1.0
+    # Preferir nombres cortos ante el mismo número de coincidencias
+    return puntaje - len(tokens_paciente) * 0.01
+
+
+class SearchService:
+    def __init__(self, max_candidatos: int = 200):
+        self.max_candidatos = max_candidatos
+
+    async def buscar_pacientes(self, texto: str, limit: int = 20) -> List[dict]:
+        """Buscar pacientes por prefijos de nombre, apellidos o identificación"""
+        tokens = tokenizar(texto)
+        if not tokens:
+            return []
+
+        db = get_database()
+        proyeccion = {
+            "nombre": 1,
+            "apellidos": 1,
+            "identificacion": 1,
+            "email": 1,
+            "telefono": 1,
+            CAMPO_NOMBRE_BUSQUEDA: 1,
+            CAMPO_TOKENS_BUSQUEDA: 1,
+        }
+        candidatos = await db.pacientes.find(
+            filtro_prefijos(tokens), proyeccion
+        ).limit(self.max_candidatos).to_list(length=self.max_candidatos)
+
+        candidatos.sort(key=lambda p: puntuar(tokens, p), reverse=True)
+
+        resultados = []
+        for paciente in candidatos[:limit]:
+            resultados.append(
+                {
+                    "id": str(paciente["_id"]),
+                    "nombre": paciente.get("nombre"),
+                    "apellidos": paciente.get("apellidos"),
+                    "identificacion": paciente.get("identificacion"),
+                    "email": paciente.get("email"),
+                    "telefono": paciente.get("telefono"),
+                    "puntaje": round(puntuar(tokens, paciente), 2),
+                }
+            )
+        return resultados
+
+    async def ids_pacientes_por_nombre(
+        self, texto: str, limit: int = MAX_PACIENTES_FILTRO
+    ) -> Tuple[List[str], bool]:
+        """Obtener los IDs de pacientes cuyo nombre coincide, usando el índice de tokens.
+
+        Retorna (ids, truncado); truncado indica que hay más de limit coincidencias
+        y el filtro solo incluye las primeras.
+        """
+        tokens = tokenizar(texto)
+        if not tokens:
+            return [], False
+
+        db = get_database()
+        cursor = db.pacientes.find(filtro_prefijos(tokens), {"_id": 1}).limit(limit + 1)
+        ids = [str(p["_id"]) async for p in cursor]
+        return ids[:limit], len(ids) > limit
+
+    async def reindexar_pacientes(self, batch_size: int = 500) -> int:
+        """Calcular los campos de búsqueda de los pacientes que aún no los tienen"""
+        db = get_database()
+        operaciones = []
+        total = 0
+        cursor = db.pacientes.find(
+            {CAMPO_TOKENS_BUSQUEDA: {"$exists": False}},
+            {"nombre": 1, "apellidos": 1, "identificacion": 1},
+        ).batch_size(batch_size)
+
+        async for paciente in cursor:
+            operaciones.append(
+                UpdateOne(
+                    {"_id": paciente["_id"]},
+                    {"$set": campos_busqueda_paciente(paciente)},
+                )
+            )
+            if len(operaciones) >= batch_size:
+                await db.pacientes.bulk_write(operaciones, ordered=False)
+                total += len(operaciones)
+                operaciones = []
+
+        if operaciones:
+            await db.pacientes.bulk_write(operaciones, ordered=False)
+            total += len(operaciones)
+
+        return total
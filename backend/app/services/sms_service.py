@@ -1,13 +1,103 @@
+import asyncio
 import os
-import requests
+import random
+import httpx
 from dotenv import load_dotenv
 import logging
-from typing import Optional
+from typing import Dict, List, Optional, Tuple
+
+from app.services.plantilla_service import plantilla_service
 
 load_dotenv()
 
+# Un POST de envío no es idempotente: solo se reintenta cuando el proveedor no
+# procesó el mensaje. Estas respuestas lo indican; un 500/502/504 puede llegar
+# después de que el SMS salió, así que no se reintenta.
+ESTADOS_REINTENTABLES = {408, 425, 429, 503}
+
+# Errores de red en los que el request no llegó a enviarse
+ERRORES_REINTENTABLES = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+
+
+class ClienteHTTPSMS:
+    """Cliente HTTP compartido por los proveedores SMS.
+
+    Mantiene conexiones keep-alive, limita los envíos simultáneos por proveedor
+    y reintenta, con backoff exponencial con jitter (respetando Retry-After
+    cuando el proveedor lo envía), solo los fallos en que el mensaje no pudo
+    haber salido: errores de conexión y respuestas como 429 o 503.
+    """
+
+    def __init__(self, max_conexiones: int = 20, timeout: float = 10, max_concurrencia: int = 10,
+                 reintentos: int = 3, backoff_base: float = 0.5, backoff_max: float = 10,
+                 transport: Optional[httpx.AsyncBaseTransport] = None):
+        self.max_conexiones = max_conexiones
+        self.timeout = timeout
+        self.max_concurrencia = max_concurrencia
+        self.reintentos = reintentos
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.transport = transport
+        self._cliente: Optional[httpx.AsyncClient] = None
+        self._semaforos: Dict[str, asyncio.Semaphore] = {}
+
+    def _cliente_actual(self) -> httpx.AsyncClient:
+        if self._cliente is None or self._cliente.is_closed:
+            self._cliente = httpx.AsyncClient(
+                timeout=self.timeout,
+                limits=httpx.Limits(
+                    max_connections=self.max_conexiones,
+                    max_keepalive_connections=self.max_conexiones,
+                ),
+                transport=self.transport,
+            )
+        return self._cliente
+
+    def _semaforo(self, proveedor: str) -> asyncio.Semaphore:
+        if proveedor not in self._semaforos:
+            self._semaforos[proveedor] = asyncio.Semaphore(self.max_concurrencia)
+        return self._semaforos[proveedor]
+
+    def _espera(self, intento: int, response: Optional[httpx.Response]) -> float:
+        retry_after = response.headers.get("Retry-After") if response is not None else None
+        if retry_after and retry_after.isdigit():
+            return min(float(retry_after), self.backoff_max)
+        # Full jitter: espera aleatoria hasta el backoff exponencial del intento
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** intento))
+
+    async def post(self, proveedor: str, url: str, **kwargs) -> httpx.Response:
+        """POST con límite de concurrencia del proveedor y reintentos"""
+        cliente = self._cliente_actual()
+        async with self._semaforo(proveedor):
+            for intento in range(self.reintentos + 1):
+                response = None
+                try:
+                    response = await cliente.post(url, **kwargs)
+                    if response.status_code not in ESTADOS_REINTENTABLES:
+                        return response
+                except ERRORES_REINTENTABLES:
+                    if intento == self.reintentos:
+                        raise
+                if intento == self.reintentos:
+                    return response
+                await asyncio.sleep(self._espera(intento, response))
+
+    async def cerrar(self):
+        if self._cliente is not None:
+            await self._cliente.aclose()
+            self._cliente = None
+
+
+sms_http = ClienteHTTPSMS(
+    max_conexiones=int(os.getenv("SMS_HTTP_MAX_CONEXIONES", "20")),
+    timeout=float(os.getenv("SMS_HTTP_TIMEOUT", "10")),
+    max_concurrencia=int(os.getenv("SMS_MAX_CONCURRENCIA", "10")),
+    reintentos=int(os.getenv("SMS_REINTENTOS", "3")),
+)
+
+
 class SMSService:
-    def __init__(self):
+    def __init__(self, http: ClienteHTTPSMS = sms_http):
         self.provider = os.getenv("SMS_PROVIDER", "twilio")  # twilio, generic
         self.twilio_account_sid = os.getenv("TWILIO_ACCOUNT_SID")
         self.twilio_auth_token = os.getenv("TWILIO_AUTH_TOKEN")
@@ -17,6 +107,9 @@ class SMSService:
         self.generic_api_url = os.getenv("SMS_API_URL")
         self.generic_api_key = os.getenv("SMS_API_KEY")
         self.generic_sender = os.getenv("SMS_SENDER", "CentroMedico")
+        # Destinatarios por request si el proveedor acepta "to" como lista (1 = sin lotes)
+        self.generic_batch_size = int(os.getenv("SMS_API_BATCH_SIZE", "1"))
+        self.http = http
         
         # Verificar configuración
         if self.provider == "twilio" and not all([self.twilio_account_sid, self.twilio_auth_token, self.twilio_from_number]):
@@ -39,6 +132,34 @@ class SMSService:
             logging.error(f"Error enviando SMS a {to_number}: {str(e)}")
             return False
     
+    async def send_bulk(self, envios: List[Tuple[str, str]]) -> List[bool]:
+        """Enviar varios SMS (número, mensaje); retorna el resultado de cada uno en orden.
+
+        Con el proveedor genérico y SMS_API_BATCH_SIZE > 1, los destinatarios de un
+        mismo mensaje se agrupan en un solo request.
+        """
+        if self.provider != "generic" or self.generic_batch_size <= 1:
+            return list(await asyncio.gather(*(self.send_sms(n, m) for n, m in envios)))
+        
+        por_mensaje: Dict[str, List[int]] = {}
+        for posicion, (_, mensaje) in enumerate(envios):
+            por_mensaje.setdefault(mensaje, []).append(posicion)
+        
+        lotes = []
+        for mensaje, posiciones in por_mensaje.items():
+            for i in range(0, len(posiciones), self.generic_batch_size):
+                lotes.append((mensaje, posiciones[i:i + self.generic_batch_size]))
+        
+        enviados = await asyncio.gather(*(
+            self._send_generic_sms([envios[p][0] for p in posiciones], mensaje)
+            for mensaje, posiciones in lotes
+        ))
+        resultados = [False] * len(envios)
+        for (_, posiciones), ok in zip(lotes, enviados):
+            for posicion in posiciones:
+                resultados[posicion] = ok
+        return resultados
+    
     async def _send_twilio_sms(self, to_number: str, message: str) -> bool:
         """Enviar SMS usando Twilio"""
         try:
@@ -55,8 +176,8 @@ class SMSService:
             logging.error(f"Error enviando SMS Twilio: {str(e)}")
             return False
     
-    async def _send_generic_sms(self, to_number: str, message: str) -> bool:
-        """Enviar SMS usando API genérica"""
+    async def _send_generic_sms(self, to_number, message: str) -> bool:
+        """Enviar SMS usando API genérica; to_number puede ser una lista en envíos por lote"""
         try:
             if not all([self.generic_api_url, self.generic_api_key]):
                 logging.error("Configuración de SMS genérico incompleta")
@@ -70,8 +191,8 @@ class SMSService:
                 "api_key": self.generic_api_key
             }
             
-            # Enviar request a la API
-            response = requests.post(self.generic_api_url, json=payload, timeout=30)
+            # Enviar request a la API por el cliente compartido
+            response = await self.http.post("generic", self.generic_api_url, json=payload)
             
             if response.status_code == 200:
                 logging.info(f"SMS genérico enviado exitosamente a {to_number}")
@@ -87,25 +208,34 @@ class SMSService:
     async def send_appointment_reminder(self, paciente_telefono: str, paciente_nombre: str, 
                                       fecha_cita: str, tipo_estudio: str) -> bool:
         """Enviar recordatorio de cita por SMS"""
-        message = f"Recordatorio: Su cita para {tipo_estudio} es el {fecha_cita}. Presentarse 15 min antes."
-        return await self.send_sms(paciente_telefono, message)
+        return await self.send_template(paciente_telefono, "recordatorio_cita", {
+            "paciente_nombre": paciente_nombre,
+            "fecha_cita": fecha_cita,
+            "tipo_estudio": tipo_estudio,
+        })
     
     async def send_study_results(self, paciente_telefono: str, paciente_nombre: str, 
                                tipo_estudio: str) -> bool:
         """Enviar notificación de resultados por SMS"""
-        message = f"Los resultados de su {tipo_estudio} están disponibles. Consulte su portal de paciente."
-        return await self.send_sms(paciente_telefono, message)
+        return await self.send_template(paciente_telefono, "resultados_estudio", {
+            "paciente_nombre": paciente_nombre,
+            "tipo_estudio": tipo_estudio,
+        })
     
     async def send_welcome_message(self, paciente_telefono: str, paciente_nombre: str) -> bool:
         """Enviar mensaje de bienvenida por SMS"""
-        message = f"¡Bienvenido {paciente_nombre}! Su cuenta ha sido creada exitosamente."
-        return await self.send_sms(paciente_telefono, message)
+        return await self.send_template(paciente_telefono, "bienvenida", {"paciente_nombre": paciente_nombre})
     
     async def send_urgency_notification(self, paciente_telefono: str, paciente_nombre: str, 
                                       mensaje: str) -> bool:
         """Enviar notificación urgente por SMS"""
-        message = f"URGENTE: {mensaje}"
-        return await self.send_sms(paciente_telefono, message)
+        return await self.send_template(paciente_telefono, "urgencia", {"mensaje": mensaje})
+    
+    async def send_template(self, to_number: str, plantilla: str, variables: dict,
+                            locale: Optional[str] = None) -> bool:
+        """Enviar la variante SMS de una plantilla"""
+        mensaje = await plantilla_service.render(plantilla, variables, locale, variantes=("sms",))
+        return await self.send_sms(to_number, mensaje.sms)
     
     def test_connection(self) -> bool:
         """Probar conexión del servicio SMS"""
@@ -0,0 +1,141 @@
+import logging
+import os
+import time
+from datetime import datetime
+from typing import List, Optional
+
+from app.database import get_database
+
+# Precios con los que se crea el catálogo cuando la colección tarifas está vacía
+TARIFAS_INICIALES = {
+    "Radiografía de Tórax": 150000,
+    "Resonancia Magnética": 800000,
+    "Tomografía Computarizada": 600000,
+    "Ultrasonido Abdominal": 300000,
+    "Mamografía": 250000,
+    "Densitometría Ósea": 350000,
+}
+
+VIGENCIA_INICIAL = datetime(2000, 1, 1)
+
+
+class TarifasService:
+    """Catálogo de precios por tipo de estudio con vigencia por fechas.
+
+    Las tarifas se guardan en la colección tarifas y se mantienen en memoria
+    junto con la versión de schema_info {_id: "tarifas"}. Cada escritura
+    incrementa la versión; los procesos la revisan como máximo cada
+    intervalo_revision segundos y recargan el catálogo si cambió.
+    """
+
+    def __init__(self, intervalo_revision: float = 30.0):
+        self.intervalo_revision = intervalo_revision
+        self.version: Optional[int] = None
+        self._tarifas: List[dict] = []
+        self._revisado = 0.0
+
+    async def _version_actual(self) -> int:
+        db = get_database()
+        estado = await db.schema_info.find_one({"_id": "tarifas"})
+        return estado.get("version", 0) if estado else 0
+
+    async def catalogo(self) -> List[dict]:
+        """Tarifas vigentes e históricas, recargadas si cambió la versión"""
+        if self.version is None or time.monotonic() - self._revisado > self.intervalo_revision:
+            version = await self._version_actual()
+            if version != self.version:
+                db = get_database()
+                self._tarifas = await db.tarifas.find().sort(
+                    [("tipo_estudio", 1), ("vigente_desde", 1)]
+                ).to_list(length=None)
+                self.version = version
+            self._revisado = time.monotonic()
+        return self._tarifas
+
+    def invalidar(self):
+        """Forzar la revisión de la versión en la próxima consulta"""
+        self._revisado = 0.0
+
+    async def expresion_precio(self, campo_tipo: str, campo_fecha: str) -> dict:
+        """Expresión $switch con el precio vigente para el tipo y la fecha del documento.
+
+        Retorna null cuando no hay tarifa vigente, para distinguirlo de un precio 0.
+        """
+        ramas = []
+        for tarifa in await self.catalogo():
+            condiciones = [
+                {"$eq": [campo_tipo, tarifa["tipo_estudio"]]},
+                {"$gte": [campo_fecha, tarifa["vigente_desde"]]},
+            ]
+            if tarifa.get("vigente_hasta"):
+                condiciones.append({"$lt": [campo_fecha, tarifa["vigente_hasta"]]})
+            ramas.append({"case": {"$and": condiciones}, "then": tarifa["precio"]})
+
+        if not ramas:
+            return {"$literal": None}
+        return {"$switch": {"branches": ramas, "default": None}}
+
+    async def crear_tarifa(self, tipo_estudio: str, precio: int, vigente_desde: datetime) -> dict:
+        """Registrar un precio nuevo; la tarifa abierta anterior del tipo termina en vigente_desde"""
+        db = get_database()
+        await db.tarifas.update_many(
+            {
+                "tipo_estudio": tipo_estudio,
+                "vigente_desde": {"$lt": vigente_desde},
+                "$or": [{"vigente_hasta": None}, {"vigente_hasta": {"$gt": vigente_desde}}],
+            },
+            {"$set": {"vigente_hasta": vigente_desde}},
+        )
+
+        # Si ya hay una tarifa posterior, la nueva termina donde empieza esa
+        siguiente = await db.tarifas.find_one(
+            {"tipo_estudio": tipo_estudio, "vigente_desde": {"$gt": vigente_desde}},
+            sort=[("vigente_desde", 1)],
+        )
+        tarifa = {
+            "tipo_estudio": tipo_estudio,
+            "precio": precio,
+            "vigente_desde": vigente_desde,
+            "vigente_hasta": siguiente["vigente_desde"] if siguiente else None,
+            "fecha_creacion": datetime.now(),
+        }
+        await db.tarifas.delete_many({"tipo_estudio": tipo_estudio, "vigente_desde": vigente_desde})
+        result = await db.tarifas.insert_one(tarifa)
+        tarifa["_id"] = result.inserted_id
+
+        await self.registrar_cambio()
+        return tarifa
+
+    async def registrar_cambio(self):
+        """Incrementar la versión del catálogo para que todos los procesos lo recarguen"""
+        db = get_database()
+        await db.schema_info.update_one(
+            {"_id": "tarifas"},
+            {"$inc": {"version": 1}, "$set": {"fecha_actualizacion": datetime.now()}},
+            upsert=True,
+        )
+        self.invalidar()
+
+    async def sembrar(self) -> int:
+        """Crear el catálogo inicial si la colección está vacía"""
+        db = get_database()
+        if await db.tarifas.count_documents({}, limit=1):
+            return 0
+        await db.tarifas.insert_many([
+            {
+                "tipo_estudio": tipo_estudio,
+                "precio": precio,
+                "vigente_desde": VIGENCIA_INICIAL,
+                "vigente_hasta": None,
+                "fecha_creacion": datetime.now(),
+            }
+            for tipo_estudio, precio in TARIFAS_INICIALES.items()
+        ])
+        await self.registrar_cambio()
+        logging.info(f"Catálogo de tarifas inicial creado con {len(TARIFAS_INICIALES)} tipos de estudio")
+        return len(TARIFAS_INICIALES)
+
+
+tarifas_service = TarifasService(
+    intervalo_revision=float(os.getenv("TARIFAS_CACHE_TTL", "30")),
+)
@@ -0,0 +1,134 @@
+import os
+from datetime import datetime, timedelta
+from typing import List, Optional
+
+from bson import ObjectId
+from pymongo import ReturnDocument
+
+from app.database import get_database
+
+# Los informes sin firmar forman la lista de trabajo de los radiólogos, ordenada por
+# lista_prioridad (mayor primero) y antigüedad. Un radiólogo toma el siguiente informe
+# libre con un lease que debe renovar mientras lo tiene abierto; si el lease vence, el
+# informe vuelve a quedar disponible para otro radiólogo.
+
+PRIORIDAD_URGENTE = 2
+PRIORIDAD_ALTA = 1
+PRIORIDAD_NORMAL = 0
+
+ORDEN_LISTA = [("lista_prioridad", -1), ("fecha_creacion", 1)]
+
+
+def prioridad_lista(informe: dict) -> int:
+    """Prioridad en la lista de trabajo según el informe y la prioridad de su estudio"""
+    if informe.get("urgente") or informe.get("estudio_prioridad") == "urgente":
+        return PRIORIDAD_URGENTE
+    if informe.get("estudio_prioridad") == "alta":
+        return PRIORIDAD_ALTA
+    return PRIORIDAD_NORMAL
+
+
+# Misma regla que prioridad_lista, evaluada en la base de datos
+EXPRESION_PRIORIDAD = {
+    "$switch": {
+        "branches": [
+            {
+                "case": {"$or": [
+                    {"$eq": ["$urgente", True]},
+                    {"$eq": ["$estudio_prioridad", "urgente"]},
+                ]},
+                "then": PRIORIDAD_URGENTE,
+            },
+            {"case": {"$eq": ["$estudio_prioridad", "alta"]}, "then": PRIORIDAD_ALTA},
+        ],
+        "default": PRIORIDAD_NORMAL,
+    }
+}
+
+
+class WorklistService:
+    def __init__(self, lease_minutos: float = 15):
+        self.lease = timedelta(minutes=lease_minutos)
+
+    @staticmethod
+    def _filtro_pendientes() -> dict:
+        # firmado: False debe estar en el filtro para usar el índice parcial lista_trabajo
+        return {"firmado": False}
+
+    def _filtro_libres(self, ahora: datetime) -> dict:
+        return {
+            **self._filtro_pendientes(),
+            "$or": [{"asignado_hasta": None}, {"asignado_hasta": {"$lte": ahora}}],
+        }
+
+    @staticmethod
+    def filtro_editable(usuario: Optional[str], ahora: datetime) -> dict:
+        """Informes que usuario puede modificar: sin lease vigente o con el lease suyo"""
+        condiciones = [{"asignado_hasta": None}, {"asignado_hasta": {"$lte": ahora}}]
+        if usuario:
+            condiciones.append({"asignado_a": usuario})
+        return {"$or": condiciones}
+
+    async def pendientes(self, skip: int = 0, limit: int = 50) -> List[dict]:
+        """Informes sin firmar en el orden en que se asignan"""
+        db = get_database()
+        cursor = db.informes.find(self._filtro_pendientes()).sort(ORDEN_LISTA).skip(skip).limit(limit)
+        return await cursor.to_list(length=limit)
+
+    async def tomar_siguiente(self, usuario: str) -> Optional[dict]:
+        """Asignar al usuario el informe libre de mayor prioridad.
+
+        find_one_and_update es atómico por documento: si dos radiólogos piden el
+        siguiente a la vez, cada uno recibe un informe distinto.
+        """
+        db = get_database()
+        ahora = datetime.now()
+        return await db.informes.find_one_and_update(
+            self._filtro_libres(ahora),
+            {"$set": {
+                "asignado_a": usuario,
+                "asignado_hasta": ahora + self.lease,
+                "fecha_asignacion": ahora,
+            }},
+            sort=ORDEN_LISTA,
+            return_document=ReturnDocument.AFTER,
+        )
+
+    async def renovar(self, informe_id: ObjectId, usuario: str) -> Optional[dict]:
+        """Extender el lease de un informe que el usuario aún tiene asignado"""
+        db = get_database()
+        ahora = datetime.now()
+        return await db.informes.find_one_and_update(
+            {"_id": informe_id, "asignado_a": usuario, "asignado_hasta": {"$gt": ahora}},
+            {"$set": {"asignado_hasta": ahora + self.lease}},
+            return_document=ReturnDocument.AFTER,
+        )
+
+    async def liberar(self, informe_id: ObjectId, usuario: Optional[str] = None) -> Optional[dict]:
+        """Devolver un informe a la lista; sin usuario se libera aunque sea de otro"""
+        db = get_database()
+        filtro = {"_id": informe_id}
+        if usuario:
+            filtro["asignado_a"] = usuario
+        return await db.informes.find_one_and_update(
+            filtro,
+            {"$set": {"asignado_a": None, "asignado_hasta": None}},
+            return_document=ReturnDocument.AFTER,
+        )
+
+    async def preparar(self) -> int:
+        """Calcular firmado y lista_prioridad de los informes creados antes de la lista"""
+        db = get_database()
+        result = await db.informes.update_many(
+            {"lista_prioridad": {"$exists": False}},
+            [{"$set": {
+                "firmado": {"$ifNull": ["$firmado", False]},
+                "lista_prioridad": EXPRESION_PRIORIDAD,
+            }}],
+        )
+        return result.modified_count
+
+
+worklist_service = WorklistService(
+    lease_minutos=float(os.getenv("WORKLIST_LEASE_MINUTOS", "15")),
+)
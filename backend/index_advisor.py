@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+"""
+Asesor de índices: ejecuta explain() sobre las consultas frecuentes de la
+aplicación y reporta recorridos completos (COLLSCAN) y ordenamientos en memoria
+"""
+
+import argparse
+import asyncio
+import sys
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+from app.database import client, get_database
+from app.indexes import INDEX_VERSION, aplicar_indices, consultas_frecuentes
+
+ETAPAS_PROBLEMATICAS = {
+    "COLLSCAN": "recorrido completo de la colección",
+    "SORT": "ordenamiento en memoria",
+}
+
+
+def planes_ganadores(explain):
+    """Extraer todos los winningPlan de una salida de explain (find o aggregate)"""
+    planes = []
+    if isinstance(explain, dict):
+        for clave, valor in explain.items():
+            if clave == "winningPlan":
+                # Con el motor SBE el plan real está anidado en queryPlan
+                planes.append(valor.get("queryPlan", valor))
+            else:
+                planes.extend(planes_ganadores(valor))
+    elif isinstance(explain, list):
+        for elemento in explain:
+            planes.extend(planes_ganadores(elemento))
+    return planes
+
+
+def etapas(plan):
+    """Recorrer recursivamente las etapas de un plan de ejecución"""
+    if isinstance(plan, dict):
+        if "stage" in plan:
+            yield plan
+        for valor in plan.values():
+            yield from etapas(valor)
+    elif isinstance(plan, list):
+        for elemento in plan:
+            yield from etapas(elemento)
+
+
+def describir_plan(plan):
+    """Resumir un plan como cadena de etapas, incluyendo el índice usado"""
+    partes = []
+    for etapa in etapas(plan):
+        if etapa.get("indexName"):
+            partes.append(f"{etapa['stage']}({etapa['indexName']})")
+        else:
+            partes.append(etapa["stage"])
+    return " <- ".join(partes)
+
+
+async def analizar_consulta(db, consulta):
+    """Ejecutar explain de una consulta del catálogo y clasificar su plan"""
+    comando = {"find": consulta["coleccion"], "filter": consulta["filtro"], "limit": 100}
+    if consulta.get("orden"):
+        comando["sort"] = dict(consulta["orden"])
+
+    explain = await db.command({"explain": comando, "verbosity": "queryPlanner"})
+
+    problemas = []
+    resumen = []
+    for plan in planes_ganadores(explain):
+        resumen.append(describir_plan(plan))
+        for etapa in etapas(plan):
+            if etapa["stage"] in ETAPAS_PROBLEMATICAS:
+                problemas.append(ETAPAS_PROBLEMATICAS[etapa["stage"]])
+
+    return {
+        "nombre": consulta["nombre"],
+        "coleccion": consulta["coleccion"],
+        "plan": " | ".join(resumen),
+        "problemas": sorted(set(problemas)),
+    }
+
+
+async def run_advisor(aplicar: bool):
+    """Analizar el catálogo completo y retornar el número de consultas con problemas"""
+    db = get_database()
+
+    if aplicar:
+        if await aplicar_indices(db, forzar=True):
+            print(f"🔧 Índices aplicados (versión {INDEX_VERSION})")
+
+    con_problemas = 0
+    for consulta in consultas_frecuentes():
+        resultado = await analizar_consulta(db, consulta)
+        if resultado["problemas"]:
+            con_problemas += 1
+            print(f"❌ [{resultado['coleccion']}] {resultado['nombre']}: {', '.join(resultado['problemas'])}")
+        else:
+            print(f"✅ [{resultado['coleccion']}] {resultado['nombre']}")
+        print(f"   {resultado['plan']}")
+
+    print()
+    print(f"Consultas analizadas: {len(consultas_frecuentes())}, con problemas: {con_problemas}")
+    return con_problemas
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Analizar planes de consulta con explain()")
+    parser.add_argument(
+        "--aplicar",
+        action="store_true",
+        help="crear los índices definidos en app/indexes.py antes de analizar",
+    )
+    args = parser.parse_args()
+
+    try:
+        con_problemas = asyncio.run(run_advisor(args.aplicar))
+    finally:
+        client.close()
+
+    sys.exit(1 if con_problemas else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+"""
+Migración en línea de identificadores: reescribe las referencias que usan un
+campo `id` heredado para que apunten al identificador canónico str(_id)
+"""
+
+import argparse
+import asyncio
+import os
+
+from dotenv import load_dotenv
+from pymongo import UpdateMany
+
+load_dotenv()
+
+from app.database import client, get_database
+from app.indexes import aplicar_indices
+
+UPLOAD_DIR = "uploads/dicom"
+
+# Colecciones con identificador heredado -> referencias que apuntan a ellas
+REFERENCIAS = {
+    "pacientes": [
+        ("estudios", "paciente_id"),
+        ("citas", "paciente_id"),
+        ("informes", "paciente_id"),
+        ("notificaciones", "paciente_id"),
+        ("dicom_files", "paciente_id"),
+        ("users", "paciente_id"),
+    ],
+    "estudios": [
+        ("citas", "estudio_id"),
+        ("informes", "estudio_id"),
+        ("notificaciones", "estudio_id"),
+        ("dicom_files", "estudio_id"),
+    ],
+    "informes": [],
+}
+
+# Referencias dentro de arreglos: (colección, arreglo, campo, colección referida)
+REFERENCIAS_ANIDADAS = [
+    ("estudios", "archivos_dicom", "paciente_id", "pacientes"),
+    ("informes", "imagenes_dicom", "estudio_id", "estudios"),
+]
+
+
+async def mapa_heredados(db, coleccion):
+    """Obtener {id heredado: id canónico} de los documentos cuyo id difiere de str(_id)"""
+    mapa = {}
+    cursor = db[coleccion].find(
+        {
+            "id": {"$exists": True},
+            "$expr": {"$ne": ["$id", {"$toString": "$_id"}]},
+        },
+        {"id": 1},
+    )
+    async for documento in cursor:
+        mapa[str(documento["id"])] = str(documento["_id"])
+    return mapa
+
+
+async def reescribir(db, coleccion, operaciones, dry_run, batch_size):
+    """Aplicar operaciones de actualización en lotes y retornar documentos modificados"""
+    if dry_run or not operaciones:
+        return 0
+
+    modificados = 0
+    for inicio in range(0, len(operaciones), batch_size):
+        resultado = await db[coleccion].bulk_write(
+            operaciones[inicio:inicio + batch_size], ordered=False
+        )
+        modificados += resultado.modified_count
+    return modificados
+
+
+def renombrar_directorios(mapa_estudios, dry_run):
+    """Mover los directorios de archivos DICOM nombrados con ids heredados"""
+    movidos = 0
+    for heredado, canonico in mapa_estudios.items():
+        origen = os.path.join(UPLOAD_DIR, heredado)
+        destino = os.path.join(UPLOAD_DIR, canonico)
+        if os.path.isdir(origen) and not os.path.exists(destino):
+            if not dry_run:
+                os.rename(origen, destino)
+            movidos += 1
+    return movidos
+
+
+async def migrar(dry_run: bool, batch_size: int):
+    """Ejecutar la migración completa y mostrar un resumen por colección"""
+    db = get_database()
+    await aplicar_indices(db)
+
+    mapas = {}
+    for coleccion in REFERENCIAS:
+        mapas[coleccion] = await mapa_heredados(db, coleccion)
+        print(f"📋 {coleccion}: {len(mapas[coleccion])} documentos con id heredado")
+
+    for coleccion, referencias in REFERENCIAS.items():
+        mapa = mapas[coleccion]
+        for coleccion_ref, campo in referencias:
+            operaciones = [
+                UpdateMany({campo: heredado}, {"$set": {campo: canonico}})
+                for heredado, canonico in mapa.items()
+            ]
+            modificados = await reescribir(db, coleccion_ref, operaciones, dry_run, batch_size)
+            print(f"   {coleccion_ref}.{campo}: {modificados} referencias actualizadas")
+
+    for coleccion, arreglo, campo, referida in REFERENCIAS_ANIDADAS:
+        operaciones = [
+            UpdateMany(
+                {f"{arreglo}.{campo}": heredado},
+                {"$set": {f"{arreglo}.$[elem].{campo}": canonico}},
+                array_filters=[{f"elem.{campo}": heredado}],
+            )
+            for heredado, canonico in mapas[referida].items()
+        ]
+        modificados = await reescribir(db, coleccion, operaciones, dry_run, batch_size)
+        print(f"   {coleccion}.{arreglo}[].{campo}: {modificados} documentos actualizados")
+
+    movidos = renombrar_directorios(mapas["estudios"], dry_run)
+    print(f"   {UPLOAD_DIR}: {movidos} directorios renombrados")
+
+    if dry_run:
+        print("\n⚠️  Ejecución en modo --dry-run: no se modificó la base de datos")
+    else:
+        print("\n✅ Migración completada. Los ids heredados se conservan y siguen resolviéndose por índice")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Migrar referencias con ids heredados a str(_id)")
+    parser.add_argument("--dry-run", action="store_true", help="solo reportar, sin escribir")
+    parser.add_argument("--batch-size", type=int, default=500, help="operaciones por bulk_write")
+    args = parser.parse_args()
+
+    try:
+        asyncio.run(migrar(args.dry_run, args.batch_size))
+    finally:
+        client.close()
+
+
+if __name__ == "__main__":
+    main()
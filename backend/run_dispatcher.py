@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+"""
+Script para ejecutar el dispatcher de notificaciones en un proceso separado,
+junto con el job que encola los recordatorios de citas del día siguiente
+"""
+
+import asyncio
+import os
+import signal
+from dotenv import load_dotenv
+
+# Cargar variables de entorno
+load_dotenv()
+
+from logging_config import setup_logging
+
+
+async def main():
+    from app.database import test_connection, close_database
+    from app.services.outbox_service import dispatcher
+    from app.services.recordatorios_service import recordatorios_service
+    from app.services.email_service import smtp_pool
+    from app.services.sms_service import sms_http
+
+    if not await test_connection():
+        raise SystemExit("No se pudo conectar a la base de datos")
+
+    tarea = asyncio.gather(
+        dispatcher.ejecutar(
+            intervalo=float(os.getenv("NOTIFICACIONES_INTERVALO", "5")),
+            concurrencia=int(os.getenv("NOTIFICACIONES_CONCURRENCIA", "2")),
+        ),
+        recordatorios_service.ejecutar(float(os.getenv("RECORDATORIOS_INTERVALO", "900"))),
+    )
+    loop = asyncio.get_running_loop()
+    for senal in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(senal, tarea.cancel)
+
+    try:
+        await tarea
+    except asyncio.CancelledError:
+        pass
+    finally:
+        # Los lotes reclamados sin terminar vuelven a la cola cuando vence su lease
+        await smtp_pool.cerrar()
+        await sms_http.cerrar()
+        await close_database()
+
+
+if __name__ == "__main__":
+    print("📨 Iniciando dispatcher de notificaciones...")
+    setup_logging(os.getenv("LOG_LEVEL", "INFO"), os.getenv("LOG_FILE"))
+    asyncio.run(main())
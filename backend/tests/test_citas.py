@@ -339,6 +339,106 @@ class TestCitas:
         
         response = await test_client.post("/api/citas", json=incomplete_data)
         assert response.status_code == 422
+    
+    async def test_crear_cita_publica_evento(self, test_client: AsyncClient, estudio_creado):
+        """Test crear una cita publica un evento para los suscriptores de su sala"""
+        from app.services.event_bus import event_bus
+        
+        with event_bus.suscribir({"sala": "Sala 7"}, {"cita"}) as suscripcion:
+            response = await test_client.post("/api/citas", json={
+                "paciente_id": estudio_creado["paciente_id"],
+                "estudio_id": estudio_creado["id"],
+                "fecha_cita": "2024-02-15T10:00:00",
+                "tipo_estudio": estudio_creado["tipo_estudio"],
+                "tecnico_asignado": "Técnico López",
+                "sala": "Sala 7"
+            })
+            assert response.status_code == 200
+            
+            evento = suscripcion.cola.get_nowait()
+            assert evento["tipo"] == "cita"
+            assert evento["operacion"] == "insert"
+            assert evento["documento_id"] == response.json()["id"]
+        
+        response = await test_client.get("/api/stream/status")
+        assert response.status_code == 200
+        assert response.json()["clientes"] == 0
+    
+    async def test_crear_cita_solapada_por_duracion(self, test_client: AsyncClient, estudio_creado):
+        """Test una cita que empieza antes de que termine otra de la misma sala genera conflicto"""
+        fecha = (datetime.now() + timedelta(days=30)).replace(hour=10, minute=0, second=0, microsecond=0)
+        cita_data = {
+            "paciente_id": estudio_creado["paciente_id"],
+            "fecha_cita": fecha.isoformat(),
+            "tipo_estudio": estudio_creado["tipo_estudio"],
+            "sala": "Sala Agenda",
+            "duracion_minutos": 60
+        }
+        response = await test_client.post("/api/citas", json=cita_data)
+        assert response.status_code == 200
+        
+        cita_data["fecha_cita"] = (fecha + timedelta(minutes=45)).isoformat()
+        response = await test_client.post("/api/citas", json=cita_data)
+        assert response.status_code == 400
+        assert "conflicto de horario" in response.json()["detail"].lower()
+        
+        # El horario ocupado no aparece como disponible
+        response = await test_client.get(
+            f"/api/citas/disponibilidad?fecha={fecha.strftime('%Y-%m-%d')}&sala=Sala Agenda&duracion_minutos=30"
+        )
+        assert response.status_code == 200
+        horarios = [h["inicio"] for dia in response.json()["dias"] for h in dia["horarios"]]
+        assert fecha.isoformat() not in horarios
+        assert (fecha + timedelta(minutes=30)).isoformat() not in horarios
+    
+    async def test_disponibilidad_sin_recurso(self, test_client: AsyncClient):
+        """Test disponibilidad sin sala ni técnico"""
+        response = await test_client.get("/api/citas/disponibilidad?fecha=2024-02-15")
+        assert response.status_code == 400
+    
+    async def test_recordatorios_no_se_duplican(self, test_client: AsyncClient, estudio_creado):
+        """Test generar los recordatorios dos veces no vuelve a encolarlos"""
+        fecha = (datetime.now() + timedelta(days=1)).replace(hour=9, minute=0, second=0, microsecond=0)
+        response = await test_client.post("/api/citas", json={
+            "paciente_id": estudio_creado["paciente_id"],
+            "fecha_cita": fecha.isoformat(),
+            "tipo_estudio": estudio_creado["tipo_estudio"],
+            "sala": "Sala Recordatorios"
+        })
+        assert response.status_code == 200
+        
+        response = await test_client.post(f"/api/citas/recordatorios?fecha={fecha.strftime('%Y-%m-%d')}")
+        assert response.status_code == 200
+        assert response.json()["encoladas"] >= 2  # email y SMS
+        
+        response = await test_client.post(f"/api/citas/recordatorios?fecha={fecha.strftime('%Y-%m-%d')}")
+        assert response.status_code == 200
+        assert response.json()["encoladas"] == 0
+        assert response.json()["ya_encoladas"] >= 2
+    
+    async def test_cancelar_cita_cancela_recordatorios(self, test_client: AsyncClient, estudio_creado):
+        """Test cancelar una cita cancela sus recordatorios pendientes"""
+        fecha = (datetime.now() + timedelta(days=1)).replace(hour=11, minute=0, second=0, microsecond=0)
+        response = await test_client.post("/api/citas", json={
+            "paciente_id": estudio_creado["paciente_id"],
+            "fecha_cita": fecha.isoformat(),
+            "tipo_estudio": estudio_creado["tipo_estudio"],
+            "sala": "Sala Cancelaciones"
+        })
+        cita_id = response.json()["id"]
+        response = await test_client.post(f"/api/citas/recordatorios?fecha={fecha.strftime('%Y-%m-%d')}")
+        assert response.json()["encoladas"] >= 2
+        
+        response = await test_client.delete(f"/api/citas/{cita_id}")
+        assert response.status_code == 200
+        
+        response = await test_client.get(f"/api/pacientes/{estudio_creado['paciente_id']}/notificaciones")
+        assert sum(1 for n in response.json() if n["estado"] == "cancelada") >= 2
+    
+    async def test_recordatorios_fecha_invalida(self, test_client: AsyncClient):
+        """Test generar recordatorios con fecha inválida"""
+        response = await test_client.post("/api/citas/recordatorios?fecha=15-02-2024")
+        assert response.status_code == 400
 
 
 
@@ -0,0 +1,47 @@
+"""
+Tests para los archivos DICOM de los estudios
+"""
+
+import os
+import shutil
+import uuid
+
+from bson import ObjectId
+from httpx import AsyncClient
+
+from app.database import get_database
+from app.routes.dicom import UPLOAD_DIR
+from migrate_ids import renombrar_directorios
+
+
+class TestDicom:
+    """Tests para la lectura de imágenes de estudios"""
+    
+    async def test_preview_por_id_heredado_tras_migrar(self, test_client: AsyncClient, estudio_creado):
+        """Test un id heredado sigue sirviendo las imágenes después de renombrar el directorio"""
+        heredado = str(uuid.uuid4())
+        await get_database().estudios.update_one(
+            {"_id": ObjectId(estudio_creado["id"])}, {"$set": {"id": heredado}}
+        )
+        os.makedirs(os.path.join(UPLOAD_DIR, heredado))
+        with open(os.path.join(UPLOAD_DIR, heredado, "vista.png"), "wb") as f:
+            f.write(b"\x89PNG imagen")
+        
+        try:
+            assert renombrar_directorios({heredado: estudio_creado["id"]}, dry_run=False) == 1
+            assert not os.path.exists(os.path.join(UPLOAD_DIR, heredado))
+            
+            response = await test_client.get(f"/api/dicom/public/preview/{heredado}/vista.png")
+            assert response.status_code == 200
+            assert response.content == b"\x89PNG imagen"
+            
+            response = await test_client.get(f"/api/dicom/public/list/{heredado}")
+            assert response.json()["png_files"] == ["vista.png"]
+            
+            response = await test_client.get(f"/api/dicom/public/preview/{uuid.uuid4()}/vista.png")
+            assert response.status_code == 404
+        finally:
+            shutil.rmtree(os.path.join(UPLOAD_DIR, estudio_creado["id"]), ignore_errors=True)
+
+
+
@@ -0,0 +1,73 @@
+"""
+Tests para el pool de conexiones SMTP
+"""
+
+import socket
+
+import pytest
+
+from app.services.email_service import EmailService, PoolSMTP
+
+aiosmtpd_controller = pytest.importorskip("aiosmtpd.controller")
+
+
+class _Buzon:
+    """Handler de aiosmtpd que guarda los destinatarios recibidos"""
+    
+    def __init__(self):
+        self.recibidos = []
+    
+    async def handle_DATA(self, server, session, envelope):
+        self.recibidos.extend(envelope.rcpt_tos)
+        return "250 OK"
+
+
+@pytest.fixture
+def servidor_smtp():
+    """Servidor SMTP local en un puerto libre"""
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        puerto = s.getsockname()[1]
+    
+    buzon = _Buzon()
+    controller = aiosmtpd_controller.Controller(buzon, hostname="127.0.0.1", port=puerto)
+    controller.start()
+    yield buzon, puerto
+    controller.stop()
+
+
+class TestEmailService:
+    """Tests para el envío de emails por el pool SMTP"""
+    
+    async def test_lote_reutiliza_conexiones(self, servidor_smtp):
+        """Test un lote de mensajes usa como máximo max_conexiones conexiones"""
+        buzon, puerto = servidor_smtp
+        pool = PoolSMTP("127.0.0.1", puerto, starttls=False, max_conexiones=2)
+        service = EmailService(pool=pool)
+        
+        mensajes = [
+            service.crear_mensaje(f"paciente{i}@example.com", "Recordatorio", "Su cita es mañana")
+            for i in range(20)
+        ]
+        resultados = await pool.enviar_lote(mensajes)
+        await pool.cerrar()
+        
+        assert all(resultados)
+        assert len(buzon.recibidos) == 20
+        assert pool.resumen()["conexiones_creadas"] <= 2
+    
+    async def test_conexion_se_renueva_tras_max_mensajes(self, servidor_smtp):
+        """Test una conexión se cierra al llegar a max_mensajes"""
+        buzon, puerto = servidor_smtp
+        pool = PoolSMTP("127.0.0.1", puerto, starttls=False, max_conexiones=1, max_mensajes=5)
+        service = EmailService(pool=pool)
+        
+        for i in range(10):
+            await pool.enviar(service.crear_mensaje(f"p{i}@example.com", "Aviso", "Texto"))
+        await pool.cerrar()
+        
+        assert len(buzon.recibidos) == 10
+        assert pool.resumen()["conexiones_creadas"] == 2
+
+
+
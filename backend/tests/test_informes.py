@@ -7,6 +7,46 @@ from httpx import AsyncClient
 from bson import ObjectId
 from datetime import datetime, timedelta
 
+from app.database import get_database
+from app.services.estadisticas_service import (
+    BASE_HISTOGRAMA,
+    estadisticas_service,
+    percentil,
+    sumar_histogramas,
+)
+from app.services.worklist_service import WorklistService
+
+async def _headers_radiologo(test_client: AsyncClient) -> dict:
+    """Registrar un radiólogo nuevo y retornar el encabezado con su token"""
+    email = f"radiologo-{ObjectId()}@test.com"
+    response = await test_client.post("/api/auth/register", json={
+        "email": email, "nombre": "Radiólogo", "role": "radiologo", "password": "clave-segura"
+    })
+    assert response.status_code == 200
+    response = await test_client.post("/api/auth/login", json={"email": email, "password": "clave-segura"})
+    return {"Authorization": f"Bearer {response.json()['access_token']}"}
+
+
+async def _vaciar_lista_de_trabajo(test_client: AsyncClient):
+    """Asignar a un radiólogo aparte los informes que dejaron los tests anteriores"""
+    headers = await _headers_radiologo(test_client)
+    while (await test_client.post("/api/worklist/next", headers=headers)).status_code == 200:
+        pass
+
+
+async def _crear_informe(test_client: AsyncClient, estudio_id: str, urgente: bool = False) -> dict:
+    response = await test_client.post("/api/informes", json={
+        "estudio_id": estudio_id,
+        "medico_radiologo": "Dr. Rodríguez",
+        "fecha_informe": "2024-02-15",
+        "hallazgos": "Sin hallazgos",
+        "impresion_diagnostica": "Normal",
+        "urgente": urgente,
+    })
+    assert response.status_code == 200
+    return response.json()
+
+
 class TestInformes:
     """Tests para el módulo de informes"""
     
@@ -247,6 +287,289 @@ class TestInformes:
         # Verificar que se agregó correctamente (debería ser 4: 1 original + 3 nuevos)
         assert radiografia_estadistica is not None
         assert radiografia_estadistica["cantidad"] == 4
+    
+    async def test_listado_informes_incluye_snapshot(self, test_client: AsyncClient, estudio_creado, paciente_creado):
+        """Test el listado de informes trae los datos de paciente y estudio copiados en el informe"""
+        informe_data = {
+            "estudio_id": estudio_creado["id"],
+            "medico_radiologo": "Dr. Rodríguez",
+            "fecha_informe": "2024-02-15",
+            "hallazgos": "Sin hallazgos relevantes",
+            "impresion_diagnostica": "Estudio normal",
+        }
+        create_response = await test_client.post("/api/informes", json=informe_data)
+        assert create_response.status_code == 200
+        informe_id = create_response.json()["id"]
+        
+        response = await test_client.get("/api/informes")
+        assert response.status_code == 200
+        
+        informe = next(i for i in response.json() if i["id"] == informe_id)
+        assert informe["paciente_id"] == paciente_creado["id"]
+        assert informe["paciente_nombre"] == paciente_creado["nombre"]
+        assert informe["estudio_tipo"] == estudio_creado["tipo_estudio"]
+    
+    async def test_estadisticas_rollup_refleja_nuevos_estudios(self, test_client: AsyncClient, estudio_creado):
+        """Test los rollups diarios se recalculan al registrar nuevos estudios"""
+        hoy = datetime.now().strftime("%Y-%m-%d")
+        url = f"/api/informes/estadisticas?inicio={hoy}&fin={hoy}"
+        
+        response = await test_client.get(url)
+        assert response.status_code == 200
+        total_inicial = response.json()["estudios"]["total"]
+        
+        estudio_data = {
+            "paciente_id": estudio_creado["paciente_id"],
+            "tipo_estudio": "Mamografía",
+            "medico_solicitante": "Dr. Pérez"
+        }
+        await test_client.post("/api/estudios", json=estudio_data)
+        
+        response = await test_client.get(url)
+        assert response.status_code == 200
+        assert response.json()["estudios"]["total"] == total_inicial + 1
+    
+    async def test_estadisticas_cache_metricas(self, test_client: AsyncClient):
+        """Test las consultas repetidas de estadísticas se sirven desde la caché"""
+        url = "/api/informes/estadisticas?inicio=2020-03-01&fin=2020-03-31"
+        await test_client.get(url)
+        
+        response = await test_client.get("/api/informes/cache/metricas")
+        assert response.status_code == 200
+        hits_iniciales = response.json()["hits_local"]
+        
+        await test_client.get(url)
+        
+        response = await test_client.get("/api/informes/cache/metricas")
+        data = response.json()
+        assert data["hits_local"] == hits_iniciales + 1
+        assert "tasa_aciertos" in data
+    
+    async def test_exportar_informe_csv(self, test_client: AsyncClient):
+        """Test exportar estadísticas agregadas en CSV"""
+        response = await test_client.get(
+            "/api/informes/export/estadisticas?inicio=2024-02-01&fin=2024-02-29&formato=csv"
+        )
+        assert response.status_code == 200
+        assert response.headers["content-type"].startswith("text/csv")
+        assert response.text.lstrip("\ufeff").startswith("seccion,")
+    
+    async def test_exportar_filas_financiero_csv(self, test_client: AsyncClient):
+        """Test exportar fila a fila los estudios completados con su precio"""
+        response = await test_client.get(
+            "/api/informes/export/financiero?inicio=2024-01-01&fin=2024-12-31&formato=csv&modo=filas&batch_size=100"
+        )
+        assert response.status_code == 200
+        encabezado = response.text.lstrip("\ufeff").splitlines()[0]
+        assert encabezado.split(",")[-1] == "precio"
+    
+    async def test_exportar_informe_parametros_invalidos(self, test_client: AsyncClient):
+        """Test exportar con tipo, formato o modo inválidos"""
+        base = "/api/informes/export"
+        response = await test_client.get(f"{base}/otro?inicio=2024-02-01&fin=2024-02-29")
+        assert response.status_code == 400
+        response = await test_client.get(f"{base}/estadisticas?inicio=2024-02-01&fin=2024-02-29&formato=xml")
+        assert response.status_code == 400
+        response = await test_client.get(f"{base}/estadisticas?inicio=2024-02-01&fin=2024-02-29&modo=otro")
+        assert response.status_code == 400
+    
+    async def test_rendimiento_utilizacion_con_duracion_real(self, test_client: AsyncClient, paciente_creado):
+        """Test la utilización de salas usa duracion_minutos y el horario de atención"""
+        cita_data = {
+            "paciente_id": paciente_creado["id"],
+            "fecha_cita": "2023-03-06T10:30:00",
+            "tipo_estudio": "Resonancia Magnética",
+            "sala": "Sala Utilización",
+            "tecnico_asignado": "Técnico Ruiz",
+            "duracion_minutos": 90
+        }
+        response = await test_client.post("/api/citas", json=cita_data)
+        assert response.status_code == 200
+        
+        response = await test_client.get("/api/informes/rendimiento?inicio=2023-03-06&fin=2023-03-06")
+        assert response.status_code == 200
+        data = response.json()
+        
+        sala = next(s for s in data["utilizacion_salas"] if s["sala"] == "Sala Utilización")
+        assert sala["horas_utilizadas"] == 1.5
+        
+        mapa = next(m for m in data["mapa_ocupacion"] if m["sala"] == "Sala Utilización")
+        # Lunes: 30 minutos en la hora 10 y 60 en la hora 11
+        assert mapa["por_dia_semana_hora"][0][10] == 50.0
+        assert mapa["por_dia_semana_hora"][0][11] == 100.0
+    
+    async def test_tiempos_percentiles_por_etapa(self, test_client: AsyncClient):
+        """Test los tiempos de respuesta incluyen percentiles de cada tramo del flujo"""
+        response = await test_client.get("/api/informes/tiempos?inicio=2024-01-01&fin=2024-12-31")
+        assert response.status_code == 200
+        
+        etapas = response.json()["etapas"]
+        for etapa in ["solicitud_programacion", "solicitud_realizacion", "realizacion_informe", "informe_firma"]:
+            assert etapa in etapas
+            assert "p50_horas" in etapas[etapa]
+            assert "p90_horas" in etapas[etapa]
+            assert "p99_horas" in etapas[etapa]
+    
+    async def test_tiempos_p50_dentro_del_error_del_bucket(self, test_client: AsyncClient):
+        """Test el p50 de solicitud → realización queda dentro del 5% del valor real"""
+        tipo = f"Tipo Tiempos {ObjectId()}"
+        estudio = {
+            "tipo_estudio": tipo,
+            "estado": "completado",
+            "fecha_solicitud": datetime(2021, 6, 14, 8, 0),
+            "fecha_realizacion": datetime(2021, 6, 14, 14, 0),
+        }
+        await get_database().estudios.insert_one(estudio)
+        await estadisticas_service.registrar_cambio_estudio(estudio)
+        
+        response = await test_client.get("/api/informes/tiempos?inicio=2021-06-14&fin=2021-06-14")
+        assert response.status_code == 200
+        
+        por_tipo = response.json()["etapas"]["solicitud_realizacion"]["por_tipo"]
+        resumen = next(t for t in por_tipo if t["tipo_estudio"] == tipo)
+        assert resumen["cantidad"] == 1
+        assert 6 <= resumen["p50_horas"] <= 6 * BASE_HISTOGRAMA
+    
+    async def test_eliminar_informe_actualiza_rollup(self, test_client: AsyncClient, estudio_creado):
+        """Test eliminar un informe de un día pasado lo descuenta de los rollups"""
+        informe = await _crear_informe(test_client, estudio_creado["id"])
+        await get_database().informes.update_one(
+            {"_id": ObjectId(informe["id"])},
+            {"$set": {
+                "fecha_creacion": datetime(2021, 5, 10, 12, 0),
+                "estudio_fecha": datetime(2021, 5, 10, 9, 0),
+            }},
+        )
+        url = "/api/informes/tiempos?inicio=2021-05-10&fin=2021-05-10"
+        
+        response = await test_client.get(url)
+        assert response.status_code == 200
+        cantidad_inicial = response.json()["etapas"]["realizacion_informe"]["cantidad"]
+        assert cantidad_inicial >= 1
+        
+        response = await test_client.delete(f"/api/informes/{informe['id']}")
+        assert response.status_code == 200
+        
+        response = await test_client.get(url)
+        assert response.json()["etapas"]["realizacion_informe"]["cantidad"] == cantidad_inicial - 1
+    
+    async def test_tiempos_metodo_invalido(self, test_client: AsyncClient):
+        """Test tiempos con un método de cálculo no soportado"""
+        response = await test_client.get("/api/informes/tiempos?inicio=2024-01-01&fin=2024-12-31&metodo=otro")
+        assert response.status_code == 400
+    
+    async def test_informe_urgente_encabeza_lista_de_trabajo(self, test_client: AsyncClient, estudio_creado):
+        """Test un informe urgente sin firmar entra a la lista de trabajo con prioridad máxima"""
+        informe_data = {
+            "estudio_id": estudio_creado["id"],
+            "medico_radiologo": "Dr. Rodríguez",
+            "fecha_informe": "2024-02-15",
+            "hallazgos": "Neumotórax derecho",
+            "impresion_diagnostica": "Neumotórax",
+            "urgente": True,
+        }
+        response = await test_client.post("/api/informes", json=informe_data)
+        assert response.status_code == 200
+        informe = response.json()
+        assert informe["firmado"] is False
+        assert informe["lista_prioridad"] == 2
+        assert informe["asignado_a"] is None
+        
+        # Tomar informes de la lista requiere un radiólogo autenticado
+        response = await test_client.post("/api/worklist/next")
+        assert response.status_code in [401, 403]
+    
+    async def test_worklist_asigna_urgentes_y_luego_los_mas_antiguos(self, test_client: AsyncClient, estudio_creado):
+        """Test la lista asigna primero los urgentes, luego por antigüedad, y cada radiólogo recibe uno distinto"""
+        await _vaciar_lista_de_trabajo(test_client)
+        antiguo = await _crear_informe(test_client, estudio_creado["id"])
+        reciente = await _crear_informe(test_client, estudio_creado["id"])
+        urgente = await _crear_informe(test_client, estudio_creado["id"], urgente=True)
+        primero, segundo = await _headers_radiologo(test_client), await _headers_radiologo(test_client)
+        
+        response = await test_client.post("/api/worklist/next", headers=primero)
+        assert response.status_code == 200
+        assert response.json()["id"] == urgente["id"]
+        
+        response = await test_client.post("/api/worklist/next", headers=segundo)
+        assert response.json()["id"] == antiguo["id"]
+        
+        response = await test_client.post("/api/worklist/next", headers=primero)
+        assert response.json()["id"] == reciente["id"]
+        
+        response = await test_client.post("/api/worklist/next", headers=segundo)
+        assert response.status_code == 404
+    
+    async def test_worklist_lease_vencido_y_liberar(self, test_client: AsyncClient, estudio_creado):
+        """Test un lease vencido deja el informe libre y al liberarlo otro radiólogo puede tomarlo"""
+        await _vaciar_lista_de_trabajo(test_client)
+        informe = await _crear_informe(test_client, estudio_creado["id"])
+        primero, segundo = await _headers_radiologo(test_client), await _headers_radiologo(test_client)
+        
+        # Un lease de cero minutos vence al asignarse
+        vencido = await WorklistService(lease_minutos=0).tomar_siguiente("ausente@test.com")
+        assert str(vencido["_id"]) == informe["id"]
+        
+        response = await test_client.post("/api/worklist/next", headers=primero)
+        assert response.json()["id"] == informe["id"]
+        
+        # Solo quien tiene el lease puede modificar el informe
+        for headers in ({}, segundo):
+            response = await test_client.put(f"/api/informes/{informe['id']}", json={"hallazgos": "Otro"}, headers=headers)
+            assert response.status_code == 409
+        response = await test_client.put(f"/api/informes/{informe['id']}", json={"hallazgos": "Revisado"}, headers=primero)
+        assert response.status_code == 200
+        
+        response = await test_client.post(f"/api/worklist/{informe['id']}/release", headers=segundo)
+        assert response.status_code == 409
+        response = await test_client.post(f"/api/worklist/{informe['id']}/release", headers=primero)
+        assert response.status_code == 200
+        assert response.json()["asignado_a"] is None
+        
+        response = await test_client.post("/api/worklist/next", headers=segundo)
+        assert response.json()["id"] == informe["id"]
+
+
+class TestPercentiles:
+    """Tests para los percentiles calculados desde histogramas"""
+    
+    def test_percentil_limite_superior_del_bucket(self):
+        """Test el percentil es el límite superior del bucket que lo contiene"""
+        histograma = {0: 2, 10: 3, 20: 5}
+        assert percentil(histograma, 10) == 1.0
+        assert percentil(histograma, 50) == BASE_HISTOGRAMA ** 10
+        assert percentil(histograma, 51) == BASE_HISTOGRAMA ** 20
+        assert percentil(histograma, 100) == BASE_HISTOGRAMA ** 20
+    
+    def test_percentil_histograma_vacio(self):
+        """Test sin muestras no hay percentil"""
+        assert percentil({}, 50) is None
+        assert sumar_histogramas([], "solicitud_realizacion") == {}
+    
+    def test_sumar_histogramas_de_dos_dias(self):
+        """Test fusionar los histogramas diarios por tipo de estudio"""
+        buckets = [
+            {"tiempos_solicitud_realizacion": [
+                {"clave": {"tipo": "TC", "b": 10}, "cantidad": 2, "minutos": 3.2},
+            ]},
+            {"tiempos_solicitud_realizacion": [
+                {"clave": {"tipo": "TC", "b": 10}, "cantidad": 1, "minutos": 1.6},
+                {"clave": {"tipo": "TC", "b": 12.0}, "cantidad": 1, "minutos": 1.8},
+                {"clave": {"tipo": "RX", "b": 3}, "cantidad": 4, "minutos": 4.5},
+            ]},
+            {},
+        ]
+        
+        por_tipo = sumar_histogramas(buckets, "solicitud_realizacion")
+        assert por_tipo["TC"]["cantidad"] == 4
+        assert por_tipo["TC"]["minutos"] == pytest.approx(6.6)
+        assert por_tipo["TC"]["histograma"] == {10: 3, 12: 1}
+        assert por_tipo["RX"]["histograma"] == {3: 4}
+        
+        # 3 de las 4 muestras de TC están en el bucket 10
+        assert percentil(por_tipo["TC"]["histograma"], 50) == BASE_HISTOGRAMA ** 10
+        assert percentil(por_tipo["TC"]["histograma"], 90) == BASE_HISTOGRAMA ** 12
+        assert sumar_histogramas(buckets, "informe_firma") == {}
 
 
 
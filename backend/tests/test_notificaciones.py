@@ -0,0 +1,193 @@
+"""
+Tests para el outbox de notificaciones
+"""
+
+from bson import ObjectId
+from httpx import AsyncClient
+
+from app.services.limitador_service import LimitadorEnvios
+from app.services.outbox_service import Dispatcher
+
+
+class _EmailRegistrado:
+    """EmailService que guarda los mensajes en lugar de enviarlos"""
+    
+    def __init__(self):
+        self.enviados = []
+    
+    def crear_mensaje(self, to_email, subject, body, html_body=None):
+        return {"to": to_email, "subject": subject, "body": body}
+    
+    async def send_bulk(self, mensajes):
+        self.enviados.extend(mensajes)
+        return [True] * len(mensajes)
+
+
+class _SMSRegistrado:
+    """SMSService que guarda los envíos y falla los de un número dado"""
+    
+    def __init__(self, numero_fallido=None):
+        self.enviados = []
+        self.numero_fallido = numero_fallido
+    
+    async def send_bulk(self, envios):
+        self.enviados.extend(envios)
+        return [numero != self.numero_fallido for numero, _ in envios]
+
+
+class TestNotificaciones:
+    """Tests para la creación y el envío de notificaciones"""
+    
+    async def test_crear_notificacion_queda_pendiente(self, test_client: AsyncClient, paciente_creado):
+        """Test crear una notificación la deja en el outbox sin enviarla"""
+        response = await test_client.post("/api/notificaciones", json={
+            "paciente_id": paciente_creado["id"],
+            "tipo": "email",
+            "titulo": "Prueba",
+            "mensaje": "Mensaje de prueba"
+        })
+        assert response.status_code == 200
+        data = response.json()
+        assert data["estado"] == "pendiente"
+        assert data["enviada"] is False
+        assert data["intentos_envio"] == 0
+    
+    async def test_dispatcher_envia_y_registra_resultados(self, test_client: AsyncClient, paciente_creado):
+        """Test el dispatcher reclama el lote, envía por email y SMS y guarda cada resultado"""
+        ids = []
+        for tipo in ["email", "sms"]:
+            response = await test_client.post("/api/notificaciones", json={
+                "paciente_id": paciente_creado["id"],
+                "tipo": tipo,
+                "mensaje": f"Aviso por {tipo}"
+            })
+            ids.append(response.json()["id"])
+        
+        email, sms = _EmailRegistrado(), _SMSRegistrado(numero_fallido=paciente_creado["telefono"])
+        dispatcher = Dispatcher(tamano_lote=50, email_service=email, sms_service=sms)
+        while await dispatcher.procesar_lote():
+            pass
+        
+        assert any(m["to"] == paciente_creado["email"] for m in email.enviados)
+        
+        response = await test_client.get(f"/api/notificaciones/{ids[0]}")
+        assert response.json()["estado"] == "enviada"
+        assert response.json()["enviada"] is True
+        
+        # El SMS fallido vuelve a la cola para reintentarse más tarde
+        response = await test_client.get(f"/api/notificaciones/{ids[1]}")
+        data = response.json()
+        assert data["estado"] == "pendiente"
+        assert data["intentos_envio"] == 1
+        assert data["error"] == "Error enviando SMS"
+        
+        response = await test_client.get("/api/notificaciones/metricas")
+        assert response.status_code == 200
+        assert response.json()["en_espera_de_reintento"] >= 1
+    
+    async def test_dispatcher_agota_intentos(self, test_client: AsyncClient, paciente_creado):
+        """Test una notificación que falla max_intentos veces queda como fallida"""
+        response = await test_client.post("/api/notificaciones", json={
+            "paciente_id": paciente_creado["id"],
+            "tipo": "sms",
+            "mensaje": "Aviso sin entregar"
+        })
+        notificacion_id = response.json()["id"]
+        
+        sms = _SMSRegistrado(numero_fallido=paciente_creado["telefono"])
+        dispatcher = Dispatcher(max_intentos=1, email_service=_EmailRegistrado(), sms_service=sms)
+        while await dispatcher.procesar_lote():
+            pass
+        
+        response = await test_client.get(f"/api/notificaciones/{notificacion_id}")
+        assert response.json()["estado"] == "fallida"
+        assert response.json()["intentos_envio"] == 1
+    
+    async def test_dispatcher_respeta_limite_de_envio(self, test_client: AsyncClient, paciente_creado):
+        """Test lo que excede el límite del canal vuelve a la cola sin contar como intento"""
+        # Vaciar la cola de los tests anteriores
+        while await Dispatcher(email_service=_EmailRegistrado(), sms_service=_SMSRegistrado()).procesar_lote():
+            pass
+        
+        ids = []
+        for i in range(3):
+            response = await test_client.post("/api/notificaciones", json={
+                "paciente_id": paciente_creado["id"],
+                "tipo": "email",
+                "mensaje": f"Aviso {i}"
+            })
+            ids.append(response.json()["id"])
+        
+        email = _EmailRegistrado()
+        email.smtp_server = f"smtp-{ObjectId()}"  # bucket propio del test
+        dispatcher = Dispatcher(
+            email_service=email,
+            sms_service=_SMSRegistrado(),
+            limitador=LimitadorEnvios({"email": (0.01, 1)}),
+        )
+        assert await dispatcher.procesar_lote() == 1
+        assert len(email.enviados) == 1
+        
+        estados = []
+        for notificacion_id in ids:
+            response = await test_client.get(f"/api/notificaciones/{notificacion_id}")
+            estados.append((response.json()["estado"], response.json()["intentos_envio"]))
+        assert sorted(estados) == [("enviada", 1), ("pendiente", 0), ("pendiente", 0)]
+    
+    async def test_cambios_de_estado_se_agrupan(self, test_client: AsyncClient, estudio_creado):
+        """Test varios cambios de estado dentro de la ventana generan un solo aviso por canal"""
+        for estado in ["programado", "en_proceso", "completado"]:
+            response = await test_client.put(f"/api/estudios/{estudio_creado['id']}/estado?estado={estado}")
+            assert response.status_code == 200
+            response = await test_client.post(f"/api/estudios/{estudio_creado['id']}/notificaciones/estado")
+            assert response.status_code == 200
+        
+        response = await test_client.get(f"/api/pacientes/{estudio_creado['paciente_id']}/notificaciones")
+        avisos = [n for n in response.json() if n["estudio_id"] == estudio_creado["id"]]
+        
+        assert sorted(n["tipo"] for n in avisos) == ["email", "sms"]
+        # Solo se envía el último estado
+        assert all("completado" in n["mensaje"] for n in avisos)
+        assert all(n["estado"] == "pendiente" for n in avisos)
+    
+    async def test_crear_notificaciones_bulk(self, test_client: AsyncClient, paciente_creado):
+        """Test crear notificaciones en lote devuelve el resultado de cada una en orden"""
+        response = await test_client.post("/api/notificaciones/bulk", json=[
+            {"paciente_id": paciente_creado["id"], "tipo": "email", "mensaje": "Cierre por mantenimiento"},
+            {"paciente_id": "no-es-un-id", "tipo": "email", "mensaje": "Inválida"},
+            {"paciente_id": str(ObjectId()), "tipo": "sms", "mensaje": "Paciente inexistente"},
+            {"paciente_id": paciente_creado["id"], "tipo": "sms", "mensaje": "Cierre por mantenimiento"}
+        ])
+        assert response.status_code == 200
+        data = response.json()
+        
+        assert data["creadas"] == 2
+        assert data["errores"] == 2
+        assert [r["error"] for r in data["resultados"]] == [
+            None, "ID de paciente inválido", "Paciente no encontrado", None
+        ]
+        
+        response = await test_client.get(f"/api/notificaciones/{data['resultados'][3]['id']}")
+        assert response.json()["estado"] == "pendiente"
+    
+    async def test_metricas_prometheus(self, test_client: AsyncClient, paciente_creado):
+        """Test las métricas de entrega se exponen en formato Prometheus"""
+        await test_client.post("/api/notificaciones", json={
+            "paciente_id": paciente_creado["id"],
+            "tipo": "email",
+            "mensaje": "Aviso medido"
+        })
+        while await Dispatcher(email_service=_EmailRegistrado(), sms_service=_SMSRegistrado()).procesar_lote():
+            pass
+        
+        response = await test_client.get("/api/notificaciones/metricas/prometheus")
+        assert response.status_code == 200
+        assert response.headers["content-type"].startswith("text/plain")
+        texto = response.text
+        
+        assert "# TYPE notificaciones_latencia_envio_segundos histogram" in texto
+        assert 'notificaciones_latencia_envio_segundos_count{tipo="email",proveedor="smtp"}' in texto
+        assert 'notificaciones_cola{estado="pendiente"}' in texto
+
+
+
@@ -290,6 +290,84 @@ class TestPacientes:
         
         response = await test_client.post("/api/pacientes", json=invalid_date_data)
         assert response.status_code == 422
+    
+    async def test_search_pacientes_sin_tildes(self, test_client: AsyncClient, sample_paciente_data):
+        """Test buscar pacientes por prefijo sin importar tildes ni mayúsculas"""
+        paciente = sample_paciente_data.copy()
+        paciente["nombre"] = "José Ángel"
+        paciente["apellidos"] = "Muñoz Pérez"
+        paciente["identificacion"] = "99887766"
+        paciente["email"] = "jose.angel@test.com"
+        create_response = await test_client.post("/api/pacientes", json=paciente)
+        assert create_response.status_code == 200
+        paciente_id = create_response.json()["id"]
+        
+        response = await test_client.get("/api/pacientes/search?q=jose munoz")
+        assert response.status_code == 200
+        
+        data = response.json()
+        assert data["total"] >= 1
+        assert data["resultados"][0]["id"] == paciente_id
+        
+        # Un prefijo que no coincide no debe retornar el paciente
+        response = await test_client.get("/api/pacientes/search?q=angelica")
+        assert response.status_code == 200
+        assert all(r["id"] != paciente_id for r in response.json()["resultados"])
+    
+    async def test_search_pacientes_identificacion_actualizada(self, test_client: AsyncClient, sample_paciente_data):
+        """Test cambiar la identificación actualiza los campos de búsqueda"""
+        paciente = sample_paciente_data.copy()
+        paciente["identificacion"] = "55443322"
+        paciente["email"] = "cambio.id@test.com"
+        create_response = await test_client.post("/api/pacientes", json=paciente)
+        paciente_id = create_response.json()["id"]
+        
+        response = await test_client.put(f"/api/pacientes/{paciente_id}", json={"identificacion": "77665544"})
+        assert response.status_code == 200
+        
+        response = await test_client.get("/api/pacientes/search?q=77665544")
+        assert any(r["id"] == paciente_id for r in response.json()["resultados"])
+        response = await test_client.get("/api/pacientes/search?q=55443322")
+        assert all(r["id"] != paciente_id for r in response.json()["resultados"])
+    
+    async def test_timeline_paciente(self, test_client: AsyncClient, sample_paciente_data, sample_estudio_data):
+        """Test timeline del paciente ordenado por fecha y paginado con cursor"""
+        paciente_response = await test_client.post("/api/pacientes", json=sample_paciente_data)
+        assert paciente_response.status_code == 200
+        paciente_id = paciente_response.json()["id"]
+        
+        for tipo in ["Radiografía de tórax", "Ecografía abdominal", "Tomografía"]:
+            estudio_data = sample_estudio_data.copy()
+            estudio_data["paciente_id"] = paciente_id
+            estudio_data["tipo_estudio"] = tipo
+            response = await test_client.post("/api/estudios", json=estudio_data)
+            assert response.status_code == 200
+        
+        response = await test_client.get(f"/api/pacientes/{paciente_id}/timeline?limit=2")
+        assert response.status_code == 200
+        
+        data = response.json()
+        assert data["paciente"]["id"] == paciente_id
+        assert len(data["eventos"]) == 2
+        assert data["eventos"][0]["fecha"] >= data["eventos"][1]["fecha"]
+        assert data["next_cursor"]
+        
+        # La segunda página continúa donde terminó la primera sin repetir eventos
+        response = await test_client.get(
+            f"/api/pacientes/{paciente_id}/timeline?limit=2&cursor={data['next_cursor']}"
+        )
+        assert response.status_code == 200
+        
+        segunda = response.json()
+        ids_primera = {e["id"] for e in data["eventos"]}
+        assert len(segunda["eventos"]) == 1
+        assert segunda["eventos"][0]["id"] not in ids_primera
+        assert segunda["next_cursor"] is None
+    
+    async def test_timeline_paciente_not_found(self, test_client: AsyncClient):
+        """Test timeline de paciente inexistente"""
+        response = await test_client.get(f"/api/pacientes/{ObjectId()}/timeline")
+        assert response.status_code == 404
 
 
 
@@ -0,0 +1,75 @@
+"""
+Tests para el motor de plantillas de notificación
+"""
+
+import pytest
+
+from app.services.plantilla_service import Plantilla, PlantillaService
+
+
+@pytest.fixture
+def plantillas(tmp_path):
+    """Directorio con una plantilla en español y su traducción al inglés"""
+    for locale, saludo in (("es", "Hola"), ("en", "Hello")):
+        carpeta = tmp_path / locale / "aviso"
+        carpeta.mkdir(parents=True)
+        (carpeta / "asunto.txt").write_text(f"{saludo} $nombre\n", encoding="utf-8")
+        (carpeta / "texto.txt").write_text(f"{saludo} $nombre, bienvenido a $centro.\n", encoding="utf-8")
+        (carpeta / "html.html").write_text("<p>$nombre</p>", encoding="utf-8")
+    return PlantillaService(str(tmp_path), variables_globales={"centro": "Centro"})
+
+
+class TestPlantillas:
+    """Tests para la compilación y el renderizado de plantillas"""
+    
+    def test_renderizar_todas_las_variantes(self, plantillas):
+        """Test un render produce asunto, texto, HTML escapado y SMS"""
+        mensaje = plantillas.renderizar("aviso", {"nombre": "Ana <b>"})
+        
+        assert mensaje.asunto == "Hola Ana <b>"
+        assert mensaje.texto == "Hola Ana <b>, bienvenido a Centro.\n"
+        assert mensaje.html == "<p>Ana &lt;b&gt;</p>"
+        # Sin variante SMS se usa el texto plano
+        assert mensaje.sms == "Hola Ana <b>, bienvenido a Centro."
+    
+    def test_locale_con_respaldo(self, plantillas):
+        """Test un locale sin la plantilla usa el locale por defecto"""
+        assert plantillas.renderizar("aviso", {"nombre": "Ann"}, "en").asunto == "Hello Ann"
+        assert plantillas.renderizar("aviso", {"nombre": "Ana"}, "pt").asunto == "Hola Ana"
+    
+    def test_variable_faltante(self, plantillas):
+        """Test renderizar sin una variable requerida"""
+        with pytest.raises(ValueError):
+            plantillas.renderizar("aviso", {})
+    
+    def test_plantilla_no_encontrada(self, plantillas):
+        """Test renderizar una plantilla que no existe"""
+        with pytest.raises(ValueError):
+            plantillas.renderizar("inexistente", {"nombre": "Ana"})
+    
+    def test_placeholder_invalido(self):
+        """Test una plantilla con placeholders inválidos no compila"""
+        with pytest.raises(ValueError):
+            Plantilla("rota", "es", {"texto": "Total: $ 100"})
+    
+    def test_plantillas_por_defecto(self):
+        """Test las plantillas del repositorio compilan y tienen las variables esperadas"""
+        servicio = PlantillaService()
+        recordatorio = servicio.obtener("recordatorio_cita")
+        
+        assert recordatorio.variables == ["centro", "fecha_cita", "paciente_nombre", "tipo_estudio"]
+        assert servicio.renderizar("urgencia", {"mensaje": "Llame al centro"}).sms == "URGENTE: Llame al centro"
+    
+    def test_validar_rechaza_variables_desconocidas(self, plantillas):
+        """Test una versión personalizada no puede usar variables que el código no envía"""
+        with pytest.raises(ValueError, match="apellido"):
+            plantillas.validar(Plantilla("aviso", "es", {"texto": "Hola $nombre $apellido"}, origen="personalizada"))
+    
+    def test_validar_acepta_variables_globales(self, plantillas):
+        """Test una versión personalizada puede usar las variables por defecto y las globales"""
+        plantillas.validar(Plantilla("aviso", "en", {"sms": "$nombre, $centro"}, origen="personalizada"))
+        with pytest.raises(ValueError):
+            plantillas.validar(Plantilla("inexistente", "es", {"texto": "Hola"}))
+
+
+
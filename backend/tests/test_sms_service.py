@@ -0,0 +1,99 @@
+"""
+Tests para el cliente HTTP del servicio SMS
+"""
+
+import json
+
+import httpx
+
+from app.services.sms_service import ClienteHTTPSMS, SMSService
+
+
+def _servicio_generico(gateway, batch_size: int = 1) -> SMSService:
+    """SMSService con proveedor genérico apuntando a un gateway simulado"""
+    http = ClienteHTTPSMS(backoff_base=0.01, transport=httpx.MockTransport(gateway))
+    service = SMSService(http=http)
+    service.provider = "generic"
+    service.generic_api_url = "http://gateway.local/sms"
+    service.generic_api_key = "test-api-key"
+    service.generic_batch_size = batch_size
+    return service
+
+
+class TestSMSService:
+    """Tests para el envío de SMS por el proveedor genérico"""
+    
+    async def test_reintenta_errores_temporales(self):
+        """Test un 503 del gateway se reintenta hasta obtener respuesta exitosa"""
+        llamadas = []
+        
+        def gateway(request):
+            llamadas.append(request)
+            return httpx.Response(503 if len(llamadas) < 3 else 200)
+        
+        service = _servicio_generico(gateway)
+        assert await service.send_sms("+573001234567", "Su cita es mañana")
+        assert len(llamadas) == 3
+        await service.http.cerrar()
+    
+    async def test_no_reintenta_errores_del_cliente(self):
+        """Test un 400 del gateway no se reintenta"""
+        llamadas = []
+        
+        def gateway(request):
+            llamadas.append(request)
+            return httpx.Response(400, text="número inválido")
+        
+        service = _servicio_generico(gateway)
+        assert not await service.send_sms("123", "Mensaje")
+        assert len(llamadas) == 1
+        await service.http.cerrar()
+    
+    async def test_reintenta_solo_si_el_mensaje_no_salio(self):
+        """Test un error de conexión se reintenta, pero un timeout de lectura o un 500 no"""
+        llamadas = []
+        
+        def gateway(request):
+            llamadas.append(request)
+            if len(llamadas) == 1:
+                raise httpx.ConnectError("conexión rechazada")
+            return httpx.Response(200)
+        
+        service = _servicio_generico(gateway)
+        assert await service.send_sms("+573001234567", "Su cita es mañana")
+        assert len(llamadas) == 2
+        await service.http.cerrar()
+        
+        for fallo in (httpx.ReadTimeout("sin respuesta"), httpx.Response(500)):
+            llamadas.clear()
+            
+            def gateway_ambiguo(request):
+                llamadas.append(request)
+                if isinstance(fallo, Exception):
+                    raise fallo
+                return fallo
+            
+            service = _servicio_generico(gateway_ambiguo)
+            assert not await service.send_sms("+573001234567", "Su cita es mañana")
+            assert len(llamadas) == 1
+            await service.http.cerrar()
+    
+    async def test_lote_agrupa_destinatarios_por_mensaje(self):
+        """Test los destinatarios de un mismo mensaje viajan en un solo request"""
+        destinatarios = []
+        
+        def gateway(request):
+            destinatarios.append(json.loads(request.content)["to"])
+            return httpx.Response(200)
+        
+        service = _servicio_generico(gateway, batch_size=100)
+        envios = [(f"+57300000000{i}", "Recordatorio de cita") for i in range(5)]
+        envios.append(("+573009999999", "Resultados disponibles"))
+        
+        resultados = await service.send_bulk(envios)
+        assert resultados == [True] * 6
+        assert sorted(len(d) for d in destinatarios) == [1, 5]
+        await service.http.cerrar()
+
+
+
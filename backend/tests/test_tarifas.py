@@ -0,0 +1,37 @@
+"""
+Tests para el catálogo de tarifas
+"""
+
+import pytest
+from httpx import AsyncClient
+
+class TestTarifas:
+    """Tests para el catálogo de tarifas"""
+    
+    async def test_crear_tarifa_cierra_la_anterior(self, test_client: AsyncClient):
+        """Test una tarifa nueva termina la vigencia de la anterior del mismo tipo"""
+        tipo = "Ecografía Doppler"
+        await test_client.post("/api/tarifas", json={
+            "tipo_estudio": tipo, "precio": 200000, "vigente_desde": "2024-01-01T00:00:00"
+        })
+        response = await test_client.post("/api/tarifas", json={
+            "tipo_estudio": tipo, "precio": 220000, "vigente_desde": "2024-07-01T00:00:00"
+        })
+        assert response.status_code == 200
+        
+        response = await test_client.get(f"/api/tarifas?tipo_estudio={tipo}&vigente_en=2024-03-15")
+        assert response.status_code == 200
+        tarifas = response.json()
+        assert len(tarifas) == 1
+        assert tarifas[0]["precio"] == 200000
+        assert tarifas[0]["vigente_hasta"].startswith("2024-07-01")
+        
+        response = await test_client.get(f"/api/tarifas?tipo_estudio={tipo}&vigente_en=2024-08-01")
+        assert response.json()[0]["precio"] == 220000
+    
+    async def test_crear_tarifa_precio_negativo(self, test_client: AsyncClient):
+        """Test crear tarifa con precio negativo"""
+        response = await test_client.post("/api/tarifas", json={
+            "tipo_estudio": "Mamografía", "precio": -1, "vigente_desde": "2024-01-01T00:00:00"
+        })
+        assert response.status_code == 422
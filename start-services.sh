@@ -37,7 +37,7 @@ kill_port() {
 cleanup() {
     echo ""
     echo -e "${YELLOW}🛑 Deteniendo servicios...${NC}"
-    kill $BACKEND_PID $FRONTEND_PID 2>/dev/null
+    kill $BACKEND_PID $DISPATCHER_PID $FRONTEND_PID 2>/dev/null
     exit 0
 }
 
@@ -95,6 +95,10 @@ cd backend
 source .venv/bin/activate
 uvicorn app.main:app --reload --host 127.0.0.1 --port 8000 > ../backend.log 2>&1 &
 BACKEND_PID=$!
+
+# Iniciar dispatcher de notificaciones (envía emails y SMS del outbox)
+python run_dispatcher.py > ../dispatcher.log 2>&1 &
+DISPATCHER_PID=$!
 cd ..
 
 # Esperar a que el backend inicie (reducido a 10 segundos max)